@@ -1,32 +1,92 @@
+import os
+import math
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles  # ✅ NEW
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
 
 from app.routes import router as app_router
+from app.telegram_webhook import (
+    router as telegram_router,
+    TELEGRAM_WEBHOOK_URL,
+    start_telegram_bot,
+    stop_telegram_bot,
+)
+from rag.rate_limiter import RateLimitRule, create_rate_limiter
+from rag.jobs import get_job_queue
+from rag.glossary_vectors import get_glossary_vectors
+from rag.precompute import warm_precomputed_answers
+from rag.suggest import rebuild_suggestion_index
 
 # Initialize PostHog LLM observability before any LangChain call happens.
 from observability import init_observability
 init_observability()
 
-# Initialize app and limiter
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI()
+# Initialize app and limiter. The limiter state is shared with every other
+# local process (other uvicorn workers, the Telegram bot), so adding workers
+# does not multiply the per-IP budget.
+HTTP_RATE_LIMIT_PER_MINUTE = int(os.getenv("HTTP_RATE_LIMIT_PER_MINUTE", "30"))
+RATE_LIMITED_PATHS = ("/ask", "/thread", "/jobs")
+
+limiter = create_rate_limiter(
+    [RateLimitRule("minute", HTTP_RATE_LIMIT_PER_MINUTE, 60.0)],
+    namespace="http",
+)
+# "split": the bot runs as its own process (python bot/bot.py, see supervisord.conf).
+# "unified": the bot runs inside this app on the same event loop, sharing
+# clients, caches, rate limits and the worker pool. Webhook mode implies unified.
+RUNTIME_MODE = os.getenv("RUNTIME_MODE", "split")
+
+def _warm_glossary_vectors() -> None:
+    # Builds the term embeddings if ingest has not (one embeddings request);
+    # until then glossary query variants are embedded through the API
+    try:
+        get_glossary_vectors(build=True)
+    except Exception as exc:
+        print(f"Glossary vectors unavailable: {exc}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    requeued = get_job_queue().recover()
+    if requeued:
+        print(f"Requeued {requeued} background jobs")
+    try:
+        print(f"Loaded {warm_precomputed_answers()} precomputed answers")
+    except Exception as exc:
+        print(f"Precomputed answers unavailable: {exc}")
+    asyncio.get_running_loop().run_in_executor(None, _warm_glossary_vectors)
+    rebuild_suggestion_index()
+    if RUNTIME_MODE == "unified" or TELEGRAM_WEBHOOK_URL:
+        await start_telegram_bot(app)
+    yield
+    await stop_telegram_bot(app)
+    get_job_queue().shutdown()
+
+app = FastAPI(lifespan=lifespan)
 app.state.limiter = limiter
+app.state.telegram_app = None
 
 # ✅ Mount static files (for style.css and other assets)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
-# Rate limit handler
-@app.exception_handler(RateLimitExceeded)
-async def rate_limit_handler(request: Request, exc: RateLimitExceeded):
-    return JSONResponse(
-        status_code=429,
-        content={"message": "Too many requests. Please wait and try again."}
-    )
+# Rate limit middleware
+@app.middleware("http")
+async def rate_limit_middleware(request: Request, call_next):
+    if request.method == "POST" and request.url.path.startswith(RATE_LIMITED_PATHS):
+        client_ip = request.client.host if request.client else "unknown"
+        # The shared limiter may wait on the SQLite write lock; keep it off the event loop
+        decision = await run_in_threadpool(limiter.check, client_ip)
+        if not decision.allowed:
+            return JSONResponse(
+                status_code=429,
+                content={"message": "Too many requests. Please wait and try again."},
+                headers={"Retry-After": str(max(1, math.ceil(decision.retry_after)))},
+            )
+    return await call_next(request)
 
 # Optional: CORS middleware if needed
 app.add_middleware(
@@ -39,5 +99,6 @@ app.add_middleware(
 
 # Include routes
 app.include_router(app_router)
+app.include_router(telegram_router)
 
 # Run this with: `uvicorn app.main:app --reload`
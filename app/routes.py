@@ -1,14 +1,25 @@
 from fastapi import APIRouter, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 import sys
 import os
+import json
+import math
 import time
+from pydantic import BaseModel, Field
+from typing import Optional
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from rag.query import query_rag, check_qdrant_ready
-from generate.thread import generate_thread
 from rag.metadata_db import get_metadata_db
 from rag.guardrails import get_guardrails
+from rag.admission import AdmissionRejected, get_admission_controller
+from rag.metrics import get_metrics
+from rag.deadline import Deadline
+from rag.jobs import get_job_queue
+from rag.suggest import suggest_questions
+
+# Budget for a web request, counted from arrival so queue wait is included
+WEB_REQUEST_TIMEOUT_SECONDS = float(os.getenv("WEB_REQUEST_TIMEOUT_SECONDS", "60"))
 
 router = APIRouter()
 templates = Jinja2Templates(directory="app/templates")
@@ -17,19 +28,45 @@ templates = Jinja2Templates(directory="app/templates")
 async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+def _busy_response(request: Request, question: str, exc: AdmissionRejected):
+    """Fast 503 for work refused by admission control."""
+    retry_after = max(1, math.ceil(exc.retry_after))
+    return templates.TemplateResponse("index.html", {
+        "request": request,
+        "question": question,
+        "answer": f"The assistant is busy right now. Please try again in {retry_after} seconds.",
+        "error": True
+    }, status_code=503, headers={"Retry-After": str(retry_after)})
+
+def _timing_headers(timing, result: dict = None) -> dict:
+    headers = {
+        "X-Queue-Wait-Ms": str(timing.queue_wait_ms),
+        "X-Service-Time-Ms": str(timing.service_time_ms),
+    }
+    if result and result.get("service_level"):
+        headers["X-Service-Level"] = result["service_level"]
+    return headers
+
 @router.post("/ask", response_class=HTMLResponse)
 async def ask(request: Request, question: str = Form(...)):
     start_time = time.time()
+    deadline = Deadline(WEB_REQUEST_TIMEOUT_SECONDS)
     
     # Get client IP for user identification
     client_ip = request.client.host if request.client else "unknown"
     
-    # Enhanced query with guardrails
-    result = query_rag(
-        question=question,
-        user_id=client_ip,
-        client_type="web"
-    )
+    # Enhanced query with guardrails, run on the bounded worker pool
+    try:
+        result, timing = await get_admission_controller().run(
+            "web",
+            query_rag,
+            question=question,
+            user_id=client_ip,
+            client_type="web",
+            deadline=deadline
+        )
+    except AdmissionRejected as exc:
+        return _busy_response(request, question, exc)
     
     processing_time = int((time.time() - start_time) * 1000)
     
@@ -39,7 +76,7 @@ async def ask(request: Request, question: str = Form(...)):
             "question": question,
             "answer": f"Error: {result.get('response', 'Unknown error')}",
             "error": True
-        })
+        }, headers=_timing_headers(timing, result))
     
     return templates.TemplateResponse("index.html", {
         "request": request,
@@ -47,7 +84,7 @@ async def ask(request: Request, question: str = Form(...)):
         "answer": result["response"],
         # hide confidence and sources from consumer UI
         "processing_time": processing_time,
-    })
+    }, headers=_timing_headers(timing, result))
 
 @router.post("/thread", response_class=HTMLResponse)
 async def thread(request: Request, topic: str = Form(...)):
@@ -57,25 +94,39 @@ async def thread(request: Request, topic: str = Form(...)):
     client_ip = request.client.host if request.client else "unknown"
     
     try:
-        # Generate thread content
-        thread_content = generate_thread(topic)
-        
-        # Get sources separately for the topic (not the thread generation process)
-        sources_result = query_rag(
-            question=topic,
-            user_id=client_ip,
-            client_type="web"
-        )
+        # Generation runs on the background job queue; waiting for it here
+        # holds no worker, and repeated topics are served from the job cache
+        job = get_job_queue().submit_thread(topic, user_id=client_ip, client_type="web")
+        job = await get_job_queue().wait(job.id, timeout=WEB_REQUEST_TIMEOUT_SECONDS)
         
         processing_time = int((time.time() - start_time) * 1000)
         
+        if not job.finished:
+            return templates.TemplateResponse("index.html", {
+                "request": request,
+                "question": topic,
+                "answer": f"Your thread is still being generated. Check /jobs/{job.id} for the result.",
+                "error": True
+            }, status_code=202)
+        
+        result = job.result or {}
+        if job.status != "succeeded":
+            return templates.TemplateResponse("index.html", {
+                "request": request,
+                "question": topic,
+                "answer": result.get("thread") or "Could not generate a thread for this topic.",
+                "error": True
+            })
+        
         return templates.TemplateResponse("index.html", {
             "request": request,
-            "thread": thread_content,
+            "thread": result["thread"],
             "question": topic,
             # hide confidence and sources from consumer UI
             "processing_time": processing_time,
         })
+    except AdmissionRejected as exc:
+        return _busy_response(request, topic, exc)
     except Exception as e:
         return templates.TemplateResponse("index.html", {
             "request": request,
@@ -84,6 +135,61 @@ async def thread(request: Request, topic: str = Form(...)):
             "error": True
         })
 
+class ThreadJobRequest(BaseModel):
+    topic: str = Field(..., min_length=1, max_length=500)
+    template: Optional[str] = None
+
+@router.post("/jobs/thread", response_class=JSONResponse)
+async def create_thread_job(request: Request, body: ThreadJobRequest):
+    """Queue a thread generation; returns the job at once (already finished when cached)."""
+    client_ip = request.client.host if request.client else "unknown"
+    try:
+        job = get_job_queue().submit_thread(
+            body.topic, user_id=client_ip, client_type="api", template_name=body.template
+        )
+    except AdmissionRejected as exc:
+        retry_after = max(1, math.ceil(exc.retry_after))
+        return JSONResponse(
+            status_code=503,
+            content={"message": "The job queue is full. Please try again later."},
+            headers={"Retry-After": str(retry_after)},
+        )
+    return JSONResponse(
+        status_code=200 if job.finished else 202,
+        content=job.to_dict(),
+        headers={"Location": f"/jobs/{job.id}"},
+    )
+
+@router.get("/jobs/{job_id}", response_class=JSONResponse)
+async def get_job(job_id: str):
+    """Current state of a job, with its result once finished."""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events: one `progress` event per status or stage change, then `done`."""
+    queue = get_job_queue()
+    if queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def events():
+        async for job in queue.watch(job_id, timeout=queue.job_timeout * 2):
+            event = "done" if job.finished else "progress"
+            yield f"event: {event}\ndata: {json.dumps(job.to_dict())}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.get("/suggest", response_class=JSONResponse)
+async def suggest(q: str = "", limit: int = 8):
+    """Popular questions starting with `q` for the question box; questions with cached answers rank higher."""
+    started = time.perf_counter()
+    suggestions = suggest_questions(q, max(1, min(limit, 20)))
+    get_metrics().observe("suggest_latency_us", (time.perf_counter() - started) * 1_000_000)
+    return {"query": q, "suggestions": suggestions}
+
 @router.get("/analytics", response_class=JSONResponse)
 async def get_analytics(days: int = 30):
     """Get usage analytics."""
@@ -94,6 +200,11 @@ async def get_analytics(days: int = 30):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/metrics", response_class=JSONResponse)
+async def get_runtime_metrics():
+    """In-process runtime metrics (admission control, queue wait, service time, service levels)."""
+    return get_metrics().snapshot()
+
 @router.get("/health", response_class=JSONResponse)
 async def health_check():
     """Health check endpoint."""
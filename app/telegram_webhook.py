@@ -0,0 +1,93 @@
+import os
+import hmac
+import secrets
+
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+from telegram import Update
+from rag.metrics import get_metrics
+from rag.admission import get_admission_controller
+
+# Public base URL Telegram should call, e.g. https://assistant.onrender.com.
+# When unset, a bot running inside this app long-polls instead.
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram/webhook")
+# Updates waiting for the dispatcher before we ask Telegram to redeliver later
+TELEGRAM_WEBHOOK_MAX_QUEUE = int(os.getenv("TELEGRAM_WEBHOOK_MAX_QUEUE", "1000"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+router = APIRouter()
+
+
+async def start_telegram_bot(app) -> None:
+    """
+    Start the Telegram application on this event loop, sharing the web app's
+    worker pool, caches and clients.
+
+    With TELEGRAM_WEBHOOK_URL set, Telegram's webhook is pointed at this app
+    and updates arrive through `telegram_webhook`; otherwise the bot
+    long-polls from here.
+    """
+    from bot.bot import build_application
+
+    application = build_application(
+        updater=not TELEGRAM_WEBHOOK_URL,
+        pipeline_pool=get_admission_controller(),
+    )
+    await application.initialize()
+    await application.start()
+    app.state.telegram_app = application
+
+    if TELEGRAM_WEBHOOK_URL:
+        secret = os.getenv("TELEGRAM_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+        await application.bot.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL + TELEGRAM_WEBHOOK_PATH,
+            secret_token=secret,
+            drop_pending_updates=True,
+        )
+        app.state.telegram_secret = secret
+        print(f"Telegram webhook set to {TELEGRAM_WEBHOOK_URL + TELEGRAM_WEBHOOK_PATH}")
+    else:
+        # Long polling returns as soon as an update arrives; no extra poll interval
+        await application.updater.start_polling(poll_interval=0.0, timeout=30, drop_pending_updates=True)
+        print("Telegram bot polling from the web process")
+
+
+async def stop_telegram_bot(app) -> None:
+    # A webhook is left registered so a replacement instance keeps receiving updates
+    application = getattr(app.state, "telegram_app", None)
+    if application is None:
+        return
+    if application.updater is not None and application.updater.running:
+        await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    app.state.telegram_app = None
+
+
+@router.post(TELEGRAM_WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    """Verify Telegram's secret token, queue the update for the dispatcher and ack immediately."""
+    application = getattr(request.app.state, "telegram_app", None)
+    if application is None or not TELEGRAM_WEBHOOK_URL:
+        return JSONResponse(status_code=404, content={"ok": False})
+
+    token = request.headers.get(SECRET_HEADER, "")
+    if not hmac.compare_digest(token, request.app.state.telegram_secret):
+        get_metrics().inc("telegram_webhook_rejected", reason="secret")
+        return JSONResponse(status_code=403, content={"ok": False})
+
+    if application.update_queue.qsize() >= TELEGRAM_WEBHOOK_MAX_QUEUE:
+        # Telegram redelivers on non-2xx, so shed load instead of queueing without bound
+        get_metrics().inc("telegram_webhook_rejected", reason="queue_full")
+        return JSONResponse(status_code=503, content={"ok": False})
+
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception:
+        get_metrics().inc("telegram_webhook_rejected", reason="malformed")
+        return JSONResponse(status_code=400, content={"ok": False})
+    await application.update_queue.put(update)
+    get_metrics().inc("telegram_webhook_updates")
+    return {"ok": True}
@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for in-process components of the RAG system.
+Unlike load_test.py these run without a server, Qdrant or OpenAI.
+
+Usage:
+    python benchmark.py                 # run all benchmarks
+    python benchmark.py rate_limiter    # run a single benchmark
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import threading
+import tracemalloc
+import multiprocessing
+
+# Add the project root to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def _report_latencies(label, samples_ns):
+    print(f"  {label}:")
+    print(f"    Calls: {len(samples_ns)}")
+    print(f"    Mean: {statistics.mean(samples_ns) / 1000:.2f}µs")
+    print(f"    p50: {_percentile(samples_ns, 0.50) / 1000:.2f}µs")
+    print(f"    p99: {_percentile(samples_ns, 0.99) / 1000:.2f}µs")
+
+
+def bench_rate_limiter(num_users=100_000, checks_per_user=5, threads=8):
+    """Sliding-window rate limiter: per-check cost and memory at 100k users."""
+    from rag.rate_limiter import RateLimitRule, SlidingWindowRateLimiter
+
+    print("⏱️  Rate limiter")
+    print("=" * 50)
+
+    rules = [
+        RateLimitRule("hour", 100, 3600.0),
+        RateLimitRule("minute", 10, 60.0),
+    ]
+    users = [f"user-{i}" for i in range(num_users)]
+
+    # 1. Cold inserts + repeated checks across 100k distinct users
+    limiter = SlidingWindowRateLimiter(rules)
+    samples = []
+    order = users * checks_per_user
+    random.shuffle(order)
+    for user in order:
+        t0 = time.perf_counter_ns()
+        limiter.check(user)
+        samples.append(time.perf_counter_ns() - t0)
+    _report_latencies(f"{num_users} users x {checks_per_user} checks", samples)
+    print(f"    Tracked keys: {len(limiter)}")
+
+    tracemalloc.start()
+    sized = SlidingWindowRateLimiter(rules)
+    for user in users:
+        sized.check(user)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"    Limiter memory: {current / 1024 / 1024:.1f} MiB ({current / num_users:.0f} B/user)")
+
+    # 2. One hot user with a long history: cost must not grow with history
+    hot = SlidingWindowRateLimiter([RateLimitRule("minute", 10**9, 60.0)])
+    samples = []
+    for _ in range(200_000):
+        t0 = time.perf_counter_ns()
+        hot.check("hot-user")
+        samples.append(time.perf_counter_ns() - t0)
+    _report_latencies("single user, 200k-event history", samples[-10_000:])
+
+    # 3. Concurrent threads sharing one limiter
+    shared = SlidingWindowRateLimiter(rules)
+    per_thread = num_users // threads
+
+    def worker(offset):
+        for i in range(per_thread):
+            shared.check(users[offset + i])
+
+    workers = [threading.Thread(target=worker, args=(t * per_thread,)) for t in range(threads)]
+    t0 = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - t0
+    print(f"  {threads} threads x {per_thread} checks:")
+    print(f"    Throughput: {threads * per_thread / elapsed:,.0f} checks/s")
+
+    # 4. Idle eviction keeps the table bounded
+    now = [0.0]
+    evicting = SlidingWindowRateLimiter(rules, clock=lambda: now[0])
+    for user in users:
+        evicting.check(user)
+    now[0] += 2 * 3600.0 + 1
+    for i in range(num_users // SlidingWindowRateLimiter.EVICTIONS_PER_CHECK + 1):
+        evicting.check(f"late-{i % 100}")
+    print(f"  Idle eviction: {num_users} stale keys -> {len(evicting)} tracked")
+    print()
+
+
+def _shared_limiter_worker(db_path, key, attempts, results):
+    from rag.rate_limiter import RateLimitRule, SQLiteRateLimiter
+
+    limiter = SQLiteRateLimiter([RateLimitRule("minute", 100, 60.0)], db_path=db_path)
+    results.put(sum(1 for _ in range(attempts) if limiter.check(key).allowed))
+
+
+def bench_shared_rate_limiter(num_checks=20_000, processes=4):
+    """SQLite-backed limiter: per-check cost and a cross-process budget."""
+    from rag.rate_limiter import RateLimitRule, SQLiteRateLimiter
+
+    print("⏱️  Shared (SQLite) rate limiter")
+    print("=" * 50)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "ratelimit.db")
+        limiter = SQLiteRateLimiter(
+            [RateLimitRule("hour", 100, 3600.0), RateLimitRule("minute", 10, 60.0)],
+            db_path=db_path,
+        )
+        samples = []
+        for i in range(num_checks):
+            t0 = time.perf_counter_ns()
+            limiter.check(f"user-{i % 5000}")
+            samples.append(time.perf_counter_ns() - t0)
+        _report_latencies(f"{num_checks} checks over 5000 users", samples)
+
+        # N processes share one key with a budget of 100
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=_shared_limiter_worker, args=(db_path, "shared", 200, results))
+            for _ in range(processes)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        allowed = sum(results.get() for _ in procs)
+        print(f"  {processes} processes x 200 attempts against a 100/min budget:")
+        print(f"    Allowed in total: {allowed}")
+    print()
+
+
+def _legacy_guardrail_pass(query, config):
+    """The pre-PromptMatcher checks: keyword loop, regex loop, then classification twice."""
+    import re
+
+    query_lower = query.lower()
+    for keyword in config.restricted_keywords:
+        if keyword in query_lower:
+            return False
+    for pattern in config.injection_patterns:
+        if re.search(pattern, query_lower, re.IGNORECASE):
+            return False
+    for _ in range(2):  # classify_prompt + get_allowed_tools_for_prompt
+        for words in config.category_keywords.values():
+            if any(word in query_lower for word in words):
+                break
+    return True
+
+
+def bench_guardrails(iterations=20_000, rule_counts=(0, 100, 300, 1000)):
+    """Single-pass PromptMatcher vs the legacy checks as rule lists grow."""
+    from rag.guardrails import GuardrailConfig, PromptMatcher
+
+    print("⏱️  Guardrail prompt checks")
+    print("=" * 50)
+
+    rng = random.Random(42)
+    queries = [
+        "What is DVN in LayerZero?",
+        "How does the ultra light node verify messages between chains?",
+        "Write a thread about OFTs and omnichain composability",
+        "explain lzRead and how an OApp can pull state from another chain, with code",
+        "show me usage metrics for the endpoint over the last week please",
+    ]
+
+    def synthetic_words(n):
+        return [
+            "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(5, 12)))
+            for _ in range(n)
+        ]
+
+    for extra in rule_counts:
+        base = GuardrailConfig()
+        config = GuardrailConfig(
+            restricted_keywords=base.restricted_keywords + synthetic_words(extra // 2),
+            injection_patterns=base.injection_patterns + [
+                rf"{w}\s+\w+" for w in synthetic_words(extra // 10)
+            ],
+            category_keywords={
+                category: words + synthetic_words(extra // 10)
+                for category, words in base.category_keywords.items()
+            },
+        )
+        total_rules = (
+            len(config.restricted_keywords)
+            + len(config.injection_patterns)
+            + sum(len(words) for words in config.category_keywords.values())
+        )
+        matcher = PromptMatcher(config)
+
+        matched, legacy = [], []
+        for i in range(iterations):
+            query = queries[i % len(queries)]
+            t0 = time.perf_counter_ns()
+            matcher.match(query)
+            matched.append(time.perf_counter_ns() - t0)
+            t0 = time.perf_counter_ns()
+            _legacy_guardrail_pass(query, config)
+            legacy.append(time.perf_counter_ns() - t0)
+        print(f"  {total_rules} rules:")
+        print(f"    PromptMatcher p50/p99: {_percentile(matched, 0.5) / 1000:.2f}µs / {_percentile(matched, 0.99) / 1000:.2f}µs")
+        print(f"    Legacy checks p50/p99: {_percentile(legacy, 0.5) / 1000:.2f}µs / {_percentile(legacy, 0.99) / 1000:.2f}µs")
+    print()
+
+
+class FakeTelegramAPI:
+    """
+    Minimal stand-in for the Telegram Bot API, served on localhost. Answers
+    the methods the bot uses and records when each call arrived, so webhook
+    handling can be exercised without Telegram.
+    """
+
+    def __init__(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs
+        import json
+
+        api = self
+        self.calls = []  # (perf_counter, method, payload)
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("application/json"):
+                    payload = json.loads(raw or b"{}")
+                elif content_type.startswith("application/x-www-form-urlencoded"):
+                    # python-telegram-bot posts form-encoded parameters
+                    payload = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+                else:
+                    # multipart uploads are not needed for these methods
+                    payload = {}
+                with api._lock:
+                    api.calls.append((time.perf_counter(), method, payload))
+                body = json.dumps({"ok": True, "result": api._result(method, payload)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _result(self, method, payload):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(payload.get("chat_id", 0))
+            return {
+                "message_id": int(payload.get("message_id", 1)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": payload.get("text", ""),
+            }
+        return True
+
+    def first_call(self, method, chat_id):
+        with self._lock:
+            for at, name, payload in self.calls:
+                if name == method and int(payload.get("chat_id", 0)) == chat_id:
+                    return at
+        return None
+
+    def close(self):
+        self.server.shutdown()
+
+
+def bench_telegram_webhook(num_updates=200):
+    """Webhook ingestion: ack latency and update pickup latency against a fake Bot API."""
+    fake = FakeTelegramAPI()
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:fake-token",
+        "TELEGRAM_API_BASE_URL": fake.base_url,
+        "TELEGRAM_WEBHOOK_URL": "http://testserver",
+        "TELEGRAM_WEBHOOK_SECRET": "bench-secret",
+    })
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    print("📨 Telegram webhook")
+    print("=" * 50)
+
+    acks, pickups = [], []
+    with TestClient(app) as client:
+        sent = {}
+        for i in range(num_updates):
+            chat_id = 1000 + i
+            update = {
+                "update_id": i + 1,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                    "text": "/start",
+                    "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+                },
+            }
+            t0 = time.perf_counter()
+            response = client.post(
+                "/telegram/webhook",
+                json=update,
+                headers={"X-Telegram-Bot-Api-Secret-Token": "bench-secret"},
+            )
+            acks.append((time.perf_counter() - t0) * 1e9)
+            assert response.status_code == 200, response.text
+            sent[chat_id] = t0
+
+        rejected = client.post("/telegram/webhook", json={}, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        deadline = time.time() + 10
+        while time.time() < deadline and any(fake.first_call("sendMessage", c) is None for c in sent):
+            time.sleep(0.01)
+        for chat_id, t0 in sent.items():
+            replied = fake.first_call("sendMessage", chat_id)
+            if replied is not None:
+                pickups.append((replied - t0) * 1e9)
+    fake.close()
+
+    _report_latencies("Webhook ack", acks)
+    _report_latencies("Update → first reply", pickups)
+    print(f"  Replies received: {len(pickups)}/{num_updates}")
+    print(f"  Wrong secret token → HTTP {rejected.status_code}")
+    print()
+
+
+class _CountingCrossEncoder:
+    """Stand-in cross-encoder: scores by query-term overlap and counts the pairs it sees."""
+
+    def __init__(self):
+        self.pairs = 0
+
+    def predict(self, pairs):
+        self.pairs += len(pairs)
+        scores = []
+        for query, passage in pairs:
+            terms = set(query.split())
+            overlap = len(terms & set(passage.split())) / len(terms)
+            scores.append(8 * overlap - 4 + random.uniform(-0.5, 0.5))
+        return scores
+
+
+def bench_rerank_cascade(num_queries=500, candidates=32, distinct_queries=100, top_k=4):
+    """Cross-encoder pairs per query: full reranking vs. first-stage cascade and score cache."""
+    from langchain_core.documents import Document
+    from rag.cache import TTLCache
+    from rag.rerank import BGEReranker
+
+    print("🎯 Rerank cascade")
+    print("=" * 50)
+
+    rng = random.Random(42)
+    vocab = [f"term{i}" for i in range(400)]
+    queries = [" ".join(rng.sample(vocab, 4)) for _ in range(distinct_queries)]
+    # Repeat questions retrieve the same chunks, in varying order
+    candidates_for = {}
+    for query in queries:
+        terms = query.split()
+        docs = []
+        for i in range(candidates):
+            words = rng.sample(terms, rng.randint(0, len(terms))) + rng.sample(vocab, 40)
+            rng.shuffle(words)
+            docs.append(Document(
+                page_content=" ".join(words),
+                metadata={"document_id": f"{query}:{i}", "chunk_index": i, "source_weight": rng.choice([0.9, 1.0, 1.1])},
+            ))
+        candidates_for[query] = docs
+    workload = []
+    for _ in range(num_queries):
+        query = rng.choice(queries)
+        workload.append((query, rng.sample(candidates_for[query], candidates)))
+
+    configs = [
+        ("Full (no cascade, no cache)", dict(cascade_top_m=0, early_exit_confidence=1.1, score_cache=None)),
+        ("Cascade", dict(score_cache=None)),
+        ("Cascade + score cache", dict(score_cache=TTLCache(maxsize=100_000))),
+    ]
+    baseline = None
+    for label, kwargs in configs:
+        reranker = BGEReranker(**kwargs)
+        reranker.cross_encoder = encoder = _CountingCrossEncoder()
+        agree = 0
+        t0 = time.perf_counter()
+        for query, docs in workload:
+            top = reranker.rerank_documents(query, docs, top_k=top_k, confidence_threshold=0.0)
+            ideal = sorted(docs, key=lambda d: -len(set(query.split()) & set(d.page_content.split())))[0]
+            agree += bool(top) and len(set(query.split()) & set(top[0]["document"].page_content.split())) == len(
+                set(query.split()) & set(ideal.page_content.split()))
+        elapsed = time.perf_counter() - t0
+        per_query = encoder.pairs / num_queries
+        baseline = baseline or per_query
+        print(f"  {label}:")
+        print(f"    Cross-encoder pairs/query: {per_query:.1f} ({baseline / max(per_query, 1e-9):.1f}x fewer than full)")
+        print(f"    Top-1 as relevant as the best candidate: {agree / num_queries:.1%}")
+        print(f"    Overhead: {elapsed / num_queries * 1e6:.0f}µs/query")
+    print()
+
+
+def bench_micro_batching(users=64, requests_per_user=20, api_latency_ms=40.0, api_slots=8):
+    """Embedding requests under concurrency: one API call per request vs. cross-request micro-batches."""
+    from concurrent.futures import ThreadPoolExecutor
+    from rag.batching import BATCH_WINDOW_MS, MicroBatcher
+
+    print(f"📦 Micro-batching ({users} concurrent users, {api_latency_ms:.0f}ms API calls, {api_slots} connections)")
+    print("=" * 50)
+
+    slots = threading.Semaphore(api_slots)
+    calls = []
+
+    def fake_api(_key, texts):
+        # Fixed per-call latency plus a little per text, over a bounded connection pool
+        with slots:
+            calls.append(len(texts))
+            time.sleep((api_latency_ms + 0.2 * len(texts)) / 1000)
+        return [[float(len(t))] for t in texts]
+
+    batcher = MicroBatcher("bench", fake_api, window_ms=BATCH_WINDOW_MS, max_batch=64, max_concurrent=api_slots)
+    modes = [
+        ("Per-request calls", lambda text: fake_api(None, [text])),
+        (f"Micro-batched ({BATCH_WINDOW_MS:g}ms window)", lambda text: batcher.run([text])),
+    ]
+    for label, embed in modes:
+        calls.clear()
+        latencies = []
+
+        def user(u):
+            for r in range(requests_per_user):
+                t = time.perf_counter_ns()
+                embed(f"user {u} question {r}")
+                latencies.append(time.perf_counter_ns() - t)
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=users) as pool:
+            list(pool.map(user, range(users)))
+        elapsed = time.perf_counter() - t0
+        total = users * requests_per_user
+        print(f"  {label}:")
+        print(f"    API calls: {len(calls)} for {total} requests (mean batch {total / len(calls):.1f})")
+        print(f"    Throughput: {total / elapsed:,.0f} requests/s")
+        print(f"    Latency p50: {_percentile(latencies, 0.50) / 1e6:.1f}ms, p99: {_percentile(latencies, 0.99) / 1e6:.1f}ms")
+    print()
+
+
+BENCHMARKS = {
+    "rate_limiter": bench_rate_limiter,
+    "shared_rate_limiter": bench_shared_rate_limiter,
+    "guardrails": bench_guardrails,
+    "telegram_webhook": bench_telegram_webhook,
+    "rerank_cascade": bench_rerank_cascade,
+    "micro_batching": bench_micro_batching,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run ({', '.join(BENCHMARKS)})")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,17 +1,26 @@
 # bot.py
 import os
 import sys
+import time
 import asyncio
+import threading
 import contextlib
+from collections import defaultdict
+from typing import Any, Awaitable, Dict, List, Optional
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from dotenv import load_dotenv
 from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import ApplicationBuilder, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.constants import ChatAction
-from generate.thread import generate_thread
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from generate.thread import generate_thread_result
 from rag.query import query_rag
+from rag.deadline import Deadline
+from rag.admission import AdmissionController, AdmissionRejected
+from rag.metrics import get_metrics
+from rag.guardrails import get_guardrails
 
 load_dotenv()
 
@@ -20,23 +29,302 @@ from observability import init_observability
 init_observability()
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Bot API server; override to run against a local fake server
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").rstrip("/")
 
 REQUEST_TIMEOUT_SECONDS = 60
 RETRY_ON_TIMEOUT = 1
+# How long to wait for a timed-out attempt to stop before retrying
+CANCEL_GRACE_SECONDS = 5
+
+# Updates handled at once across all chats; each chat is still handled in order
+BOT_MAX_CONCURRENT_UPDATES = int(os.getenv("BOT_MAX_CONCURRENT_UPDATES", "32"))
+# Updates a single user may have queued or running before new ones are turned away
+BOT_MAX_PENDING_PER_USER = int(os.getenv("BOT_MAX_PENDING_PER_USER", "3"))
+TYPING_INTERVAL_SECONDS = 4.5
+# Minimum gap between edits of a streaming answer (Telegram throttles frequent edits)
+BOT_STREAM_EDIT_INTERVAL = float(os.getenv("BOT_STREAM_EDIT_INTERVAL", "1.0"))
+# Telegram caps messages at 4096 UTF-16 units; stay below it for characters that count double
+TELEGRAM_MESSAGE_LIMIT = 4000
+
+# Dedicated pool for blocking pipeline work (BOT_ADMISSION_MAX_WORKERS, ...),
+# so bot traffic never competes for the event loop's default executor
+_pipeline_pool: Optional[AdmissionController] = None
+
+
+def _get_pipeline_pool() -> AdmissionController:
+    global _pipeline_pool
+    if _pipeline_pool is None:
+        _pipeline_pool = AdmissionController.from_env("bot", prefix="BOT_ADMISSION")
+    return _pipeline_pool
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates from different chats concurrently while keeping each chat's
+    updates in arrival order.
+
+    An update first waits for its chat's lock (asyncio locks are FIFO), and
+    only then takes one of the `max_concurrent_updates` slots, so a chat
+    with a backlog never holds slots other chats could use. Users with more
+    than `max_pending_per_user` updates queued or running get a short notice
+    instead of another place in the queue.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_per_user: int):
+        super().__init__(max_concurrent_updates)
+        self.max_pending_per_user = max_pending_per_user
+        self._chat_locks: Dict[Any, asyncio.Lock] = {}
+        self._chat_waiters: Dict[Any, int] = defaultdict(int)
+        self._pending_by_user: Dict[Any, int] = defaultdict(int)
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        user = getattr(update, "effective_user", None)
+        chat = getattr(update, "effective_chat", None)
+        user_key = user.id if user else None
+        chat_key = chat.id if chat else None
+
+        if user_key is not None and self._pending_by_user[user_key] >= self.max_pending_per_user:
+            coroutine.close()
+            get_metrics().inc("bot_updates_rejected", reason="user_pending_limit")
+            message = getattr(update, "effective_message", None)
+            if message is not None:
+                with contextlib.suppress(Exception):
+                    await message.reply_text("I'm still working on your previous messages. Please wait for those answers first.")
+            return
 
-
-async def _typing_loop(context: ContextTypes.DEFAULT_TYPE, chat_id: int, interval_seconds: float = 5.0):
-    try:
+        if user_key is not None:
+            self._pending_by_user[user_key] += 1
+        lock = self._chat_locks.get(chat_key)
+        if lock is None:
+            lock = self._chat_locks[chat_key] = asyncio.Lock()
+        self._chat_waiters[chat_key] += 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._chat_waiters[chat_key] -= 1
+            if not self._chat_waiters[chat_key]:
+                del self._chat_waiters[chat_key]
+                del self._chat_locks[chat_key]
+            if user_key is not None:
+                self._pending_by_user[user_key] -= 1
+                if not self._pending_by_user[user_key]:
+                    del self._pending_by_user[user_key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class TypingScheduler:
+    """
+    One background task that keeps the "typing..." indicator alive for every
+    chat with work in progress, instead of one sleep loop per request.
+    Requests in the same chat share a single indicator.
+    """
+
+    def __init__(self, interval_seconds: float = TYPING_INTERVAL_SECONDS):
+        self.interval_seconds = interval_seconds
+        self._active: Dict[int, int] = defaultdict(int)
+        self._bot = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _send(self, chat_id: int) -> None:
+        with contextlib.suppress(Exception):
+            await self._bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+
+    async def _run(self) -> None:
+        while self._active:
+            await asyncio.sleep(self.interval_seconds)
+            await asyncio.gather(*(self._send(chat_id) for chat_id in list(self._active)))
+        self._task = None
+
+    async def start(self, bot, chat_id: int) -> None:
+        """Show the typing indicator in `chat_id` until the matching `stop()`."""
+        self._bot = bot
+        self._active[chat_id] += 1
+        if self._active[chat_id] == 1:
+            await self._send(chat_id)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self, chat_id: int) -> None:
+        self._active[chat_id] -= 1
+        if not self._active[chat_id]:
+            del self._active[chat_id]
+
+
+_typing = TypingScheduler()
+
+
+def _split_pages(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """
+    Split text into Telegram-sized pages, preferring line then word breaks.
+    A page's cut depends only on text before it, so pages stay stable as a
+    streamed answer grows.
+    """
+    pages = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        pages.append(text[:cut])
+        text = text[cut:].lstrip("\n ")
+    pages.append(text)
+    return pages
+
+
+def _seconds(value) -> float:
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class StreamingReply:
+    """
+    Shows an answer in Telegram while it streams, by editing the placeholder
+    message at most every `interval_seconds`. Text beyond one message rolls
+    over into follow-up replies.
+
+    `feed()` is the pipeline's token callback and may be called from a
+    worker thread; chunks pass through the incremental guardrail sanitizer
+    before they are shown. `finish()` replaces the preview with the final
+    (batch-sanitized) text.
+    """
+
+    def __init__(self, placeholder, reply_to, interval_seconds: float = BOT_STREAM_EDIT_INTERVAL):
+        self.interval_seconds = interval_seconds
+        self._reply_to = reply_to
+        self._messages = [placeholder]
+        self._shown = [placeholder.text]
+        self._lock = threading.Lock()
+        self._text = ""
+        self._sanitizer = get_guardrails().streaming_sanitizer()
+        self._next_edit = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def feed(self, chunk: str) -> None:
+        """Token callback; safe to call from any thread."""
+        with self._lock:
+            self._text += self._sanitizer.feed(chunk)
+
+    async def _run(self) -> None:
         while True:
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(interval_seconds)
-    except asyncio.CancelledError:
-        return
-
-
-async def _run_blocking_with_timeout(func, *args, timeout_seconds: int = REQUEST_TIMEOUT_SECONDS):
-    loop = asyncio.get_running_loop()
-    return await asyncio.wait_for(loop.run_in_executor(None, lambda: func(*args)), timeout=timeout_seconds)
+            await asyncio.sleep(0.1)
+            with self._lock:
+                text = self._text
+            if text.strip() and time.monotonic() >= self._next_edit:
+                await self._render(text, final=False)
+
+    async def _stop(self) -> None:
+        if self._task is None:
+            return
+        try:
+            self._task.cancel()
+            # A preview edit that failed ended the task early; the final render still runs
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self._task
+        finally:
+            self._task = None
+
+    async def _render(self, text: str, final: bool) -> None:
+        pages = _split_pages(text)
+        if not final:
+            # Only the last page is still growing; don't send a follow-up for a fragment
+            pages = pages[:len(self._messages) + 1]
+        for i, page in enumerate(pages):
+            if i < len(self._shown) and self._shown[i] == page:
+                continue
+            for _attempt in range(3):
+                try:
+                    if i < len(self._messages):
+                        await self._messages[i].edit_text(page)
+                        self._shown[i] = page
+                    else:
+                        self._messages.append(await self._reply_to.reply_text(page))
+                        self._shown.append(page)
+                    break
+                except RetryAfter as exc:
+                    if not final:
+                        self._next_edit = time.monotonic() + _seconds(exc.retry_after)
+                        return
+                    await asyncio.sleep(_seconds(exc.retry_after))
+                except TelegramError as exc:
+                    if isinstance(exc, BadRequest) and "not modified" in str(exc).lower():
+                        break
+                    if final:
+                        raise
+                    # TimedOut, NetworkError, ...: skip this preview; the next one or the final render catches up
+                    print(f"Streaming preview edit failed: {exc}")
+                    self._next_edit = time.monotonic() + self.interval_seconds
+                    return
+        if final:
+            # A shorter final text leaves stale follow-up messages behind
+            for message in self._messages[len(pages):]:
+                with contextlib.suppress(Exception):
+                    await message.delete()
+            del self._messages[len(pages):]
+            del self._shown[len(pages):]
+        self._next_edit = time.monotonic() + self.interval_seconds
+
+    async def reset(self, status: str) -> None:
+        """Discard streamed text (e.g. before a retry) and show a status line."""
+        await self._stop()
+        with self._lock:
+            self._text = ""
+            self._sanitizer = get_guardrails().streaming_sanitizer()
+        await self._render(status, final=True)
+        self.start()
+
+    async def finish(self, text: str) -> None:
+        """Stop streaming and show the final text."""
+        await self._stop()
+        await self._render(text or "…", final=True)
+
+    async def finish_quietly(self) -> None:
+        """Stop streaming without touching the messages (idempotent)."""
+        await self._stop()
+
+
+async def _run_blocking_with_timeout(
+    func, *args, timeout_seconds: int = REQUEST_TIMEOUT_SECONDS, pool_client: str = "bot", **kwargs
+):
+    """
+    Run a blocking pipeline call under a request deadline.
+
+    `pool_client` picks the priority class on the pipeline pool ("bot" for
+    questions, "thread" for thread generation).
+
+    The deadline is passed to `func`, so when it fires the worker thread
+    stops at its next stage check and its in-flight OpenAI/Qdrant call is
+    cut off, instead of running to completion next to the retry.
+    """
+    deadline = Deadline(timeout_seconds)
+    future = asyncio.ensure_future(
+        _get_pipeline_pool().run(pool_client, lambda: func(*args, deadline=deadline, **kwargs))
+    )
+    try:
+        result, _timing = await asyncio.wait_for(asyncio.shield(future), timeout=timeout_seconds)
+    except asyncio.TimeoutError:
+        deadline.cancel()
+        # Let the abandoned attempt wind down before a retry starts another one
+        with contextlib.suppress(Exception):
+            await asyncio.wait_for(future, timeout=CANCEL_GRACE_SECONDS)
+        raise
+    error = result.get("error") if isinstance(result, dict) else getattr(result, "error", None)
+    if error == "timeout":
+        # The pipeline hit the deadline first and stopped on its own
+        raise asyncio.TimeoutError()
+    return result
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -79,23 +367,23 @@ async def thread_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     topic = " ".join(args)
-    normalized_topic = topic.lower().strip()
 
     loading_message = await update.message.reply_text("Generating thread. This may take up to a minute...")
-    typing_task = asyncio.create_task(_typing_loop(context, update.effective_chat.id))
+    chat_id = update.effective_chat.id
+    await _typing.start(context.bot, chat_id)
 
     try:
         attempt = 0
         last_error_text = None
         while True:
             try:
-                thread_content = await _run_blocking_with_timeout(generate_thread, topic, timeout_seconds=REQUEST_TIMEOUT_SECONDS)
-                sources_result = await _run_blocking_with_timeout(
-                    query_rag,
-                    normalized_topic,
+                result = await _run_blocking_with_timeout(
+                    generate_thread_result,
+                    topic,
                     user_id,
                     "telegram",
                     timeout_seconds=REQUEST_TIMEOUT_SECONDS,
+                    pool_client="thread",
                 )
                 break
             except asyncio.TimeoutError:
@@ -105,27 +393,26 @@ async def thread_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     continue
                 last_error_text = "Request timed out. Please try again later."
                 raise
+            except AdmissionRejected as exc:
+                last_error_text = f"The assistant is busy right now. Please try again in {max(1, int(exc.retry_after))} seconds."
+                raise
             except Exception as exc:
                 last_error_text = f"An error occurred: {str(exc)}"
                 raise
 
-        confidence = sources_result.get("confidence_score", 0.0) if isinstance(sources_result, dict) else 0.0
-        processing_time = sources_result.get("processing_time_ms", 0) if isinstance(sources_result, dict) else 0
-        sources = sources_result.get("sources", []) if isinstance(sources_result, dict) else []
+        if not result.success:
+            await loading_message.edit_text(result.thread)
+            return
 
         response_parts = []
         response_parts.append("Thread Generated\n")
-        response_parts.append(thread_content)
-        # Hide metadata in user-facing thread output
+        response_parts.append(result.thread)
+        # Hide metadata (sources, confidence) in user-facing thread output
 
         full_response = "".join(response_parts)
 
-        if len(full_response) > 4096:
-            await loading_message.edit_text("Response is long; sending in parts...")
-            await update.message.reply_text(thread_content)
-            # No metadata block
-        else:
-            await loading_message.edit_text(full_response)
+        # Long threads roll over into follow-up messages
+        await StreamingReply(loading_message, update.message).finish(full_response)
 
     except Exception as e:
         error_text = last_error_text or "An unexpected error occurred. Please try again."
@@ -135,9 +422,7 @@ async def thread_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(error_text)
         print(f"Error in thread_command: {str(e)}")
     finally:
-        typing_task.cancel()
-        with contextlib.suppress(Exception):
-            await typing_task
+        _typing.stop(chat_id)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -146,7 +431,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     normalized_input = (user_input or "").lower().strip()
 
     loading_message = await update.message.reply_text("Processing your request. This may take up to a minute...")
-    typing_task = asyncio.create_task(_typing_loop(context, update.effective_chat.id))
+    chat_id = update.effective_chat.id
+    await _typing.start(context.bot, chat_id)
+    # The answer appears as it is generated, edited in place about once a second
+    reply = StreamingReply(loading_message, update.message)
+    reply.start()
 
     try:
         attempt = 0
@@ -159,59 +448,89 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     user_id,
                     "telegram",
                     timeout_seconds=REQUEST_TIMEOUT_SECONDS,
+                    on_token=reply.feed,
                 )
                 break
             except asyncio.TimeoutError:
                 attempt += 1
                 if attempt <= RETRY_ON_TIMEOUT:
-                    await loading_message.edit_text("Request timed out. Retrying once...")
+                    await reply.reset("Request timed out. Retrying once...")
                     continue
                 last_error_text = "Request timed out. Please try again later."
                 raise
+            except AdmissionRejected as exc:
+                last_error_text = f"The assistant is busy right now. Please try again in {max(1, int(exc.retry_after))} seconds."
+                raise
             except Exception as exc:
                 last_error_text = f"An error occurred: {str(exc)}"
                 raise
 
         if not isinstance(result, dict) or not result.get("success", False):
             error_msg = (result or {}).get("response", "Unknown error occurred") if isinstance(result, dict) else "Unknown error occurred"
-            await loading_message.edit_text(error_msg)
+            await reply.finish(error_msg)
             return
 
         response_text = result.get("response", "")
-        # Hide confidence/sources in user-facing responses
-        full_response = response_text
-
-        if len(full_response) > 4096:
-            await loading_message.edit_text("Response is long; sending in parts...")
-            await update.message.reply_text(response_text)
-        else:
-            await loading_message.edit_text(full_response)
+        # Hide confidence/sources in user-facing responses; the final text
+        # replaces the streamed preview (it may differ, e.g. a clarifier)
+        await reply.finish(response_text)
 
     except Exception as e:
         error_text = last_error_text or "An unexpected error occurred. Please try again."
         try:
-            await loading_message.edit_text(error_text)
+            await reply.finish(error_text)
         except Exception:
             await update.message.reply_text(error_text)
         print(f"Error in handle_message: {str(e)}")
     finally:
-        typing_task.cancel()
-        with contextlib.suppress(Exception):
-            await typing_task
+        await reply.finish_quietly()
+        _typing.stop(chat_id)
+
+
+def build_application(updater: bool = True, pipeline_pool: Optional[AdmissionController] = None):
+    """
+    Build the Telegram application with handlers and the chat-ordered update processor.
+
+    Args:
+        updater: Include the polling updater; webhook mode feeds
+            `update_queue` directly and does not need one
+        pipeline_pool: Worker pool for pipeline calls, e.g. the web app's when
+            both run in one process; defaults to a bot-only pool
+    """
+    global _pipeline_pool
+    if pipeline_pool is not None:
+        _pipeline_pool = pipeline_pool
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(ChatOrderedUpdateProcessor(BOT_MAX_CONCURRENT_UPDATES, BOT_MAX_PENDING_PER_USER))
+    )
+    if TELEGRAM_API_BASE_URL:
+        # e.g. a local fake Bot API server for testing
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("thread", thread_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return app
 
 
 def main():
+    if os.getenv("TELEGRAM_WEBHOOK_URL", "").strip():
+        # The web app owns the bot through the webhook; polling would delete it
+        print("TELEGRAM_WEBHOOK_URL is set: the web app receives updates by webhook, not starting the polling bot.")
+        return
+
     max_retries = 5
     retry_count = 0
 
     while retry_count < max_retries:
         try:
-            app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-            app.add_handler(CommandHandler("start", start))
-            app.add_handler(CommandHandler("help", help_command))
-            app.add_handler(CommandHandler("thread", thread_command))
-            app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+            app = build_application()
 
             print("Telegram bot is running with guardrails...")
             print("Timeouts configured and auto-restart enabled")
@@ -0,0 +1,176 @@
+# generate/batch.py
+"""
+Generate many threads in one run.
+
+    python generate/batch.py topics.txt -o threads.jsonl --concurrency 4
+
+Input is a text file with one topic per line (blank lines and `#` comments
+skipped) or a JSONL file of {"topic": ..., "template": ..., "id": ...}.
+Results are appended to the output JSONL as each topic finishes, and that
+file is the checkpoint: re-running the same command skips topics that
+already succeeded and retries the rest.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from langchain_community.callbacks import get_openai_callback
+
+from generate.thread import generate_thread_result
+from rag.deadline import Deadline
+from rag.governor import BACKGROUND, get_governor, governor_lane
+from rag.query import normalize_question, retrieval_cache_stats
+
+
+def load_topics(path: str, template: Optional[str] = None) -> List[Dict]:
+    """Read topics from a .txt or .jsonl file into [{"id", "topic", "template"}]."""
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.endswith(".jsonl"):
+                record = json.loads(line)
+                topic = record["topic"]
+                item_template = record.get("template", template)
+                item_id = record.get("id")
+            else:
+                topic, item_template, item_id = line, template, None
+            items.append({
+                "id": str(item_id) if item_id is not None else f"{normalize_question(topic)}|{item_template or ''}",
+                "topic": topic,
+                "template": item_template,
+            })
+    return items
+
+
+def load_checkpoint(path: str) -> set:
+    """Ids that already succeeded in a previous run of the same output file."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Truncated last line from an interrupted run
+                continue
+            if record.get("success"):
+                done.add(record["id"])
+    return done
+
+
+def run_one(item: Dict, timeout: float) -> Dict:
+    """Generate one thread as background OpenAI traffic and report its usage."""
+    with governor_lane(BACKGROUND), get_openai_callback() as cb:
+        try:
+            result = generate_thread_result(
+                item["topic"],
+                user_id="batch",
+                client_type="batch",
+                template_name=item["template"],
+                deadline=Deadline(timeout),
+            )
+            record = {
+                "thread": result.thread,
+                "sources": result.sources,
+                "confidence_score": result.confidence_score,
+                "template": result.template,
+                "success": result.success,
+                "error": result.error,
+                "processing_time_ms": result.processing_time_ms,
+            }
+        except Exception as exc:
+            record = {"success": False, "error": f"{type(exc).__name__}: {exc}"}
+    return {
+        "id": item["id"],
+        "topic": item["topic"],
+        **record,
+        "prompt_tokens": cb.prompt_tokens,
+        "completion_tokens": cb.completion_tokens,
+        "total_tokens": cb.total_tokens,
+        "cost_usd": round(cb.total_cost, 6),
+    }
+
+
+def run_batch(
+    input_path: str,
+    output_path: str,
+    concurrency: int = 4,
+    template: Optional[str] = None,
+    timeout: float = 120.0,
+) -> Dict:
+    """
+    Generate threads for every topic in `input_path` not already done in `output_path`.
+
+    Returns:
+        Summary with counts, token usage, cost and throughput
+    """
+    items = load_topics(input_path, template)
+    done = load_checkpoint(output_path)
+    pending = [item for item in items if item["id"] not in done]
+    # Duplicate lines in the input are generated once
+    pending = list({item["id"]: item for item in pending}.values())
+    print(f"📋 {len(items)} topics, {len(items) - len(pending)} already done, {len(pending)} to generate")
+
+    summary = {"succeeded": 0, "failed": 0, "skipped": len(items) - len(pending),
+               "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cost_usd": 0.0}
+    write_lock = threading.Lock()
+    start = time.time()
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run_one, item, timeout) for item in pending]
+        for n, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            with write_lock:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+            summary["succeeded" if record["success"] else "failed"] += 1
+            for key in ("prompt_tokens", "completion_tokens", "total_tokens", "cost_usd"):
+                summary[key] += record[key]
+            status = "✅" if record["success"] else f"❌ {record.get('error')}"
+            print(f"[{n}/{len(pending)}] {status} {record['topic'][:60]}")
+
+    elapsed = time.time() - start
+    summary.update({
+        "elapsed_seconds": round(elapsed, 1),
+        "threads_per_minute": round(len(pending) / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "tokens_per_minute": round(summary["total_tokens"] / elapsed * 60) if elapsed > 0 else 0,
+        "cost_usd": round(summary["cost_usd"], 4),
+        **retrieval_cache_stats(),
+    })
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Generate threads for a list of topics.")
+    parser.add_argument("input", help="Topics file: .txt (one per line) or .jsonl")
+    parser.add_argument("-o", "--output", default="threads.jsonl", help="Results JSONL; also the resume checkpoint")
+    parser.add_argument("-c", "--concurrency", type=int, default=int(os.getenv("BATCH_CONCURRENCY", "4")))
+    parser.add_argument("--template", default=None, help="Template for topics that do not name one")
+    parser.add_argument("--rpm", type=int, default=None, help="OpenAI requests per minute (default OPENAI_RPM_LIMIT)")
+    parser.add_argument("--tpm", type=int, default=None, help="OpenAI tokens per minute (default OPENAI_TPM_LIMIT)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds allowed per topic")
+    args = parser.parse_args(argv)
+
+    governor = get_governor()
+    if args.rpm or args.tpm:
+        governor.set_limits(args.rpm or governor.rpm, args.tpm or governor.tpm)
+
+    summary = run_batch(args.input, args.output, args.concurrency, args.template, args.timeout)
+    print("\n📊 Batch summary")
+    for key, value in summary.items():
+        print(f"  {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
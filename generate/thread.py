@@ -1,28 +1,211 @@
 # generate/thread.py
 import os
+import re
 import sys
+import time
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from rag.query import query_rag
-from langchain_openai import ChatOpenAI
-
-def structure_thread_with_llm(context: str, template: str) -> str:
-    llm = ChatOpenAI(model="gpt-4o", temperature=0.4)
-    prompt = (
-        f"Given the following context, extract a compelling hook, a main body, and a call to action (CTA). "
-        f"Then fill the following template:\n\n"
-        f"Template:\n{template}\n\n"
-        f"Context:\n{context}\n\n"
-        f"Return ONLY the filled template."
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from rag.query import prepare_query, PreparedQuery
+from rag.deadline import Deadline, DeadlineExceeded, stage_timeout, LLM_TIMEOUT_SECONDS
+from rag.clients import get_chat_model
+from rag.guardrails import get_guardrails
+from rag.metadata_db import get_metadata_db
+
+THREAD_TEMPLATES_DIR = os.getenv("THREAD_TEMPLATES_DIR", "data/thread_templates")
+DEFAULT_THREAD_TEMPLATE = os.getenv("THREAD_TEMPLATE", "thread_template")
+THREAD_MODEL = os.getenv("THREAD_MODEL", "gpt-4o")
+# Retrieved chunks packed into the thread prompt
+THREAD_CONTEXT_DOCS = 6
+
+
+@dataclass(frozen=True)
+class ThreadTemplate:
+    """A parsed template from data/thread_templates."""
+    name: str
+    title: str
+    body: str  # the fill-in skeleton, e.g. "{{hook}}\n\n{{body}}\n\n{{cta}}"
+    guidance: str  # instructions and examples from the template's HTML comment
+    slots: Tuple[str, ...]
+
+
+@dataclass
+class ThreadResult:
+    """A generated thread together with the sources it was written from."""
+    thread: str
+    sources: List[Dict] = field(default_factory=list)
+    confidence_score: float = 0.0
+    template: str = DEFAULT_THREAD_TEMPLATE
+    success: bool = True
+    error: Optional[str] = None
+    processing_time_ms: int = 0
+
+
+def _parse_template(path: Path) -> ThreadTemplate:
+    text = path.read_text(encoding="utf-8")
+    guidance = "\n\n".join(part.strip() for part in re.findall(r"<!--(.*?)-->", text, flags=re.DOTALL))
+    body = re.sub(r"<!--.*?-->", "", text, flags=re.DOTALL)
+    title = path.stem.replace("_", " ")
+    lines = body.strip().splitlines()
+    if lines and lines[0].startswith("# "):
+        title = lines[0][2:].strip()
+        lines = lines[1:]
+    body = "\n".join(lines).strip()
+    slots = tuple(dict.fromkeys(re.findall(r"{{\s*(\w+)\s*}}", body)))
+    return ThreadTemplate(name=path.stem, title=title, body=body, guidance=guidance, slots=slots)
+
+
+@lru_cache(maxsize=None)
+def load_thread_templates(directory: str = THREAD_TEMPLATES_DIR) -> Dict[str, ThreadTemplate]:
+    """Parse every *.md template in `directory` once; keyed by file stem."""
+    return {path.stem: _parse_template(path) for path in sorted(Path(directory).glob("*.md"))}
+
+
+def get_thread_template(name: Optional[str] = None) -> ThreadTemplate:
+    """
+    Look up a template by name, falling back to the default and then to any template.
+
+    Raises:
+        FileNotFoundError: No templates exist
+    """
+    templates = load_thread_templates()
+    if not templates:
+        raise FileNotFoundError(f"No thread templates found in {THREAD_TEMPLATES_DIR}")
+    return templates.get(name or DEFAULT_THREAD_TEMPLATE) or next(iter(templates.values()))
+
+
+def build_thread_prompt(topic: str, template: ThreadTemplate, docs: List[Document], sources: List[Dict]) -> str:
+    """Pack template, guidance and retrieved context into one generation prompt."""
+    context = "\n\n".join(
+        f"[Source {i + 1}: {source.get('source', 'Unknown')}]\n{doc.page_content}"
+        for i, (doc, source) in enumerate(zip(docs, sources))
     )
-    response = llm.invoke(prompt)
-    return response.content.strip()
-
-def generate_thread(topic: str) -> str:
-    template = query_rag("thread template for a Twitter thread", k=1)
-    context = query_rag(topic)
-    thread_text = structure_thread_with_llm(context, template)
-    return thread_text
+    slots = ", ".join(template.slots) or "the template"
+    return f"""You write Twitter/X threads about LayerZero and omnichain technology.
+
+Write a thread about: {topic}
+
+Fill in {slots} in the template below. Base every claim on the context; do not invent figures.
+Keep each tweet under 280 characters. Return ONLY the filled template.
+
+Template guidance:
+{template.guidance}
+
+Template:
+{template.body}
+
+Context:
+{context}
+"""
+
+
+def generate_thread_result(
+    topic: str,
+    user_id: Optional[str] = None,
+    client_type: str = "web",
+    template_name: Optional[str] = None,
+    deadline: Optional[Deadline] = None,
+    on_progress: Optional[Callable[[str], None]] = None
+) -> ThreadResult:
+    """
+    Generate a thread with one retrieval pass and one LLM call.
+
+    Args:
+        topic: Thread topic
+        user_id: Optional user identifier (rate limits and analytics)
+        client_type: Type of client (web, telegram, etc.)
+        template_name: Template file stem; defaults to THREAD_TEMPLATE
+        deadline: Optional request deadline
+        on_progress: Optional callback, called with the stage name
+            ("retrieving", "generating") as each stage starts
+
+    Returns:
+        ThreadResult with the thread text and the sources it used. When the
+        topic is refused or nothing relevant is found, `success` is False
+        and `thread` holds the message to show instead.
+    """
+    start_time = time.time()
+    template = get_thread_template(template_name)
+
+    if on_progress:
+        on_progress("retrieving")
+    prepared = prepare_query(
+        topic,
+        user_id=user_id,
+        client_type=client_type,
+        k=THREAD_CONTEXT_DOCS,
+        deadline=deadline,
+        # Threads are written from whatever context was found; the Q&A confidence gate does not apply
+        gate_confidence=False,
+        # A stored Q&A answer is not context to write a thread from
+        use_precomputed=False,
+        use_shortcuts=False,
+    )
+    if not isinstance(prepared, PreparedQuery):
+        # Refused or nothing retrieved: there is no grounded context to write from
+        return ThreadResult(
+            thread=prepared.get("response", "Could not generate a thread for this topic."),
+            sources=prepared.get("sources", []),
+            template=template.name,
+            success=False,
+            error=prepared.get("error", "no_context"),
+            processing_time_ms=int((time.time() - start_time) * 1000),
+        )
+
+    prompt = build_thread_prompt(topic, template, prepared.context_docs, prepared.sources)
+    if on_progress:
+        on_progress("generating")
+    try:
+        timeout = stage_timeout(deadline, "thread_generation", LLM_TIMEOUT_SECONDS)
+        llm = get_chat_model(THREAD_MODEL, temperature=0.4, max_retries=0 if deadline is not None else 2)
+        response = llm.invoke(prompt, timeout=timeout)
+    except Exception as exc:
+        if not isinstance(exc, DeadlineExceeded) and not (deadline is not None and deadline.expired):
+            raise
+        return ThreadResult(
+            thread="The request took too long and was stopped. Please try again.",
+            template=template.name,
+            success=False,
+            error="timeout",
+            processing_time_ms=int((time.time() - start_time) * 1000),
+        )
+    thread_text = get_guardrails().sanitize_response(response.content.strip())
+
+    processing_time_ms = int((time.time() - start_time) * 1000)
+    metadata_db = get_metadata_db()
+    query_id = metadata_db.log_query(
+        query_text=topic,
+        user_id=user_id,
+        client_type=client_type,
+        confidence_score=prepared.confidence,
+        response_length=len(thread_text),
+        sources_used=prepared.sources,
+        processing_time_ms=processing_time_ms
+    )
+    metadata_db.log_tool_usage(
+        query_id=query_id,
+        tool_name="thread_generation",
+        tool_category="content_generation"
+    )
+
+    return ThreadResult(
+        thread=thread_text,
+        sources=prepared.sources,
+        confidence_score=prepared.confidence,
+        template=template.name,
+        processing_time_ms=processing_time_ms,
+    )
+
+
+def generate_thread(topic: str, deadline: Optional[Deadline] = None) -> str:
+    """Generate a thread and return only its text."""
+    return generate_thread_result(topic, deadline=deadline).thread
+
 
 if __name__ == "__main__":
     topic = input("Enter a topic: ")
@@ -0,0 +1,368 @@
+# rag/admission.py
+
+import os
+import time
+import asyncio
+import weakref
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Optional
+
+from rag.metrics import get_metrics
+
+
+class AdmissionRejected(Exception):
+    """Raised when a job is refused before doing any work."""
+
+    def __init__(self, reason: str, retry_after: float = 1.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+@dataclass
+class JobTiming:
+    """Where a job's time went: waiting for a worker vs. running."""
+    queue_wait_ms: int
+    service_time_ms: int
+
+
+@dataclass
+class PriorityClass:
+    """
+    Scheduling policy for one workload class.
+
+    `weight` sets its share when several classes are waiting, `floor` is
+    the number of workers it is served ahead of everyone else until it
+    holds them, `ceiling` caps its running jobs, and `max_queue_wait`
+    (None: the controller's default) drops jobs that waited too long.
+    """
+    name: str
+    weight: float
+    floor: int = 0
+    ceiling: Optional[int] = None
+    max_queue_wait: Optional[float] = None
+
+
+# Client types passed to `run()` and the class they are scheduled in
+CLIENT_PRIORITY_CLASSES = {
+    "web": "interactive_web",
+    "api": "interactive_web",
+    "bot": "interactive_bot",
+    "telegram": "interactive_bot",
+    "thread": "thread",
+    "batch": "batch",
+    "ingest": "batch",
+}
+
+
+def default_priority_classes(max_workers: int) -> Dict[str, PriorityClass]:
+    """Interactive questions first; thread and batch work capped to part of the pool and never dropped."""
+    return {
+        "interactive_web": PriorityClass("interactive_web", weight=8, floor=min(2, max_workers)),
+        "interactive_bot": PriorityClass("interactive_bot", weight=6, floor=min(1, max_workers)),
+        "thread": PriorityClass("thread", weight=2, ceiling=max(1, max_workers // 2), max_queue_wait=float("inf")),
+        "batch": PriorityClass("batch", weight=1, ceiling=max(1, max_workers // 4), max_queue_wait=float("inf")),
+    }
+
+
+# Every live controller, so load-based policies can read pool pressure
+_CONTROLLERS: "weakref.WeakSet[AdmissionController]" = weakref.WeakSet()
+
+
+def all_controllers():
+    """All live admission controllers in this process."""
+    return list(_CONTROLLERS)
+
+
+def _parse_limits(value: str) -> Dict[str, int]:
+    """Parse "web=8,api=4" into {"web": 8, "api": 4}."""
+    limits: Dict[str, int] = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, limit = item.split("=", 1)
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+def _parse_priority_classes(value: str, max_workers: int) -> Dict[str, PriorityClass]:
+    """
+    Override default classes from "thread=2:0:4,batch=1:0:1" (weight:floor:ceiling;
+    trailing fields may be left out, an empty ceiling means the whole pool).
+    """
+    classes = default_priority_classes(max_workers)
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        name, spec = item.split("=", 1)
+        name = name.strip()
+        fields = spec.split(":")
+        current = classes.get(name) or PriorityClass(name, weight=1)
+        current.weight = float(fields[0])
+        if len(fields) > 1 and fields[1]:
+            current.floor = int(fields[1])
+        if len(fields) > 2:
+            current.ceiling = int(fields[2]) if fields[2] else None
+        classes[name] = current
+    return classes
+
+
+@dataclass
+class _QueuedJob:
+    client_type: str
+    priority_class: str
+    func: Callable
+    args: tuple
+    kwargs: dict
+    future: Future
+    submitted: float
+
+
+class AdmissionController:
+    """
+    Bounded worker pool with admission control and priority scheduling for
+    blocking pipeline work.
+
+    At most `max_workers` jobs run at once and at most `max_queue` more may
+    wait for a worker; anything beyond that is rejected immediately with a
+    retry hint instead of piling up. Each client type can additionally be
+    capped to a number of admitted (queued + running) jobs, and a job that
+    waited longer than its class's queue wait limit is dropped before it
+    starts, since its caller has likely given up. Rejected or dropped jobs
+    never run, so they never reach OpenAI.
+
+    Waiting jobs are queued per priority class (see CLIENT_PRIORITY_CLASSES)
+    instead of first-come first-served. When a worker frees up it goes to a
+    class still below its floor, otherwise to the waiting class with the
+    highest `weight * (1 + oldest_wait / aging_seconds)` that is under its
+    ceiling. Ceilings keep a burst of thread generations from occupying the
+    workers that questions need; aging lets low-weight work through
+    eventually.
+    """
+
+    def __init__(
+        self,
+        name: str = "web",
+        max_workers: int = 8,
+        max_queue: int = 16,
+        client_limits: Optional[Dict[str, int]] = None,
+        max_queue_wait: float = 30.0,
+        priority_classes: Optional[Dict[str, PriorityClass]] = None,
+        aging_seconds: float = 10.0,
+    ):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.client_limits = client_limits or {}
+        self.max_queue_wait = max_queue_wait
+        self.priority_classes = priority_classes or default_priority_classes(max_workers)
+        self.aging_seconds = aging_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-worker")
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._running = 0
+        self._admitted_by_client: Dict[str, int] = {}
+        self._queues: Dict[str, Deque[_QueuedJob]] = {name: deque() for name in self.priority_classes}
+        self._running_by_class: Dict[str, int] = {name: 0 for name in self.priority_classes}
+        # EWMA of service time, used for Retry-After estimates
+        self._avg_service_seconds = 1.0
+        self._metrics = get_metrics()
+        _CONTROLLERS.add(self)
+
+    @classmethod
+    def from_env(cls, name: str = "web", prefix: str = "ADMISSION") -> "AdmissionController":
+        """
+        Build a controller from `<PREFIX>_MAX_WORKERS`, `_QUEUE_DEPTH`, `_CLIENT_LIMITS`,
+        `_MAX_QUEUE_WAIT`, `_PRIORITY_CLASSES` and `_AGING_SECONDS`.
+        """
+        max_workers = int(os.getenv(f"{prefix}_MAX_WORKERS", "8"))
+        return cls(
+            name=name,
+            max_workers=max_workers,
+            max_queue=int(os.getenv(f"{prefix}_QUEUE_DEPTH", "16")),
+            client_limits=_parse_limits(os.getenv(f"{prefix}_CLIENT_LIMITS", "thread=4")),
+            max_queue_wait=float(os.getenv(f"{prefix}_MAX_QUEUE_WAIT", "30")),
+            priority_classes=_parse_priority_classes(os.getenv(f"{prefix}_PRIORITY_CLASSES", ""), max_workers),
+            aging_seconds=float(os.getenv(f"{prefix}_AGING_SECONDS", "10")),
+        )
+
+    @property
+    def queued(self) -> int:
+        """Jobs admitted but not yet running."""
+        return self._admitted - self._running
+
+    @property
+    def load(self) -> float:
+        """Admitted jobs as a fraction of total capacity (workers + queue)."""
+        return self._admitted / max(1, self.max_workers + self.max_queue)
+
+    def _retry_after(self) -> float:
+        backlog = self._admitted - self.max_workers + 1
+        return max(1.0, backlog * self._avg_service_seconds / self.max_workers)
+
+    def _class_for(self, client_type: str) -> str:
+        name = CLIENT_PRIORITY_CLASSES.get(client_type, "interactive_web")
+        return name if name in self.priority_classes else next(iter(self.priority_classes))
+
+    def _admit(self, client_type: str) -> None:
+        with self._lock:
+            if self._admitted >= self.max_workers + self.max_queue:
+                raise AdmissionRejected("queue_full", self._retry_after())
+            limit = self.client_limits.get(client_type)
+            if limit is not None and self._admitted_by_client.get(client_type, 0) >= limit:
+                raise AdmissionRejected("client_limit", self._retry_after())
+            self._admitted += 1
+            self._admitted_by_client[client_type] = self._admitted_by_client.get(client_type, 0) + 1
+            self._publish_gauges()
+
+    def _release(self, client_type: str) -> None:
+        with self._lock:
+            self._admitted -= 1
+            self._admitted_by_client[client_type] -= 1
+            self._publish_gauges()
+
+    def _publish_gauges(self) -> None:
+        self._metrics.set_gauge("admission_admitted", self._admitted, pool=self.name)
+        self._metrics.set_gauge("admission_running", self._running, pool=self.name)
+
+    def _pick(self, now: float) -> Optional[_QueuedJob]:
+        """Next job to start, by floor, then aged weight; caller holds the lock."""
+        best, best_key = None, None
+        for name, queue in self._queues.items():
+            while queue and queue[0].future.cancelled():
+                queue.popleft()
+            if not queue:
+                continue
+            policy = self.priority_classes[name]
+            running = self._running_by_class[name]
+            if policy.ceiling is not None and running >= policy.ceiling:
+                continue
+            below_floor = running < policy.floor
+            aged_weight = policy.weight * (1.0 + (now - queue[0].submitted) / self.aging_seconds)
+            key = (below_floor, aged_weight)
+            if best_key is None or key > best_key:
+                best, best_key = name, key
+        return self._queues[best].popleft() if best is not None else None
+
+    def _dispatch(self) -> None:
+        """Start waiting jobs while workers are free; caller holds the lock."""
+        while self._running < self.max_workers:
+            job = self._pick(time.monotonic())
+            if job is None:
+                break
+            self._metrics.set_gauge("admission_queued", len(self._queues[job.priority_class]),
+                                    pool=self.name, priority_class=job.priority_class)
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            self._running += 1
+            self._running_by_class[job.priority_class] += 1
+            self._executor.submit(self._run_job, job)
+        self._publish_gauges()
+
+    def _run_job(self, job: _QueuedJob) -> None:
+        started = time.monotonic()
+        queue_wait = started - job.submitted
+        policy = self.priority_classes[job.priority_class]
+        max_queue_wait = self.max_queue_wait if policy.max_queue_wait is None else policy.max_queue_wait
+        try:
+            if queue_wait > max_queue_wait:
+                raise AdmissionRejected("queue_timeout", self._retry_after())
+            result = job.func(*job.args, **job.kwargs)
+            job.future.set_result((result, queue_wait, time.monotonic() - started))
+        except BaseException as exc:
+            job.future.set_exception(exc)
+        finally:
+            service = time.monotonic() - started
+            with self._lock:
+                self._running -= 1
+                self._running_by_class[job.priority_class] -= 1
+                self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * service
+                self._dispatch()
+
+    def submit(self, client_type: str, func: Callable, *args: Any, **kwargs: Any) -> Future:
+        """
+        Queue `func(*args, **kwargs)` if it can be admitted.
+
+        Returns:
+            Future resolving to (result, queue_wait_seconds, service_seconds);
+            cancelling it before the job starts removes the job from the queue
+
+        Raises:
+            AdmissionRejected: The job was refused and will not run
+        """
+        try:
+            self._admit(client_type)
+        except AdmissionRejected as exc:
+            self._metrics.inc("admission_rejected", pool=self.name, client_type=client_type, reason=exc.reason)
+            raise
+        priority_class = self._class_for(client_type)
+        job = _QueuedJob(client_type, priority_class, func, args, kwargs, Future(), time.monotonic())
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        with self._lock:
+            self._queues[priority_class].append(job)
+            self._metrics.set_gauge("admission_queued", len(self._queues[priority_class]),
+                                    pool=self.name, priority_class=priority_class)
+            self._dispatch()
+        return job.future
+
+    def _finish(self, job: _QueuedJob, future: Future) -> None:
+        self._release(job.client_type)
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if isinstance(exc, AdmissionRejected):
+            self._metrics.inc("admission_rejected", pool=self.name, client_type=job.client_type, reason=exc.reason)
+        elif exc is None:
+            _result, queue_wait, service = future.result()
+            labels = {"pool": self.name, "client_type": job.client_type, "priority_class": job.priority_class}
+            self._metrics.observe("admission_queue_wait_ms", int(queue_wait * 1000), **labels)
+            self._metrics.observe("admission_service_ms", int(service * 1000), **labels)
+
+    def call(self, client_type: str, func: Callable, *args: Any, **kwargs: Any):
+        """Blocking `run()` for worker threads outside the event loop. Returns (result, JobTiming)."""
+        result, queue_wait, service = self.submit(client_type, func, *args, **kwargs).result()
+        return result, JobTiming(int(queue_wait * 1000), int(service * 1000))
+
+    async def run(self, client_type: str, func: Callable, *args: Any, **kwargs: Any):
+        """
+        Run `func(*args, **kwargs)` on the pool if it can be admitted.
+
+        Args:
+            client_type: Client type used for per-client caps, scheduling and metrics
+            func: Blocking callable
+
+        Returns:
+            Tuple of (result, JobTiming)
+
+        Raises:
+            AdmissionRejected: The job was refused and did not run
+        """
+        future = self.submit(client_type, func, *args, **kwargs)
+        result, queue_wait, service = await asyncio.wrap_future(future)
+        return result, JobTiming(int(queue_wait * 1000), int(service * 1000))
+
+    def shutdown(self, wait: bool = False) -> None:
+        with self._lock:
+            waiting = [job for queue in self._queues.values() for job in queue]
+            for queue in self._queues.values():
+                queue.clear()
+        # Outside the lock: cancelling runs the jobs' done callbacks, which take it
+        for job in waiting:
+            job.future.cancel()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+# Global admission controller for the web app
+_admission_controller = None
+_admission_lock = threading.Lock()
+
+def get_admission_controller() -> AdmissionController:
+    """Get or create the web app's admission controller."""
+    global _admission_controller
+    if _admission_controller is None:
+        with _admission_lock:
+            if _admission_controller is None:
+                _admission_controller = AdmissionController.from_env("web")
+    return _admission_controller
@@ -0,0 +1,224 @@
+# rag/batching.py
+
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from rag.clients import get_embeddings, get_vectorstore
+from rag.deadline import DeadlineExceeded
+from rag.governor import current_lane, governor_lane
+from rag.metrics import get_metrics
+
+# Cross-request batching of query embeddings and Qdrant searches
+MICRO_BATCHING = os.getenv("MICRO_BATCHING", "true").strip().lower() in {"1", "true", "yes", "on"}
+# How long the first request of a batch waits for others to join
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "5"))
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", "64"))
+SEARCH_BATCH_MAX_SIZE = int(os.getenv("SEARCH_BATCH_MAX_SIZE", "32"))
+# Batches in flight at once; the collector keeps filling the next one meanwhile
+BATCH_MAX_CONCURRENT = int(os.getenv("BATCH_MAX_CONCURRENT", "4"))
+
+
+@dataclass
+class _BatchRequest:
+    items: List[Any]
+    key: Hashable
+    future: Future = field(default_factory=Future)
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+class MicroBatcher:
+    """
+    Packs items from concurrent callers into one call of `handler`.
+
+    A collector thread takes the first queued request, waits at most
+    `window_ms` (or until `max_batch` items) for more, then runs the handler
+    once per distinct key on a small pool and hands each caller its slice
+    of the results. Requests with different keys (e.g. OpenAI governor
+    lanes) never share a call.
+
+    `handler(key, items)` must return one result per item, in order.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Hashable, List[Any]], Sequence[Any]],
+        window_ms: float = BATCH_WINDOW_MS,
+        max_batch: int = 32,
+        max_concurrent: int = BATCH_MAX_CONCURRENT,
+    ):
+        self.name = name
+        self.handler = handler
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._requests: "queue.Queue[_BatchRequest]" = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix=f"{name}-batch")
+        threading.Thread(target=self._collect_loop, name=f"{name}-batcher", daemon=True).start()
+
+    def submit(self, items: List[Any], key: Hashable = None) -> Future:
+        """Queue items; the future resolves to their results, in order."""
+        request = _BatchRequest(list(items), key)
+        self._requests.put(request)
+        return request.future
+
+    def run(self, items: List[Any], key: Hashable = None, timeout: Optional[float] = None, stage: str = "batch") -> List[Any]:
+        """
+        Submit and wait for the results.
+
+        Raises:
+            DeadlineExceeded: No results within `timeout` seconds
+        """
+        future = self.submit(items, key)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise DeadlineExceeded(stage)
+
+    def _collect_loop(self) -> None:
+        while True:
+            batch = [self._requests.get()]
+            size = len(batch[0].items)
+            flush_at = time.monotonic() + self.window
+            while size < self.max_batch:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.items)
+            groups: Dict[Hashable, List[_BatchRequest]] = {}
+            for request in batch:
+                groups.setdefault(request.key, []).append(request)
+            for key, requests in groups.items():
+                self._pool.submit(self._run_batch, key, requests)
+
+    def _run_batch(self, key: Hashable, requests: List[_BatchRequest]) -> None:
+        # Callers that gave up (deadline) while the batch waited for a worker are left out
+        requests = [request for request in requests if request.future.set_running_or_notify_cancel()]
+        if not requests:
+            return
+        items = [item for request in requests for item in request.items]
+        now = time.monotonic()
+        metrics = get_metrics()
+        metrics.observe("batch_size", len(items), batcher=self.name)
+        metrics.observe("batch_requests", len(requests), batcher=self.name)
+        for request in requests:
+            metrics.observe("batch_wait_ms", (now - request.queued_at) * 1000, batcher=self.name)
+        try:
+            results = list(self.handler(key, items))
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name} batch returned {len(results)} results for {len(items)} items")
+        except Exception as exc:
+            for request in requests:
+                request.future.set_exception(exc)
+            return
+        offset = 0
+        for request in requests:
+            request.future.set_result(results[offset:offset + len(request.items)])
+            offset += len(request.items)
+
+
+def _embed_batch(lane: str, texts: List[str]) -> List[List[float]]:
+    # Each distinct text once, in the lane of the callers that queued them
+    unique = list(dict.fromkeys(texts))
+    with governor_lane(lane):
+        embedded = dict(zip(unique, get_embeddings().embed_documents(unique)))
+    return [embedded[text] for text in texts]
+
+
+def _search_batch(_key: Hashable, searches: List[Tuple[List[float], int, bool, int]]) -> List[list]:
+    from qdrant_client.http import models as rest
+
+    vectorstore = get_vectorstore()
+    requests = [
+        rest.SearchRequest(
+            vector=rest.NamedVector(name=vectorstore.vector_name, vector=embedding) if vectorstore.vector_name else embedding,
+            limit=limit,
+            with_payload=True,
+            with_vector=with_vectors,
+        )
+        for embedding, limit, with_vectors, _timeout in searches
+    ]
+    # Every caller also waits with its own timeout, so the longest one bounds the call
+    return vectorstore.client.search_batch(
+        collection_name=vectorstore.collection_name,
+        requests=requests,
+        timeout=max(search[3] for search in searches),
+    )
+
+
+# Global batchers
+_batchers: Dict[str, MicroBatcher] = {}
+_batchers_lock = threading.Lock()
+
+
+def _get_batcher(name: str, handler: Callable, max_batch: int) -> MicroBatcher:
+    batcher = _batchers.get(name)
+    if batcher is None:
+        with _batchers_lock:
+            batcher = _batchers.get(name)
+            if batcher is None:
+                batcher = _batchers[name] = MicroBatcher(name, handler, max_batch=max_batch)
+    return batcher
+
+
+def batched_embed(texts: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+    """
+    Embed texts together with those of concurrent requests in one
+    embed_documents call.
+
+    Raises:
+        DeadlineExceeded: No embeddings within `timeout` seconds
+    """
+    batcher = _get_batcher("embeddings", _embed_batch, EMBED_BATCH_MAX_SIZE)
+    return batcher.run(texts, key=current_lane(), timeout=timeout, stage="embedding")
+
+
+def batched_search(
+    embedding: List[float],
+    k: int,
+    use_mmr: bool = True,
+    fetch_k: int = 32,
+    lambda_mult: float = 0.5,
+    timeout: int = 10,
+) -> List[Tuple[Document, float]]:
+    """
+    Vector search sent with those of concurrent requests in one Qdrant
+    search_batch call; with `use_mmr`, the `fetch_k` candidates are then
+    reduced to `k` by maximal marginal relevance here, as the LangChain
+    vectorstore does.
+
+    Raises:
+        DeadlineExceeded: No results within `timeout` seconds
+    """
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+    vectorstore = get_vectorstore()
+    batcher = _get_batcher("search", _search_batch, SEARCH_BATCH_MAX_SIZE)
+    search = (embedding, fetch_k if use_mmr else k, use_mmr, timeout)
+    points = batcher.run([search], timeout=timeout, stage="retrieval")[0]
+    if use_mmr and points:
+        vectors = [p.vector.get(vectorstore.vector_name) if vectorstore.vector_name else p.vector for p in points]
+        selected = maximal_marginal_relevance(np.array(embedding), vectors, k=k, lambda_mult=lambda_mult)
+        points = [points[i] for i in selected]
+    return [
+        (
+            vectorstore._document_from_scored_point(
+                point, vectorstore.collection_name, vectorstore.content_payload_key, vectorstore.metadata_payload_key
+            ),
+            point.score,
+        )
+        for point in points
+    ]
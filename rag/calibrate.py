@@ -0,0 +1,118 @@
+# rag/calibrate.py
+"""
+Calibration report for the vector rescorer (rag/rescore.py).
+
+    python rag/calibrate.py replay.jsonl               # report the current calibration
+    python rag/calibrate.py replay.jsonl --fit         # fit Platt weights and save them
+    python rag/calibrate.py replay.jsonl --dump features.jsonl
+
+The replay set is JSONL. Each line is either a labeled question,
+
+    {"question": "What is a DVN?", "relevant": ["dvn.md", "<document_id>"]}
+
+which is retrieved live (Qdrant and OpenAI embeddings) and whose candidates
+are labeled relevant when their document_id/doc_id equals, or their source
+contains, one of the `relevant` entries; or an already extracted candidate,
+
+    {"features": {"similarity": 0.52, "agreement": 1.0, "glossary": 1.0, "source_weight": 1.0}, "label": 1}
+
+as written by --dump, so calibrations can be refit offline.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+from typing import List, Optional, Tuple
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from rag.rescore import (
+    FEATURES, RESCORE_CALIBRATION_PATH, apply_calibration,
+    calibration_report, feature_matrix, fit_calibration, load_calibration,
+)
+
+
+def _is_relevant(metadata: dict, relevant: List[str]) -> bool:
+    ids = {str(metadata.get("document_id", "")), str(metadata.get("doc_id", ""))}
+    source = str(metadata.get("source", "")).lower()
+    return any(r in ids or (r and r.lower() in source) for r in relevant)
+
+
+def load_replay(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Features and labels for every candidate in the replay set."""
+    rows, labels = [], []
+    retrieve = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "features" in record:
+                rows.append([float(record["features"][name]) for name in FEATURES])
+                labels.append(int(record["label"]))
+                continue
+            if retrieve is None:
+                # Live retrieval only when the replay set needs it
+                from rag.query import retrieve_candidates as retrieve
+            candidates = retrieve(record["question"])
+            if not candidates.docs:
+                continue
+            rows.extend(feature_matrix(candidates.docs, candidates.signals).tolist())
+            labels.extend(int(_is_relevant(d.metadata, record["relevant"])) for d in candidates.docs)
+    return np.asarray(rows, dtype=np.float64).reshape(-1, len(FEATURES)), np.asarray(labels, dtype=np.float64)
+
+
+def print_report(label: str, report: dict) -> None:
+    print(f"\n📊 {label}")
+    print(f"  Candidates: {report['candidates']} ({report['positives']} relevant)")
+    print(f"  Brier: {report['brier']}  Log loss: {report['log_loss']}  ECE: {report['ece']}  AUC: {report['auc']}")
+    print("  Reliability (predicted → observed):")
+    for row in report["reliability"]:
+        print(f"    {row['bin']}: {row['predicted']:.3f} → {row['observed']:.3f}  (n={row['count']})")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Calibration report for the vector rescorer.")
+    parser.add_argument("replay", help="Labeled replay set (JSONL)")
+    parser.add_argument("--fit", action="store_true", help="Fit Platt weights and save them to --out")
+    parser.add_argument("--out", default=RESCORE_CALIBRATION_PATH)
+    parser.add_argument("--holdout", type=float, default=0.3, help="Share of candidates kept out of the fit for the report")
+    parser.add_argument("--dump", help="Also write the extracted candidates as feature records to this JSONL")
+    args = parser.parse_args(argv)
+
+    features, labels = load_replay(args.replay)
+    if not len(labels):
+        print("❌ No candidates in the replay set")
+        return
+    if args.dump:
+        with open(args.dump, "w", encoding="utf-8") as f:
+            for row, label in zip(features, labels):
+                f.write(json.dumps({"features": dict(zip(FEATURES, row.tolist())), "label": int(label)}) + "\n")
+        print(f"💾 Wrote {len(labels)} candidates to {args.dump}")
+
+    current = load_calibration()
+    print_report(f"Current calibration ({current.source})", calibration_report(apply_calibration(features, current), labels))
+    if not args.fit:
+        return
+
+    index = list(range(len(labels)))
+    random.Random(0).shuffle(index)
+    cut = int(len(index) * (1 - args.holdout))
+    train, test = np.asarray(index[:cut]), np.asarray(index[cut:] or index)
+    fitted = fit_calibration(features[train], labels[train])
+    print_report("Current calibration, held-out", calibration_report(apply_calibration(features[test], current), labels[test]))
+    print_report("Fitted calibration, held-out", calibration_report(apply_calibration(features[test], fitted), labels[test]))
+
+    # Refit on everything for the saved weights
+    final = fit_calibration(features, labels)
+    final.save(args.out)
+    weights = ", ".join(f"{name}={w:.3f}" for name, w in zip(FEATURES, final.weights))
+    print(f"\n✅ Saved calibration to {args.out}: {weights}, bias={final.bias:.3f}")
+
+
+if __name__ == "__main__":
+    main()
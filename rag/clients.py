@@ -0,0 +1,155 @@
+# rag/clients.py
+
+import os
+import math
+import threading
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain_community.vectorstores.qdrant import Qdrant
+from qdrant_client import QdrantClient
+
+from rag.deadline import RETRIEVAL_TIMEOUT_SECONDS
+from rag.governor import estimate_tokens, get_governor
+
+load_dotenv()
+
+QDRANT_URL = os.getenv("QDRANT_URL")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+QDRANT_COLLECTION_NAME = os.getenv("QDRANT_COLLECTION_NAME", "layerzero-rag")
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSIONS = 3072
+# Completion tokens charged up front when a call sets no max_tokens
+COMPLETION_TOKENS_ESTIMATE = int(os.getenv("COMPLETION_TOKENS_ESTIMATE", "700"))
+
+
+class GovernedOpenAIEmbeddings(OpenAIEmbeddings):
+    """
+    OpenAIEmbeddings that charges the embeddings budget (rag/governor.py)
+    before each request. Texts are sent in `chunk_size` slices, one request
+    each, so a large ingest is paced slice by slice. `lane` pins the
+    governor lane; by default the caller's current lane is used.
+    """
+
+    lane: Optional[str] = None
+
+    def embed_documents(self, texts: List[str], chunk_size: Optional[int] = 0) -> List[List[float]]:
+        governor = get_governor("embeddings")
+        step = chunk_size or self.chunk_size
+        embeddings: List[List[float]] = []
+        for i in range(0, len(texts), step):
+            batch = texts[i:i + step]
+            governor.acquire(sum(estimate_tokens(text) for text in batch), lane=self.lane)
+            embeddings.extend(super().embed_documents(batch))
+        return embeddings
+
+
+class GovernedChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI that charges the chat budget (rag/governor.py) before each
+    call and settles it from the usage the response reports. Streamed
+    responses carry no usage, so they are settled from the streamed text.
+    """
+
+    def _estimate(self, messages: List[BaseMessage]) -> int:
+        prompt = sum(estimate_tokens(str(message.content)) for message in messages)
+        return prompt + (self.max_tokens or COMPLETION_TOKENS_ESTIMATE)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        stream: Optional[bool] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if stream if stream is not None else self.streaming:
+            # Charged in _stream
+            return super()._generate(messages, stop=stop, run_manager=run_manager, stream=stream, **kwargs)
+        governor = get_governor("chat")
+        estimate = self._estimate(messages)
+        governor.acquire(estimate, timeout=kwargs.get("timeout"))
+        result = super()._generate(messages, stop=stop, run_manager=run_manager, stream=stream, **kwargs)
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        governor.record_usage(estimate, usage.get("total_tokens") or estimate)
+        return result
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        governor = get_governor("chat")
+        estimate = self._estimate(messages)
+        governor.acquire(estimate, timeout=kwargs.get("timeout"))
+        streamed = []
+        try:
+            for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                streamed.append(chunk.text)
+                yield chunk
+        finally:
+            prompt = estimate - (self.max_tokens or COMPLETION_TOKENS_ESTIMATE)
+            governor.record_usage(estimate, prompt + estimate_tokens("".join(streamed)))
+
+# One instance of each client per process. The web app and the Telegram bot
+# share these when they run in the same process, so connection pools and the
+# vectorstore are built once instead of once per client or per call.
+_clients: Dict[Hashable, Any] = {}
+_clients_lock = threading.Lock()
+
+
+def _get_or_create(key: Hashable, factory: Callable[[], Any]) -> Any:
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = factory()
+    return client
+
+
+def get_embeddings() -> OpenAIEmbeddings:
+    """Query-time embeddings client; calls are capped at the retrieval stage budget."""
+    return _get_or_create("embeddings", lambda: GovernedOpenAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        dimensions=EMBEDDING_DIMENSIONS,
+        request_timeout=RETRIEVAL_TIMEOUT_SECONDS,
+        max_retries=1,
+    ))
+
+
+def get_qdrant_client() -> QdrantClient:
+    """Shared Qdrant client; per-request deadlines are applied per search."""
+    return _get_or_create("qdrant", lambda: QdrantClient(
+        url=QDRANT_URL,
+        api_key=QDRANT_API_KEY,
+        timeout=int(math.ceil(RETRIEVAL_TIMEOUT_SECONDS)),
+    ))
+
+
+def get_vectorstore() -> Qdrant:
+    """Shared LangChain vectorstore over the configured collection."""
+    return _get_or_create("vectorstore", lambda: Qdrant(
+        client=get_qdrant_client(),
+        collection_name=QDRANT_COLLECTION_NAME,
+        embeddings=get_embeddings(),
+    ))
+
+
+def get_chat_model(model: str, temperature: float = 0.0, max_retries: int = 2) -> ChatOpenAI:
+    """
+    Shared chat model for a (model, temperature, max_retries) combination.
+
+    Per-call timeouts are passed at invoke time (`llm.invoke(prompt, timeout=...)`),
+    so one instance serves requests with different deadlines; the timeout also
+    bounds how long the call may wait for the OpenAI budget.
+    """
+    return _get_or_create(
+        ("chat", model, temperature, max_retries),
+        lambda: GovernedChatOpenAI(model=model, temperature=temperature, max_retries=max_retries),
+    )
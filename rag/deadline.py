@@ -0,0 +1,89 @@
+# rag/deadline.py
+
+import os
+import time
+import threading
+from typing import Callable, Optional
+
+
+# Per-stage caps; a stage never gets more than the request has left
+RETRIEVAL_TIMEOUT_SECONDS = float(os.getenv("RETRIEVAL_TIMEOUT_SECONDS", "10"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "45"))
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request ran out of time or was cancelled by its caller."""
+
+    def __init__(self, stage: str, cancelled: bool = False):
+        super().__init__(f"{'cancelled' if cancelled else 'deadline exceeded'} at {stage}")
+        self.stage = stage
+        self.cancelled = cancelled
+
+
+class Deadline:
+    """
+    Time budget for one request, shared by every stage that works on it.
+
+    Stages call `check()` before starting work and size their client
+    timeouts with `stage_timeout()`, so an abandoned request stops at the
+    next stage boundary and an in-flight OpenAI/Qdrant call is cut off when
+    the budget runs out instead of holding a worker thread and spending
+    tokens nobody will read. `cancel()` lets the caller abandon the request
+    early (e.g. after its own timeout fired).
+    """
+
+    def __init__(self, timeout_seconds: float, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self.expires_at = clock() + timeout_seconds
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> float:
+        """Seconds left, never negative."""
+        return max(0.0, self.expires_at - self._clock())
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.cancelled or self._clock() >= self.expires_at
+
+    def cancel(self) -> None:
+        """Abandon the request; running stages stop at their next check."""
+        self._cancelled.set()
+
+    def check(self, stage: str) -> None:
+        """
+        Raise if the request should not do any more work.
+
+        Raises:
+            DeadlineExceeded: The deadline passed or the request was cancelled
+        """
+        if self.cancelled:
+            raise DeadlineExceeded(stage, cancelled=True)
+        if self._clock() >= self.expires_at:
+            raise DeadlineExceeded(stage)
+
+    def stage_timeout(self, stage: str, stage_max: float) -> float:
+        """
+        Client timeout for a stage: the stage cap or what is left, whichever is smaller.
+
+        Raises:
+            DeadlineExceeded: No time is left for the stage
+        """
+        self.check(stage)
+        return min(stage_max, self.remaining())
+
+
+def stage_timeout(deadline: Optional[Deadline], stage: str, stage_max: float) -> float:
+    """`deadline.stage_timeout(...)`, or the stage cap when there is no deadline."""
+    if deadline is None:
+        return stage_max
+    return deadline.stage_timeout(stage, stage_max)
+
+
+def check_deadline(deadline: Optional[Deadline], stage: str) -> None:
+    """`deadline.check(stage)` when a deadline is set."""
+    if deadline is not None:
+        deadline.check(stage)
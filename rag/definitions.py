@@ -0,0 +1,177 @@
+# rag/definitions.py
+
+import os
+import re
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from rag.utils.glossary import GLOSSARY_DOC_PATH, get_glossary, load_glossary_definitions
+
+# Pre-rendered glossary answers, written by rag/ingest.py
+DEFINITIONS_PATH = os.getenv("DEFINITIONS_PATH", "data/definitions.json")
+
+# Spend estimate for an answer the fast path did not generate: USD per 1M
+# (input, output) tokens, ~4 characters per token
+LLM_PRICES_PER_1M = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+ESTIMATED_PROMPT_CHARS = int(os.getenv("ESTIMATED_PROMPT_CHARS", "8000"))
+ESTIMATED_ANSWER_TOKENS = int(os.getenv("ESTIMATED_ANSWER_TOKENS", "300"))
+
+# "What is a DVN?", "what's lzRead", "define OFT", "What does ULN stand for?"
+_DEFINITIONAL_PATTERNS = (
+    re.compile(r"^(?:what\s+(?:is|are)|what'?s|define|definition\s+of|meaning\s+of|explain)\s+(?P<term>.+)$"),
+    re.compile(r"^what\s+(?:does|do)\s+(?P<term>.+?)\s+(?:mean|stand\s+for)$"),
+    re.compile(r"^(?P<term>.+?)\s+(?:meaning|definition)$"),
+)
+_ARTICLE_RE = re.compile(r"^(?:an?|the)\s+")
+_CONTEXT_SUFFIX_RE = re.compile(r"\s+(?:in|on|for)\s+(?:layerzero|layer\s+zero|lz)(?:\s+v2)?$")
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.strip().lower().split())
+
+
+def definitional_term(question: str) -> Optional[str]:
+    """
+    The term a single-term definitional question asks about ("What is a
+    DVN in LayerZero?" -> "dvn"), or None when the question has another shape.
+    """
+    text = _normalize(question.replace("`", "").replace('"', ""))
+    text = text.rstrip("?.! ")
+    for pattern in _DEFINITIONAL_PATTERNS:
+        m = pattern.match(text)
+        if m:
+            term = _CONTEXT_SUFFIX_RE.sub("", _ARTICLE_RE.sub("", m.group("term").strip()))
+            return term or None
+    return None
+
+
+def render_definition(term: str, definition: str) -> str:
+    return f"{term}: {definition}"
+
+
+def build_definitions(path: str = GLOSSARY_DOC_PATH, document_id: Optional[str] = None) -> Dict:
+    """
+    Render an answer for every glossary entry and index it under each of
+    the entry's names and their synonyms from rag/utils/glossary.py.
+
+    Args:
+        path: Glossary document
+        document_id: The glossary's document_id in the collection, for the citation
+    """
+    source = os.path.basename(path)
+    entries: List[Dict] = []
+    terms: Dict[str, int] = {}
+    for definition in load_glossary_definitions(path):
+        index = len(entries)
+        entries.append({
+            "term": definition.term,
+            "response": render_definition(definition.term, definition.definition),
+            "sources": [{
+                "source": source,
+                "source_type": "text",
+                "doc_id": document_id or "glossary",
+                "section": definition.term,
+                "confidence": 1.0,
+                "rank": 1,
+            }],
+        })
+        for name in definition.names:
+            terms.setdefault(name, index)
+
+    # Synonym groups reach an entry through any member that names it
+    for canonical, synonyms in get_glossary().items():
+        group = {_normalize(t) for t in (canonical, *synonyms)}
+        index = next((terms[t] for t in sorted(group) if t in terms), None)
+        if index is not None:
+            for t in group:
+                terms.setdefault(t, index)
+    return {"terms": terms, "entries": entries}
+
+
+class DefinitionStore:
+    """Pre-rendered glossary answers keyed by normalized term."""
+
+    def __init__(self, data: Dict):
+        self.terms: Dict[str, int] = data["terms"]
+        self.entries: List[Dict] = data["entries"]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, term: str) -> Optional[Dict]:
+        """The entry for a term, trying its singular for plurals ("dvns", "oapps")."""
+        term = _normalize(term)
+        for candidate in (term, term[:-1] if term.endswith("s") else None):
+            if candidate and candidate in self.terms:
+                return self.entries[self.terms[candidate]]
+        return None
+
+    def answer(self, question: str) -> Tuple[Optional[Dict], Optional[str]]:
+        """
+        The entry answering a single-term definitional question, and the term
+        asked about (None when the question is not definitional).
+        """
+        term = definitional_term(question)
+        if term is None:
+            return None, None
+        return self.lookup(term), term
+
+
+def save_definitions(data: Dict, path: str = DEFINITIONS_PATH) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def build_definition_store(path: str = GLOSSARY_DOC_PATH, document_id: Optional[str] = None) -> DefinitionStore:
+    """Build and save the definition store; called by rag/ingest.py."""
+    data = build_definitions(path, document_id)
+    save_definitions(data)
+    return DefinitionStore(data)
+
+
+# Loaded store with the mtime of its file (None: built from the glossary document)
+_store: Optional[Tuple[Optional[float], DefinitionStore]] = None
+_store_lock = threading.Lock()
+
+
+def get_definition_store() -> DefinitionStore:
+    """
+    The saved definition store, reloaded when ingest rewrites it. Before the
+    first ingest, the store is built in memory from the glossary document.
+    """
+    global _store
+    try:
+        mtime: Optional[float] = os.path.getmtime(DEFINITIONS_PATH)
+    except OSError:
+        mtime = None
+    cached = _store
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with _store_lock:
+        if _store is None or _store[0] != mtime:
+            store = None
+            if mtime is not None:
+                try:
+                    with open(DEFINITIONS_PATH, encoding="utf-8") as f:
+                        store = DefinitionStore(json.load(f))
+                except (OSError, ValueError, KeyError) as exc:
+                    print(f"⚠️ Could not load definitions {DEFINITIONS_PATH}: {exc}")
+            _store = (mtime, store if store is not None else DefinitionStore(build_definitions()))
+        return _store[1]
+
+
+def estimated_llm_cost(model: Optional[str], prompt_chars: Optional[int] = None) -> float:
+    """Rough USD cost of one answer from `model`; 0 for models without a price."""
+    prices = LLM_PRICES_PER_1M.get(model or "")
+    if prices is None:
+        return 0.0
+    prompt_chars = ESTIMATED_PROMPT_CHARS if prompt_chars is None else min(prompt_chars, ESTIMATED_PROMPT_CHARS)
+    input_price, output_price = prices
+    # Instructions and the question add ~1000 characters to the context
+    return ((prompt_chars + 1000) / 4 * input_price + ESTIMATED_ANSWER_TOKENS * output_price) / 1_000_000
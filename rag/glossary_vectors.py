@@ -0,0 +1,194 @@
+# rag/glossary_vectors.py
+"""
+Glossary term embeddings for composing query-variant embeddings.
+
+The glossary query variants are the question with glossary terms appended,
+so instead of embedding each one through the API, retrieval composes it
+from the question's embedding and precomputed term embeddings.
+
+    python rag/glossary_vectors.py build
+    python rag/glossary_vectors.py evaluate [questions.txt] --k 8 --alphas 0.6,0.7,0.8
+
+`evaluate` embeds the real variants and reports, per alpha, their cosine
+similarity to the composed ones and the overlap of their Qdrant top-k.
+"""
+import os
+import sys
+import hashlib
+import argparse
+import threading
+from typing import Dict, List, Optional, Sequence
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from rag.clients import EMBEDDING_MODEL, get_embeddings
+from rag.utils.glossary import get_glossary
+
+GLOSSARY_VECTORS_PATH = os.getenv("GLOSSARY_VECTORS_PATH", "data/glossary_vectors.npz")
+# Weight of the question in a composed variant; the glossary terms share the rest
+GLOSSARY_VARIANT_ALPHA = float(os.getenv("GLOSSARY_VARIANT_ALPHA", "0.7"))
+
+
+def _normalize_term(term: str) -> str:
+    return " ".join(str(term).lower().split())
+
+
+def glossary_terms() -> List[str]:
+    """Every canonical term and synonym in the glossary, once each."""
+    terms: Dict[str, str] = {}
+    for canonical, synonyms in get_glossary().items():
+        for term in (canonical, *synonyms):
+            terms.setdefault(_normalize_term(term), term)
+    return sorted(terms.values(), key=_normalize_term)
+
+
+def _fingerprint(terms: Sequence[str]) -> str:
+    """Changes with the glossary or the embedding model, invalidating the stored matrix."""
+    return hashlib.sha1("\n".join([EMBEDDING_MODEL, *terms]).encode("utf-8")).hexdigest()[:16]
+
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class GlossaryVectors:
+    """Unit-norm term embeddings (float16 on disk) with lookup by normalized term."""
+
+    def __init__(self, terms: List[str], matrix: np.ndarray, fingerprint: str):
+        self.terms = terms
+        self.matrix = matrix
+        self.fingerprint = fingerprint
+        self.index = {_normalize_term(t): i for i, t in enumerate(terms)}
+
+    def covers(self, terms: Sequence[str]) -> bool:
+        return bool(terms) and all(_normalize_term(t) in self.index for t in terms)
+
+    def compose(self, base_embedding: Sequence[float], terms: Sequence[str], alpha: float = GLOSSARY_VARIANT_ALPHA) -> List[float]:
+        """
+        Approximate the embedding of "<question> <terms>": the normalized
+        weighted sum of the question's embedding and the mean of the term
+        embeddings.
+
+        Raises:
+            KeyError: A term has no stored embedding (check `covers` first)
+        """
+        rows = self.matrix[[self.index[_normalize_term(t)] for t in terms]].astype(np.float32)
+        base = _unit(np.asarray(base_embedding, dtype=np.float32))
+        return _unit(alpha * base + (1.0 - alpha) * _unit(rows.mean(axis=0))).tolist()
+
+    def save(self, path: str = GLOSSARY_VECTORS_PATH) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(path, terms=np.asarray(self.terms), matrix=self.matrix, fingerprint=np.asarray(self.fingerprint))
+
+    @classmethod
+    def load(cls, path: str = GLOSSARY_VECTORS_PATH) -> "GlossaryVectors":
+        with np.load(path) as data:
+            return cls([str(t) for t in data["terms"]], data["matrix"], str(data["fingerprint"]))
+
+
+def build_glossary_vectors(path: str = GLOSSARY_VECTORS_PATH) -> GlossaryVectors:
+    """Embed every glossary term in one request and save the matrix."""
+    terms = glossary_terms()
+    matrix = _unit(np.asarray(get_embeddings().embed_documents(terms), dtype=np.float32)).astype(np.float16)
+    vectors = GlossaryVectors(terms, matrix, _fingerprint(terms))
+    vectors.save(path)
+    return vectors
+
+
+# Global instance; None until built or loaded for the current glossary
+_vectors: Optional[GlossaryVectors] = None
+_vectors_lock = threading.Lock()
+
+
+def get_glossary_vectors(build: bool = False) -> Optional[GlossaryVectors]:
+    """
+    The stored term embeddings for the current glossary, or None when they
+    are missing or stale. With `build`, missing or stale ones are rebuilt
+    (one embeddings request), e.g. at startup.
+    """
+    global _vectors
+    if _vectors is not None:
+        return _vectors
+    with _vectors_lock:
+        if _vectors is None:
+            fingerprint = _fingerprint(glossary_terms())
+            try:
+                loaded = GlossaryVectors.load()
+                if loaded.fingerprint == fingerprint:
+                    _vectors = loaded
+            except (OSError, KeyError, ValueError):
+                pass
+            if _vectors is None and build:
+                _vectors = build_glossary_vectors()
+    return _vectors
+
+
+def evaluate(questions: List[str], k: int = 8, alphas: Sequence[float] = (0.6, 0.7, 0.8)) -> None:
+    """Compare composed and real variant embeddings: cosine and Qdrant top-k overlap."""
+    from rag.clients import get_vectorstore
+    from rag.query import build_query_variants
+
+    vectors = get_glossary_vectors(build=True)
+    embeddings = get_embeddings()
+    vectorstore = get_vectorstore()
+
+    def top_ids(embedding: List[float]) -> set:
+        hits = vectorstore.similarity_search_by_vector(embedding, k=k)
+        return {(d.metadata.get("document_id"), d.metadata.get("chunk_index")) for d in hits}
+
+    # Real variants of the questions with glossary terms
+    pairs = []
+    for question in questions:
+        variants = [(text, terms) for text, terms in build_query_variants(question) if terms and vectors.covers(terms)]
+        if variants:
+            pairs.append((question.strip(), variants))
+    if not pairs:
+        print("❌ None of the questions produce glossary variants")
+        return
+    print(f"🔬 {sum(len(v) for _, v in pairs)} glossary variants from {len(pairs)} questions, top-{k}")
+
+    results: Dict[float, Dict[str, List[float]]] = {a: {"cosine": [], "overlap": []} for a in (1.0, *alphas)}
+    for question, variants in pairs:
+        texts = [question] + [text for text, _ in variants]
+        real = embeddings.embed_documents(texts)
+        base = real[0]
+        for (text, terms), true_embedding in zip(variants, real[1:]):
+            true_unit = _unit(np.asarray(true_embedding, dtype=np.float32))
+            true_top = top_ids(true_embedding)
+            for alpha in results:
+                composed = vectors.compose(base, terms, alpha)
+                results[alpha]["cosine"].append(float(true_unit @ np.asarray(composed, dtype=np.float32)))
+                results[alpha]["overlap"].append(len(true_top & top_ids(composed)) / max(len(true_top), 1))
+
+    for alpha, scores in results.items():
+        label = "question only" if alpha == 1.0 else f"alpha={alpha:.2f}"
+        print(f"  {label}: cosine {np.mean(scores['cosine']):.3f}, top-{k} overlap {np.mean(scores['overlap']):.1%}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Glossary term embeddings for composed query variants.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", help="Embed the glossary terms and save the matrix")
+    evaluation = commands.add_parser("evaluate", help="Compare composed and real variant embeddings")
+    evaluation.add_argument("questions", nargs="?", help="Questions file, one per line (default: one per glossary term)")
+    evaluation.add_argument("--k", type=int, default=8)
+    evaluation.add_argument("--alphas", default="0.6,0.7,0.8")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        vectors = build_glossary_vectors()
+        print(f"✅ Embedded {len(vectors.terms)} glossary terms to {GLOSSARY_VECTORS_PATH}")
+        return
+    if args.questions:
+        with open(args.questions, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    else:
+        questions = [f"What is {term}?" for term in glossary_terms()]
+    evaluate(questions, k=args.k, alphas=[float(a) for a in args.alphas.split(",")])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+# rag/governor.py
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Tuple
+
+from rag.metrics import get_metrics
+
+logger = logging.getLogger("governor")
+
+# Organization limits for OpenAI; set them a little under the real quota.
+# Chat and embedding models are limited separately, so each has its own budget.
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "30000"))
+OPENAI_EMBEDDING_RPM_LIMIT = int(os.getenv("OPENAI_EMBEDDING_RPM_LIMIT", "3000"))
+OPENAI_EMBEDDING_TPM_LIMIT = int(os.getenv("OPENAI_EMBEDDING_TPM_LIMIT", "1000000"))
+# Share of each budget that background work may not use, kept for interactive traffic
+GOVERNOR_INTERACTIVE_RESERVE = float(os.getenv("GOVERNOR_INTERACTIVE_RESERVE", "0.2"))
+# `sqlite` shares the buckets between every local process (web app, bot, batch and
+# precompute runs) through GOVERNOR_DB_PATH; `memory` gives each process the full budget
+GOVERNOR_BACKEND = os.getenv("GOVERNOR_BACKEND", "sqlite").strip().lower()
+GOVERNOR_DB_PATH = os.getenv("GOVERNOR_DB_PATH", "data/governor.db")
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Lane of the OpenAI calls made by the current thread or task
+_lane: ContextVar[str] = ContextVar("openai_lane", default=INTERACTIVE)
+
+
+def current_lane() -> str:
+    return _lane.get()
+
+
+@contextmanager
+def governor_lane(lane: str):
+    """Run the enclosed OpenAI calls in `lane` (INTERACTIVE or BACKGROUND)."""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+class RateGovernor:
+    """
+    Client-side requests-per-minute and tokens-per-minute budget for OpenAI.
+
+    Two token buckets refill continuously at `rpm / 60` and `tpm / 60` per
+    second and hold at most a minute's worth, so short bursts pass and
+    sustained load settles at the quota. `acquire()` blocks until both
+    buckets can cover a call's request count and estimated tokens; once the
+    call returns, `record_usage()` settles the difference between the
+    estimate and the tokens actually used.
+
+    Calls run in one of two lanes. Background calls (ingest, thread jobs,
+    batch runs) may not draw a bucket below `interactive_reserve` of its
+    capacity and yield to any waiting interactive call, so a bulk run slows
+    down instead of pushing live questions into 429 retries.
+    """
+
+    # Re-check interval for a background call yielding to interactive ones
+    YIELD_SECONDS = 0.05
+
+    def __init__(
+        self,
+        rpm: int = OPENAI_RPM_LIMIT,
+        tpm: int = OPENAI_TPM_LIMIT,
+        name: str = "chat",
+        interactive_reserve: float = GOVERNOR_INTERACTIVE_RESERVE,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.name = name
+        self.interactive_reserve = interactive_reserve
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._waiting: Dict[str, int] = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._metrics = get_metrics()
+        self.set_limits(rpm, tpm)
+
+    def set_limits(self, rpm: int, tpm: int) -> None:
+        """Change the budgets; both buckets start full."""
+        with self._lock:
+            self.rpm = rpm
+            self.tpm = tpm
+            self._requests = float(rpm)
+            self._tokens = float(tpm)
+            self._updated = self._clock()
+
+    def _take(self, requests: float, tokens: float, need_requests: float, need_tokens: float) -> Tuple[float, float]:
+        """
+        Charge `requests` and `tokens` if the buckets hold `need_*`; called
+        with the lock held.
+
+        Returns:
+            (seconds until the call would fit, 0 when charged; tokens left)
+        """
+        self._refill(self._clock())
+        wait = self._wait_time(need_requests, need_tokens)
+        if wait <= 0:
+            self._requests -= requests
+            self._tokens -= tokens
+        return wait, self._tokens
+
+    def _adjust_tokens(self, delta: float) -> None:
+        """Add `delta` tokens (negative to charge); called with the lock held."""
+        self._refill(self._clock())
+        # May go negative after a large underestimate; later calls then wait it out
+        self._tokens = min(self.tpm, self._tokens + delta)
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def _wait_time(self, requests: float, tokens: float) -> float:
+        """Seconds until both buckets cover the call; 0 if they already do."""
+        request_gap = max(0.0, requests - self._requests) * 60.0 / self.rpm
+        token_gap = max(0.0, tokens - self._tokens) * 60.0 / self.tpm
+        return max(request_gap, token_gap)
+
+    def acquire(
+        self,
+        tokens: int,
+        requests: int = 1,
+        lane: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> float:
+        """
+        Block until the call fits the budgets, then charge it.
+
+        Args:
+            tokens: Estimated tokens (prompt plus expected completion)
+            requests: Number of API requests the call makes
+            lane: INTERACTIVE or BACKGROUND; defaults to the current lane
+            timeout: Give up after this many seconds
+
+        Returns:
+            Seconds spent waiting
+
+        Raises:
+            TimeoutError: The budget did not free up within `timeout`
+        """
+        lane = lane or current_lane()
+        background = lane == BACKGROUND
+        # A single call larger than a minute's budget would never fit
+        tokens = min(tokens, self.tpm)
+        requests = min(requests, self.rpm)
+        reserve = self.interactive_reserve if background else 0.0
+        started = self._clock()
+        waiting = False
+        try:
+            while True:
+                with self._lock:
+                    if background and self._waiting[INTERACTIVE]:
+                        wait = self.YIELD_SECONDS
+                    else:
+                        wait, available = self._take(
+                            requests,
+                            tokens,
+                            min(self.rpm, requests + reserve * self.rpm),
+                            min(self.tpm, tokens + reserve * self.tpm),
+                        )
+                    now = self._clock()
+                    if wait <= 0:
+                        waited = now - started
+                        self._metrics.observe("governor_wait_ms", int(waited * 1000), budget=self.name, lane=lane)
+                        self._metrics.set_gauge("governor_tokens_available", int(available), budget=self.name)
+                        return waited
+                    if not waiting:
+                        waiting = True
+                        self._waiting[lane] += 1
+                if timeout is not None and now + wait - started > timeout:
+                    self._metrics.inc("governor_timeouts", budget=self.name, lane=lane)
+                    raise TimeoutError(f"OpenAI {self.name} budget not available within {timeout:.1f}s")
+                self._sleep(wait)
+        finally:
+            if waiting:
+                with self._lock:
+                    self._waiting[lane] -= 1
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Settle a call: refund an overestimate or charge an underestimate."""
+        with self._lock:
+            self._adjust_tokens(estimated_tokens - actual_tokens)
+        self._metrics.observe("governor_estimate_error_tokens", actual_tokens - estimated_tokens, budget=self.name)
+
+
+class SharedRateGovernor(RateGovernor):
+    """
+    RateGovernor whose buckets live in a SQLite file, so every local process
+    draws on one organization budget instead of each getting all of it.
+
+    Each charge is a short `BEGIN IMMEDIATE` transaction on a WAL-mode
+    database; buckets refill on the wall clock, which is comparable across
+    processes. Lanes and the interactive reserve work as in RateGovernor;
+    background calls yield to interactive calls waiting in the same process,
+    and the reserve keeps room for those of other processes. If the file is
+    busy or unusable, calls fall back to this process's own buckets.
+    """
+
+    def __init__(self, rpm: int = OPENAI_RPM_LIMIT, tpm: int = OPENAI_TPM_LIMIT, name: str = "chat",
+                 db_path: str = GOVERNOR_DB_PATH, busy_timeout: float = 1.0, **kwargs):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._degraded = False
+        kwargs.setdefault("clock", time.time)
+        super().__init__(rpm, tpm, name=name, **kwargs)
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._connection().execute("""
+            CREATE TABLE IF NOT EXISTS governor_buckets (
+                name TEXT PRIMARY KEY,
+                requests REAL NOT NULL,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def _shared(self, update: Callable[[], Tuple[float, float]]) -> Tuple[float, float]:
+        """
+        Load the shared buckets into this instance, run `update` on them and
+        store the result, in one transaction. A missing row starts full.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT requests, tokens, updated FROM governor_buckets WHERE name = ?", (self.name,)
+            ).fetchone()
+            if row is None:
+                row = (float(self.rpm), float(self.tpm), self._clock())
+            self._requests, self._tokens, self._updated = row
+            result = update()
+            conn.execute(
+                "INSERT OR REPLACE INTO governor_buckets (name, requests, tokens, updated) VALUES (?, ?, ?, ?)",
+                (self.name, self._requests, self._tokens, self._updated),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if self._degraded:
+            logger.info("Shared OpenAI budget recovered.")
+            self._degraded = False
+        return result
+
+    def _fallback(self, exc: Exception) -> None:
+        if not self._degraded:
+            logger.warning("Shared OpenAI budget unavailable (%s); using this process's own budget.", exc)
+            self._degraded = True
+
+    def _take(self, requests: float, tokens: float, need_requests: float, need_tokens: float) -> Tuple[float, float]:
+        local = (self._requests, self._tokens, self._updated)
+        try:
+            return self._shared(lambda: super(SharedRateGovernor, self)._take(requests, tokens, need_requests, need_tokens))
+        except sqlite3.Error as exc:
+            self._fallback(exc)
+            self._requests, self._tokens, self._updated = local
+            return super()._take(requests, tokens, need_requests, need_tokens)
+
+    def _adjust_tokens(self, delta: float) -> None:
+        try:
+            self._shared(lambda: (super(SharedRateGovernor, self)._adjust_tokens(delta), 0.0))
+        except sqlite3.Error as exc:
+            self._fallback(exc)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for budgeting: about four characters per token."""
+    return len(text) // 4 + 1
+
+
+# Global governors shared by every OpenAI caller in the process, one per budget
+_governors: Dict[str, RateGovernor] = {}
+_governor_lock = threading.Lock()
+
+_BUDGETS = {
+    "chat": lambda: (OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT),
+    "embeddings": lambda: (OPENAI_EMBEDDING_RPM_LIMIT, OPENAI_EMBEDDING_TPM_LIMIT),
+}
+
+def get_governor(name: str = "chat") -> RateGovernor:
+    """
+    Get or create the process-wide governor for a budget ("chat" or
+    "embeddings"), shared with the other local processes unless
+    GOVERNOR_BACKEND=memory.
+    """
+    governor = _governors.get(name)
+    if governor is None:
+        with _governor_lock:
+            governor = _governors.get(name)
+            if governor is None:
+                rpm, tpm = _BUDGETS[name]()
+                governor = None
+                if GOVERNOR_BACKEND == "sqlite":
+                    try:
+                        governor = SharedRateGovernor(rpm, tpm, name=name)
+                    except Exception as exc:
+                        logger.warning("Shared OpenAI budget unavailable (%s); using a per-process budget.", exc)
+                if governor is None:
+                    governor = RateGovernor(rpm, tpm, name=name)
+                _governors[name] = governor
+    return governor
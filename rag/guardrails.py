@@ -2,12 +2,16 @@
 
 import re
 import os
+import json
 import time
 from typing import Dict, List, Optional, Tuple, Any
 from enum import Enum
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import datetime
 import hashlib
+import threading
+
+from rag.rate_limiter import RateLimitRule, create_rate_limiter
 
 class PromptCategory(Enum):
     """Categories for different types of prompts."""
@@ -34,6 +38,9 @@ class GuardrailConfig:
     require_source_citation: bool = True
     max_sources_per_response: int = 5
     restricted_keywords: List[str] = None
+    injection_patterns: List[str] = None
+    # Ordered by priority: the first category with a keyword hit wins
+    category_keywords: Dict[PromptCategory, List[str]] = None
     allowed_tools_by_category: Dict[PromptCategory, List[ToolCategory]] = None
     
     def __post_init__(self):
@@ -43,6 +50,24 @@ class GuardrailConfig:
                 "financial_advice", "investment_advice", "legal_advice"
             ]
         
+        if self.injection_patterns is None:
+            self.injection_patterns = [
+                r"<script.*?>",
+                r"javascript:",
+                r"on\w+\s*=",
+                r"union\s+select",
+                r"drop\s+table",
+                r"delete\s+from"
+            ]
+        
+        if self.category_keywords is None:
+            self.category_keywords = {
+                PromptCategory.CONTENT_GENERATION: ["generate", "create", "write", "thread", "content", "post"],
+                PromptCategory.TECHNICAL_DETAILS: ["how", "what is", "explain", "technical", "implementation", "code"],
+                PromptCategory.ANALYTICS: ["analytics", "stats", "usage", "metrics", "performance"],
+                PromptCategory.ADMIN: ["admin", "system", "config", "settings"]
+            }
+        
         if self.allowed_tools_by_category is None:
             self.allowed_tools_by_category = {
                 PromptCategory.GENERAL_QUERY: [ToolCategory.RAG_QUERY],
@@ -52,6 +77,173 @@ class GuardrailConfig:
                 PromptCategory.ADMIN: [ToolCategory.ADMIN, ToolCategory.ANALYTICS]
             }
 
+def load_guardrail_config(path: str) -> GuardrailConfig:
+    """
+    Load a GuardrailConfig from a JSON file.
+    
+    Every key is optional and mirrors a GuardrailConfig field. Categories and
+    tools are given by their enum values, e.g.
+    {"restricted_keywords": [...], "injection_patterns": [...],
+     "category_keywords": {"content_generation": [...], ...}}
+    
+    Args:
+        path: Path to the JSON rules file
+        
+    Returns:
+        GuardrailConfig with defaults for missing keys
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    
+    kwargs: Dict[str, Any] = {}
+    for key in (
+        "min_confidence_threshold", "max_response_length",
+        "rate_limit_queries_per_minute", "rate_limit_queries_per_hour",
+        "require_source_citation", "max_sources_per_response",
+        "restricted_keywords", "injection_patterns",
+    ):
+        if key in raw:
+            kwargs[key] = raw[key]
+    if "category_keywords" in raw:
+        kwargs["category_keywords"] = {
+            PromptCategory(category): list(words)
+            for category, words in raw["category_keywords"].items()
+        }
+    if "allowed_tools_by_category" in raw:
+        kwargs["allowed_tools_by_category"] = {
+            PromptCategory(category): [ToolCategory(tool) for tool in tools]
+            for category, tools in raw["allowed_tools_by_category"].items()
+        }
+    return GuardrailConfig(**kwargs)
+
+@dataclass
+class PromptVerdict:
+    """Result of a single guardrail pass over a prompt."""
+    safe: bool
+    message: str
+    category: PromptCategory
+    allowed_tools: List[ToolCategory]
+
+def _trie_regex(words: List[str]) -> str:
+    """
+    Build a regex alternation for literal words shaped like a prefix trie,
+    so matching at a position costs O(word length) rather than O(#words).
+    At any position the longest word is matched.
+    """
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+    
+    def build(node: Dict[str, Any]) -> str:
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return "(?:" + body + ")?" if "" in node else body
+    
+    return build(trie)
+
+class PromptMatcher:
+    """
+    Precompiled guardrail rules: restricted keywords, injection patterns and
+    category keywords combined into one regex that is applied in a single
+    pass over the lowercased prompt.
+    
+    Keywords keep the original substring semantics and are compiled into a
+    trie-shaped alternation. Every position is tested through a lookahead, so
+    overlapping hits are all seen; injection patterns are tried before
+    keywords at each position, and a keyword hit also reports every shorter
+    keyword that is a prefix of it.
+    """
+    
+    def __init__(self, config: GuardrailConfig):
+        self.allowed_tools_by_category = config.allowed_tools_by_category
+        self.category_priority = {
+            category: rank for rank, category in enumerate(config.category_keywords)
+        }
+        
+        # keyword -> position in restricted_keywords (or None) and the
+        # categories it signals
+        labels: Dict[str, Tuple[Optional[int], List[PromptCategory]]] = {}
+        for index, keyword in enumerate(config.restricted_keywords):
+            kw = keyword.lower()
+            if kw and kw not in labels:
+                labels[kw] = (index, [])
+        for category, words in config.category_keywords.items():
+            for word in words:
+                kw = word.lower()
+                if kw:
+                    restricted, categories = labels.get(kw, (None, []))
+                    labels[kw] = (restricted, categories + [category])
+        
+        # A match reports the longest keyword at a position; fold in every
+        # keyword that is a prefix of it.
+        self._restricted_keywords = [kw.lower() for kw in config.restricted_keywords]
+        self._hits: Dict[str, Tuple[Optional[int], List[PromptCategory]]] = {}
+        for kw in labels:
+            restricted_index: Optional[int] = None
+            categories: List[PromptCategory] = []
+            for end in range(1, len(kw) + 1):
+                prefix_label = labels.get(kw[:end])
+                if prefix_label is None:
+                    continue
+                if prefix_label[0] is not None:
+                    if restricted_index is None or prefix_label[0] < restricted_index:
+                        restricted_index = prefix_label[0]
+                categories.extend(prefix_label[1])
+            self._hits[kw] = (restricted_index, categories)
+        
+        # Patterns run against the lowercased prompt; a case-insensitive regex
+        # is several times slower, so patterns are expected in lowercase.
+        alternatives = []
+        if config.injection_patterns:
+            alternatives.append("(?P<inj>" + "|".join(f"(?:{p})" for p in config.injection_patterns) + ")")
+        if labels:
+            alternatives.append(f"(?P<kw>{_trie_regex(list(labels))})")
+        self._regex = re.compile("(?=" + "|".join(alternatives) + ")") if alternatives else None
+    
+    def match(self, query: str) -> PromptVerdict:
+        """
+        Evaluate safety, category and allowed tools for a prompt.
+        
+        Restricted keywords take precedence over injection patterns, and the
+        category is reported even for unsafe prompts, matching the separate
+        checks this replaces.
+        
+        Args:
+            query: User query text
+            
+        Returns:
+            PromptVerdict
+        """
+        best_category = PromptCategory.GENERAL_QUERY
+        best_rank = len(self.category_priority)
+        restricted_index: Optional[int] = None
+        injection_found = False
+        if self._regex is not None:
+            for m in self._regex.finditer(query.lower()):
+                if m.lastgroup != "kw":
+                    injection_found = True
+                    continue
+                hit_index, categories = self._hits[m.group("kw")]
+                if hit_index is not None and (restricted_index is None or hit_index < restricted_index):
+                    restricted_index = hit_index
+                for category in categories:
+                    rank = self.category_priority[category]
+                    if rank < best_rank:
+                        best_category, best_rank = category, rank
+        
+        allowed_tools = self.allowed_tools_by_category.get(best_category, [])
+        if restricted_index is not None:
+            keyword = self._restricted_keywords[restricted_index]
+            return PromptVerdict(False, f"Query contains restricted keyword: {keyword}", best_category, allowed_tools)
+        if injection_found:
+            return PromptVerdict(False, "Query contains potentially unsafe content", best_category, allowed_tools)
+        return PromptVerdict(True, "Content safety check passed", best_category, allowed_tools)
+
 class Guardrails:
     def __init__(self, config: Optional[GuardrailConfig] = None):
         """
@@ -60,6 +252,10 @@ class Guardrails:
         Args:
             config: Guardrail configuration
         """
+        # Rules may be loaded from a JSON file; env still overrides the threshold
+        rules_file = os.getenv("GUARDRAILS_RULES_FILE")
+        if config is None and rules_file:
+            config = load_guardrail_config(rules_file)
         # Allow environment override for min confidence threshold
         cfg = config or GuardrailConfig()
         try:
@@ -69,8 +265,14 @@ class Guardrails:
         except Exception:
             pass
         self.config = cfg
-        self.rate_limit_cache = {}  # Simple in-memory rate limiting
+        # Shared across local processes (web workers, bot) unless
+        # RATE_LIMIT_BACKEND=memory
+        self.rate_limiter = create_rate_limiter([
+            RateLimitRule("hour", self.config.rate_limit_queries_per_hour, 3600.0),
+            RateLimitRule("minute", self.config.rate_limit_queries_per_minute, 60.0),
+        ], namespace="guardrails")
         self.user_queries = {}  # Track user query history
+        self.matcher = PromptMatcher(self.config)
     
     def classify_prompt(self, query: str) -> PromptCategory:
         """
@@ -82,25 +284,7 @@ class Guardrails:
         Returns:
             PromptCategory classification
         """
-        query_lower = query.lower()
-        
-        # Content generation keywords
-        if any(word in query_lower for word in ["generate", "create", "write", "thread", "content", "post"]):
-            return PromptCategory.CONTENT_GENERATION
-        
-        # Technical details keywords
-        if any(word in query_lower for word in ["how", "what is", "explain", "technical", "implementation", "code"]):
-            return PromptCategory.TECHNICAL_DETAILS
-        
-        # Analytics keywords
-        if any(word in query_lower for word in ["analytics", "stats", "usage", "metrics", "performance"]):
-            return PromptCategory.ANALYTICS
-        
-        # Admin keywords
-        if any(word in query_lower for word in ["admin", "system", "config", "settings"]):
-            return PromptCategory.ADMIN
-        
-        return PromptCategory.GENERAL_QUERY
+        return self.matcher.match(query).category
     
     def check_rate_limit(self, user_id: str) -> Tuple[bool, str]:
         """
@@ -112,33 +296,13 @@ class Guardrails:
         Returns:
             Tuple of (allowed, message)
         """
-        now = datetime.utcnow()
-        
-        if user_id not in self.rate_limit_cache:
-            self.rate_limit_cache[user_id] = []
-        
-        # Clean old entries
-        self.rate_limit_cache[user_id] = [
-            timestamp for timestamp in self.rate_limit_cache[user_id]
-            if now - timestamp < timedelta(hours=1)
-        ]
-        
-        # Check hourly limit
-        if len(self.rate_limit_cache[user_id]) >= self.config.rate_limit_queries_per_hour:
+        decision = self.rate_limiter.check(user_id)
+        if decision.allowed:
+            return True, "Rate limit check passed"
+
+        if decision.rule.name == "hour":
             return False, f"Hourly rate limit exceeded ({self.config.rate_limit_queries_per_hour} queries)"
-        
-        # Check minute limit (last 60 seconds)
-        recent_queries = [
-            timestamp for timestamp in self.rate_limit_cache[user_id]
-            if now - timestamp < timedelta(minutes=1)
-        ]
-        
-        if len(recent_queries) >= self.config.rate_limit_queries_per_minute:
-            return False, f"Minute rate limit exceeded ({self.config.rate_limit_queries_per_minute} queries)"
-        
-        # Add current query
-        self.rate_limit_cache[user_id].append(now)
-        return True, "Rate limit check passed"
+        return False, f"Minute rate limit exceeded ({self.config.rate_limit_queries_per_minute} queries)"
     
     def check_content_safety(self, query: str) -> Tuple[bool, str]:
         """
@@ -150,28 +314,20 @@ class Guardrails:
         Returns:
             Tuple of (safe, message)
         """
-        query_lower = query.lower()
-        
-        # Check for restricted keywords
-        for keyword in self.config.restricted_keywords:
-            if keyword in query_lower:
-                return False, f"Query contains restricted keyword: {keyword}"
-        
-        # Check for potential injection attempts
-        injection_patterns = [
-            r"<script.*?>",
-            r"javascript:",
-            r"on\w+\s*=",
-            r"union\s+select",
-            r"drop\s+table",
-            r"delete\s+from"
-        ]
-        
-        for pattern in injection_patterns:
-            if re.search(pattern, query_lower, re.IGNORECASE):
-                return False, f"Query contains potentially unsafe content"
-        
-        return True, "Content safety check passed"
+        verdict = self.matcher.match(query)
+        return verdict.safe, verdict.message
+    
+    def evaluate_prompt(self, query: str) -> PromptVerdict:
+        """
+        Run content safety, prompt classification and tool lookup in one pass.
+        
+        Args:
+            query: User query text
+            
+        Returns:
+            PromptVerdict with safety verdict, category and allowed tools
+        """
+        return self.matcher.match(query)
     
     def validate_tool_access(
         self, 
@@ -278,6 +434,10 @@ class Guardrails:
         
         return response
     
+    def streaming_sanitizer(self) -> "StreamingSanitizer":
+        """Incremental sanitizer for a streamed response (see StreamingSanitizer)."""
+        return StreamingSanitizer(self.config.max_response_length)
+    
     def generate_response_id(self, query: str, user_id: str) -> str:
         """
         Generate a unique response ID for tracking.
@@ -303,15 +463,74 @@ class Guardrails:
         Returns:
             List of allowed tool categories
         """
-        prompt_category = self.classify_prompt(query)
-        return self.config.allowed_tools_by_category.get(prompt_category, [])
+        return self.matcher.match(query).allowed_tools
+
+class StreamingSanitizer:
+    """
+    Incremental form of Guardrails.sanitize_response for streamed text.
+
+    `feed()` returns only text that can no longer change: an unclosed `<`
+    (a possible tag) and a trailing partial "javascript:" are held back
+    until later chunks settle them. Output stops at `max_length`, like the
+    batch sanitizer. The batch result stays authoritative for the final text.
+    """
+
+    _TAG = re.compile(r'<[^>]+>')
+    _JS = re.compile(r'javascript:', re.IGNORECASE)
+    _JS_PREFIX = "javascript:"
+
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self._pending = ""
+        self._emitted = 0
+        self._truncated = False
+
+    def feed(self, chunk: str) -> str:
+        """Add a raw chunk; return the newly safe text."""
+        self._pending += chunk
+        return self._drain(final=False)
+
+    def finish(self) -> str:
+        """Flush whatever is still held back at the end of the stream."""
+        return self._drain(final=True)
+
+    def _drain(self, final: bool) -> str:
+        if self._truncated:
+            self._pending = ""
+            return ""
+        text = self._TAG.sub('', self._pending)
+        held = ""
+        if not final:
+            # An unclosed '<' may still become a tag
+            open_at = text.find('<', text.rfind('>') + 1)
+            if open_at != -1:
+                text, held = text[:open_at], text[open_at:]
+        text = self._JS.sub('', text)
+        if not final:
+            lowered = text.lower()
+            for size in range(min(len(self._JS_PREFIX) - 1, len(text)), 0, -1):
+                if lowered.endswith(self._JS_PREFIX[:size]):
+                    text, held = text[:-size], text[-size:] + held
+                    break
+        self._pending = held
+
+        remaining = self.max_length - self._emitted
+        if len(text) > remaining:
+            text = text[:remaining] + "..."
+            self._truncated = True
+        self._emitted += len(text)
+        return text
+
 
 # Global guardrails instance
 _guardrails = None
+_guardrails_lock = threading.Lock()
 
 def get_guardrails() -> Guardrails:
     """Get or create global guardrails instance."""
     global _guardrails
     if _guardrails is None:
-        _guardrails = Guardrails()
+        with _guardrails_lock:
+            if _guardrails is None:
+                _guardrails = Guardrails()
     return _guardrails 
\ No newline at end of file
@@ -1,18 +1,27 @@
 # rag/ingest.py
 
 import os
+import sys
 import hashlib
 from typing import List, Dict
 from langchain_community.document_loaders import TextLoader, PyMuPDFLoader
 from langchain.text_splitter import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Qdrant
-from langchain_openai import OpenAIEmbeddings
 from dotenv import load_dotenv
 from qdrant_client import QdrantClient
 from qdrant_client.http.models import VectorParams, Distance
 from langchain_core.documents import Document
 from datetime import datetime
 
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from rag.metadata_db import get_metadata_db
+from rag.clients import GovernedOpenAIEmbeddings
+from rag.governor import BACKGROUND
+from rag.sparse_index import build_sparse_index
+from rag.glossary_vectors import build_glossary_vectors
+from rag.definitions import build_definition_store
+from rag.precompute import PRECOMPUTE_ON_INGEST, refresh_precomputed_answers
+
 load_dotenv()
 
 def embed_documents(
@@ -151,10 +160,19 @@ def embed_documents(
 
     print(f"✂️ Split into {len(chunks)} chunks.")
 
-    # Embeddings - Using text-embedding-3-large
-    embeddings = OpenAIEmbeddings(
+    # Content version of this ingest; caches keyed on it go stale when the corpus changes
+    version_hash = hashlib.sha256()
+    for chunk in chunks:
+        version_hash.update(f"{chunk.metadata.get('document_id')}:{chunk.metadata.get('chunk_index')}\n".encode("utf-8"))
+        version_hash.update(chunk.page_content.encode("utf-8"))
+    collection_version = version_hash.hexdigest()[:16]
+
+    # Embeddings - Using text-embedding-3-large, paced as background work so
+    # a re-ingest cannot starve live questions of the embeddings budget
+    embeddings = GovernedOpenAIEmbeddings(
         model="text-embedding-3-large",
-        dimensions=3072  # text-embedding-3-large uses 3072 dimensions
+        dimensions=3072,  # text-embedding-3-large uses 3072 dimensions
+        lane=BACKGROUND,
     )
 
     # Qdrant Setup
@@ -232,7 +250,23 @@ def embed_documents(
             print(f"❌ Unknown error: {error_msg}")
             raise e
 
-    print("✅ Ingestion complete! Vectorstore uploaded to Qdrant.")
+    get_metadata_db().set_collection_version(collection_name, collection_version, len(chunks))
+    sparse_index = build_sparse_index(chunks, collection_name, collection_version)
+    print(f"🔤 Built sparse BM25 index over {len(sparse_index)} chunks ({len(sparse_index.vocabulary)} terms).")
+    glossary_vectors = build_glossary_vectors()
+    print(f"🔤 Embedded {len(glossary_vectors.terms)} glossary terms for composed query variants.")
+    glossary_path = os.path.join(source_folder, "Glossary.md")
+    if os.path.exists(glossary_path):
+        definitions = build_definition_store(glossary_path, _stable_document_id("text", glossary_path))
+        print(f"📖 Pre-rendered {len(definitions)} glossary definitions for the direct-answer fast path.")
+    if PRECOMPUTE_ON_INGEST:
+        # Answers for the top questions were generated against the old content
+        try:
+            summary = refresh_precomputed_answers()
+            print(f"💬 Regenerated {summary['stored']} precomputed answers for the top {summary['clusters']} questions.")
+        except Exception as exc:
+            print(f"⚠️ Precomputed answers not refreshed (stale ones are no longer served): {exc}")
+    print(f"✅ Ingestion complete! Vectorstore uploaded to Qdrant (version {collection_version}).")
 
 if __name__ == "__main__":
     embed_documents()
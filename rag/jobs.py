@@ -0,0 +1,398 @@
+# rag/jobs.py
+
+import os
+import json
+import asyncio
+import time
+import uuid
+import sqlite3
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncIterator, Dict, Optional
+
+from rag.admission import AdmissionRejected, get_admission_controller
+from rag.clients import QDRANT_COLLECTION_NAME
+from rag.deadline import Deadline
+from rag.governor import BACKGROUND, governor_lane
+from rag.metadata_db import get_metadata_db
+from rag.metrics import get_metrics
+from rag.query import normalize_question
+
+logger = logging.getLogger("jobs")
+
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "data/jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Jobs waiting for a worker in this process before new submissions are refused
+JOB_QUEUE_DEPTH = int(os.getenv("JOB_QUEUE_DEPTH", "50"))
+# Budget for one job, counted from when a worker picks it up
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "120"))
+# How long a finished thread is served for the same topic and collection version
+JOB_CACHE_TTL_SECONDS = float(os.getenv("JOB_CACHE_TTL_SECONDS", "86400"))
+# How often watchers re-read a job; the table is shared across processes, so polling it is the feed
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "0.5"))
+# Finished jobs older than this are deleted when the queue starts
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 86400)))
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+FINISHED_STATUSES = (SUCCEEDED, FAILED)
+
+
+@dataclass
+class Job:
+    """One row of the job table."""
+    id: str
+    kind: str
+    topic: str
+    template: Optional[str]
+    cache_key: str
+    status: str
+    stage: Optional[str] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    user_id: Optional[str] = None
+    client_type: str = "web"
+    created_at: float = 0.0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    cached: bool = False
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Public view: a reused job is returned to other callers, so the submitter stays out of it."""
+        data = asdict(self)
+        for private in ("cache_key", "user_id", "client_type"):
+            data.pop(private)
+        return data
+
+
+_COLUMNS = (
+    "id, kind, topic, template, cache_key, status, stage, result, error, "
+    "user_id, client_type, created_at, started_at, finished_at"
+)
+
+
+def _row_to_job(row) -> Job:
+    values = dict(zip([c.strip() for c in _COLUMNS.split(",")], row))
+    values["result"] = json.loads(values["result"]) if values["result"] else None
+    return Job(**values)
+
+
+class JobStore:
+    """
+    Job table in SQLite, shared by every local process (web app, webhook
+    server, bot) so a job can be polled from any of them and finished
+    results serve as a cache for all of them.
+
+    Uses a WAL-mode database with one connection per thread, like the
+    shared rate limiter.
+    """
+
+    def __init__(self, db_path: str = JOB_DB_PATH, clock=time.time):
+        self.db_path = db_path
+        self._clock = clock
+        self._local = threading.local()
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        conn = self._connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                template TEXT,
+                cache_key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                result TEXT,
+                error TEXT,
+                user_id TEXT,
+                client_type TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_cache_key ON jobs (cache_key, status)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, job: Job) -> None:
+        values = asdict(job)
+        values["result"] = json.dumps(job.result) if job.result is not None else None
+        columns = [c.strip() for c in _COLUMNS.split(",")]
+        self._connection().execute(
+            f"INSERT INTO jobs ({_COLUMNS}) VALUES ({', '.join('?' * len(columns))})",
+            [values[c] for c in columns],
+        )
+
+    def get(self, job_id: str) -> Optional[Job]:
+        row = self._connection().execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    def find_reusable(self, cache_key: str, max_age_seconds: float) -> Optional[Job]:
+        """
+        A job for the same cache key that succeeded within `max_age_seconds`,
+        or else one still pending so duplicates coalesce; a finished result
+        wins because it can be returned at once.
+        """
+        cutoff = self._clock() - max_age_seconds
+        row = self._connection().execute(
+            f"SELECT {_COLUMNS} FROM jobs WHERE cache_key = ? AND "
+            "(status IN (?, ?) OR (status = ? AND finished_at >= ?)) "
+            "ORDER BY status = ? DESC, created_at DESC LIMIT 1",
+            (cache_key, QUEUED, RUNNING, SUCCEEDED, cutoff, SUCCEEDED),
+        ).fetchone()
+        return _row_to_job(row) if row else None
+
+    def claim(self, job_id: str) -> bool:
+        """Move a queued job to running; False if another worker got it first."""
+        cursor = self._connection().execute(
+            "UPDATE jobs SET status = ?, started_at = ? WHERE id = ? AND status = ?",
+            (RUNNING, self._clock(), job_id, QUEUED),
+        )
+        return cursor.rowcount == 1
+
+    def set_stage(self, job_id: str, stage: str) -> None:
+        self._connection().execute("UPDATE jobs SET stage = ? WHERE id = ?", (stage, job_id))
+
+    def finish(self, job_id: str, status: str, result: Optional[Dict] = None, error: Optional[str] = None) -> None:
+        self._connection().execute(
+            "UPDATE jobs SET status = ?, stage = NULL, result = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error, self._clock(), job_id),
+        )
+
+    def recover(self, retention_seconds: float, stale_after_seconds: float) -> list:
+        """
+        Tidy up after a restart: fail jobs that have been running for longer
+        than any job can (their process died), delete old finished jobs, and
+        return the ids of jobs that are still queued.
+        """
+        conn = self._connection()
+        now = self._clock()
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = 'interrupted', finished_at = ? "
+            "WHERE status = ? AND started_at < ?",
+            (FAILED, now, RUNNING, now - stale_after_seconds),
+        )
+        conn.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (now - retention_seconds,))
+        return [row[0] for row in conn.execute(
+            "SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (QUEUED,)
+        )]
+
+
+def thread_cache_key(topic: str, template: Optional[str], collection_version: Optional[str]) -> str:
+    """Cache key for a thread: normalized topic, template and the collection version it was written from."""
+    content = f"{normalize_question(topic)}|{template or ''}|{collection_version or 'unversioned'}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class JobQueue:
+    """
+    Background jobs for long generations, with a bounded worker pool.
+
+    `submit_thread` returns at once with a Job: a cached result for the same
+    topic and collection version when one exists, the already pending job
+    for a duplicate topic, or a new queued job. Workers run the generation
+    under a per-job deadline and write the outcome to the JobStore, where
+    callers poll for it. At most `max_workers` jobs run at once and at most
+    `max_queue` more wait in this process; beyond that submissions are
+    refused with AdmissionRejected.
+    """
+
+    def __init__(
+        self,
+        store: Optional[JobStore] = None,
+        max_workers: int = JOB_WORKERS,
+        max_queue: int = JOB_QUEUE_DEPTH,
+        job_timeout: float = JOB_TIMEOUT_SECONDS,
+        cache_ttl: float = JOB_CACHE_TTL_SECONDS,
+    ):
+        self.store = store or JobStore()
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.job_timeout = job_timeout
+        self.cache_ttl = cache_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._metrics = get_metrics()
+
+    def _publish_gauges(self) -> None:
+        self._metrics.set_gauge("jobs_pending", self._pending)
+
+    def _reserve(self) -> None:
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                raise AdmissionRejected("queue_full", retry_after=5.0)
+            self._pending += 1
+            self._publish_gauges()
+
+    def submit_thread(
+        self,
+        topic: str,
+        user_id: Optional[str] = None,
+        client_type: str = "web",
+        template_name: Optional[str] = None,
+    ) -> Job:
+        """
+        Queue a thread generation, or reuse a pending or cached one.
+
+        Returns:
+            The Job; `cached` is True when it was already finished
+
+        Raises:
+            AdmissionRejected: The queue is full
+        """
+        collection_version = get_metadata_db().get_collection_version(QDRANT_COLLECTION_NAME)
+        cache_key = thread_cache_key(topic, template_name, collection_version)
+        existing = self.store.find_reusable(cache_key, self.cache_ttl)
+        if existing is not None:
+            outcome = "cache_hit" if existing.finished else "coalesced"
+            self._metrics.inc("jobs_submitted", kind="thread", outcome=outcome)
+            existing.cached = existing.finished
+            return existing
+
+        job = Job(
+            id=uuid.uuid4().hex,
+            kind="thread",
+            topic=topic,
+            template=template_name,
+            cache_key=cache_key,
+            status=QUEUED,
+            user_id=user_id,
+            client_type=client_type,
+            created_at=time.time(),
+        )
+        try:
+            self._reserve()
+        except AdmissionRejected:
+            self._metrics.inc("jobs_submitted", kind="thread", outcome="rejected")
+            raise
+        self.store.create(job)
+        self._executor.submit(self._run, job.id)
+        self._metrics.inc("jobs_submitted", kind="thread", outcome="queued")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.store.get(job_id)
+
+    async def watch(self, job_id: str, timeout: Optional[float] = None) -> AsyncIterator[Job]:
+        """
+        Yield the job each time its status or stage changes, ending once it
+        has finished or `timeout` seconds have passed. Yields nothing for an
+        unknown job id.
+        """
+        loop = asyncio.get_running_loop()
+        give_up_at = None if timeout is None else loop.time() + timeout
+        last = None
+        while True:
+            job = self.store.get(job_id)
+            if job is None:
+                return
+            if (job.status, job.stage) != last:
+                last = (job.status, job.stage)
+                yield job
+            if job.finished or (give_up_at is not None and loop.time() >= give_up_at):
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL_SECONDS)
+
+    async def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[Job]:
+        """The job once finished, or its latest state when `timeout` runs out first."""
+        job = None
+        async for job in self.watch(job_id, timeout):
+            pass
+        return job
+
+    def _run(self, job_id: str) -> None:
+        try:
+            if not self.store.claim(job_id):
+                return
+            job = self.store.get(job_id)
+            self._metrics.observe("job_queue_wait_ms", int((job.started_at - job.created_at) * 1000), kind=job.kind)
+            self._schedule(job)
+        except Exception:
+            logger.exception("Job %s crashed", job_id)
+            self.store.finish(job_id, FAILED, error="processing_error")
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._publish_gauges()
+
+    def _schedule(self, job: Job) -> None:
+        """Run the job on the shared pipeline pool in the "thread" priority class, waiting out a full pool."""
+        give_up_at = time.monotonic() + self.job_timeout
+        while True:
+            try:
+                get_admission_controller().call("thread", self._run_thread, job)
+                return
+            except AdmissionRejected as exc:
+                if time.monotonic() + exc.retry_after > give_up_at:
+                    self.store.finish(job.id, FAILED, error="overloaded")
+                    self._metrics.inc("jobs_finished", kind=job.kind, status=FAILED)
+                    return
+                time.sleep(exc.retry_after)
+
+    def _run_thread(self, job: Job) -> None:
+        from generate.thread import generate_thread_result
+
+        # Nobody is blocked on a job, so it yields the OpenAI budget to live questions
+        with governor_lane(BACKGROUND):
+            result = generate_thread_result(
+                job.topic,
+                user_id=job.user_id,
+                client_type=job.client_type,
+                template_name=job.template,
+                deadline=Deadline(self.job_timeout),
+                on_progress=lambda stage: self.store.set_stage(job.id, stage),
+            )
+        status = SUCCEEDED if result.success else FAILED
+        self.store.finish(job.id, status, result=asdict(result), error=result.error)
+        self._metrics.inc("jobs_finished", kind=job.kind, status=status)
+        self._metrics.observe("job_service_ms", result.processing_time_ms, kind=job.kind)
+
+    def recover(self) -> int:
+        """Requeue jobs left queued by a previous process. Returns how many were requeued."""
+        # Another live process may share the table; its queued jobs are safe
+        # to requeue here because only one worker can claim each job
+        job_ids = self.store.recover(JOB_RETENTION_SECONDS, stale_after_seconds=2 * self.job_timeout)
+        requeued = 0
+        for job_id in job_ids:
+            try:
+                self._reserve()
+            except AdmissionRejected:
+                self.store.finish(job_id, FAILED, error="queue_full")
+                continue
+            self._executor.submit(self._run, job_id)
+            requeued += 1
+        return requeued
+
+    def shutdown(self, wait: bool = False) -> None:
+        # Queued jobs stay queued in the table and are picked up by the next recover()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+# Global job queue
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue() -> JobQueue:
+    """Get or create the process-wide job queue."""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue()
+    return _job_queue
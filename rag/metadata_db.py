@@ -91,6 +91,31 @@ class MetadataDB:
                 )
             """)
             
+            # Collection versions, recorded by each ingest
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS collection_versions (
+                    collection_name TEXT PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    chunk_count INTEGER,
+                    ingested_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Vetted answers for the most frequent questions, written by rag/precompute.py
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS precomputed_answers (
+                    question_key TEXT PRIMARY KEY,
+                    question TEXT NOT NULL,
+                    variants TEXT,
+                    frequency INTEGER,
+                    response TEXT NOT NULL,
+                    sources TEXT,
+                    confidence_score REAL,
+                    collection_version TEXT,
+                    generated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
             conn.commit()
     
     def log_query(
@@ -309,6 +334,149 @@ class MetadataDB:
                 "tool_usage": tool_usage
             }
     
+    def set_collection_version(self, collection_name: str, version: str, chunk_count: Optional[int] = None):
+        """
+        Record the content version of a collection after an ingest.
+        
+        Args:
+            collection_name: Qdrant collection name
+            version: Content hash of the ingested chunks
+            chunk_count: Number of chunks stored
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO collection_versions (collection_name, version, chunk_count, ingested_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            """, (collection_name, version, chunk_count))
+            conn.commit()
+    
+    def get_collection_version(self, collection_name: str) -> Optional[str]:
+        """Get the last recorded version of a collection, or None if it was never ingested here."""
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT version FROM collection_versions WHERE collection_name = ?",
+                (collection_name,)
+            ).fetchone()
+            return row[0] if row else None
+    
+    def get_question_counts(
+        self,
+        days: Optional[int] = None,
+        exclude_clients: tuple = (),
+        exclude_tools: tuple = ()
+    ) -> List[Dict]:
+        """
+        How often each distinct query text was asked.
+        
+        Args:
+            days: Only count queries from the last `days` days
+            exclude_clients: Client types to leave out (batch jobs)
+            exclude_tools: Leave out queries logged with these tools (thread topics)
+            
+        Returns:
+            [{"query_text", "count"}], most frequent first
+        """
+        conditions, params = [], []
+        if days is not None:
+            conditions.append("timestamp >= datetime('now', ?)")
+            params.append(f"-{int(days)} days")
+        if exclude_clients:
+            conditions.append(f"COALESCE(client_type, '') NOT IN ({', '.join('?' * len(exclude_clients))})")
+            params.extend(exclude_clients)
+        if exclude_tools:
+            conditions.append(
+                "id NOT IN (SELECT query_id FROM tool_usage "
+                f"WHERE query_id IS NOT NULL AND tool_name IN ({', '.join('?' * len(exclude_tools))}))"
+            )
+            params.extend(exclude_tools)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(f"""
+                SELECT query_text, COUNT(*) AS count FROM query_history
+                {where}
+                GROUP BY query_text
+                ORDER BY count DESC
+            """, params).fetchall()
+            return [dict(row) for row in rows]
+    
+    def get_answered_question_users(
+        self,
+        days: Optional[int] = None,
+        exclude_clients: tuple = (),
+        answer_tools: tuple = ()
+    ) -> List[Dict]:
+        """
+        How often each user asked each query text and got an answer.
+        
+        Only rows with a non-empty response logged under one of
+        `answer_tools` count; failed queries and thread topics do not.
+        
+        Args:
+            days: Only count queries from the last `days` days
+            exclude_clients: Client types to leave out (batch jobs)
+            answer_tools: Tool names an answered query is logged with
+            
+        Returns:
+            [{"query_text", "user_id", "count"}]
+        """
+        if not answer_tools:
+            return []
+        conditions = [
+            "response_length > 0",
+            "id IN (SELECT query_id FROM tool_usage "
+            f"WHERE query_id IS NOT NULL AND tool_name IN ({', '.join('?' * len(answer_tools))}))",
+        ]
+        params = list(answer_tools)
+        if days is not None:
+            conditions.append("timestamp >= datetime('now', ?)")
+            params.append(f"-{int(days)} days")
+        if exclude_clients:
+            conditions.append(f"COALESCE(client_type, '') NOT IN ({', '.join('?' * len(exclude_clients))})")
+            params.extend(exclude_clients)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(f"""
+                SELECT query_text, COALESCE(user_id, '') AS user_id, COUNT(*) AS count
+                FROM query_history
+                WHERE {' AND '.join(conditions)}
+                GROUP BY query_text, COALESCE(user_id, '')
+            """, params).fetchall()
+            return [dict(row) for row in rows]
+    
+    def replace_precomputed_answers(self, answers: List[Dict]):
+        """
+        Replace the precomputed answer set.
+        
+        Args:
+            answers: [{"question_key", "question", "variants", "frequency",
+                "response", "sources", "confidence_score", "collection_version"}]
+        """
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("DELETE FROM precomputed_answers")
+            conn.executemany("""
+                INSERT INTO precomputed_answers
+                (question_key, question, variants, frequency, response, sources, confidence_score, collection_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(
+                a["question_key"], a["question"], json.dumps(a.get("variants", [])), a.get("frequency"),
+                a["response"], json.dumps(a.get("sources", [])), a.get("confidence_score"), a.get("collection_version"),
+            ) for a in answers])
+            conn.commit()
+    
+    def get_precomputed_answers(self) -> List[Dict]:
+        """The precomputed answer set, most frequent question first."""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT * FROM precomputed_answers ORDER BY frequency DESC").fetchall()
+        answers = []
+        for row in rows:
+            answer = dict(row)
+            answer["variants"] = json.loads(answer["variants"] or "[]")
+            answer["sources"] = json.loads(answer["sources"] or "[]")
+            answers.append(answer)
+        return answers
+    
     def update_daily_analytics(self):
         """Update daily analytics summary."""
         with sqlite3.connect(self.db_path) as conn:
@@ -0,0 +1,299 @@
+# rag/precompute.py
+"""
+Precomputed answers for the most frequent questions in query_history.
+
+    python rag/precompute.py refresh --top 50 --days 30
+    python rag/precompute.py report --days 7
+
+`refresh` clusters historical questions (normalized, then deduplicated by
+embedding similarity), answers the top clusters with the full pipeline,
+keeps the answers that pass vetting and replaces the stored set. rag/ingest.py
+runs it after every ingest. `report` prints the share of historical traffic
+the stored set covers.
+
+prepare_query consults the stored set before retrieval; a hit is answered
+without any OpenAI call.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from rag.clients import QDRANT_COLLECTION_NAME
+from rag.governor import BACKGROUND, governor_lane
+from rag.metadata_db import get_metadata_db
+
+PRECOMPUTED_ANSWERS = os.getenv("PRECOMPUTED_ANSWERS", "true").strip().lower() in {"1", "true", "yes", "on"}
+PRECOMPUTE_TOP_N = int(os.getenv("PRECOMPUTE_TOP_N", "50"))
+PRECOMPUTE_DAYS = int(os.getenv("PRECOMPUTE_DAYS", "30"))
+# Cosine similarity above which two phrasings count as the same question
+PRECOMPUTE_DEDUP_SIMILARITY = float(os.getenv("PRECOMPUTE_DEDUP_SIMILARITY", "0.92"))
+# Answers below this reranked confidence are not stored; the neutral 0.5
+# (no cross-encoder and no fitted rescorer calibration) passes
+PRECOMPUTE_MIN_CONFIDENCE = float(os.getenv("PRECOMPUTE_MIN_CONFIDENCE", "0.5"))
+# Regenerate the answers at the end of every rag/ingest.py run
+PRECOMPUTE_ON_INGEST = os.getenv("PRECOMPUTE_ON_INGEST", "true").strip().lower() in {"1", "true", "yes", "on"}
+# Serving processes pick up a refresh written by another process within this interval
+PRECOMPUTED_RELOAD_SECONDS = float(os.getenv("PRECOMPUTED_RELOAD_SECONDS", "300"))
+# The refresh runs as this client so its own queries stay out of the mined history
+PRECOMPUTE_CLIENT = "batch"
+# query_history rows logged with these tools are not questions (thread topics); hits on
+# the stored answers and glossary definitions are logged too and keep counting
+NON_QUESTION_TOOLS = ("thread_generation",)
+
+# Answers that decline ("I don't know", as the prompt asks when the context lacks it)
+_NON_ANSWER_RE = re.compile(
+    r"\b(?:i\s+don'?t\s+know|i\s+do\s+not\s+know|i'?m\s+not\s+sure|i\s+am\s+not\s+sure"
+    r"|(?:not|isn'?t|aren'?t)\s+(?:found|mentioned|covered|provided)\s+in\s+the\s+(?:context|sources|provided)"
+    r"|(?:context|sources)\s+(?:does|do)\s+not\s+(?:contain|provide|mention|include)"
+    r"|(?:cannot|can'?t|unable\s+to)\s+(?:find|answer|determine))\b"
+)
+
+
+def is_non_answer(response: str) -> bool:
+    """Whether a generated answer declines instead of answering; checked in its opening."""
+    return bool(_NON_ANSWER_RE.search(" ".join(response.lower().replace("\u2019", "'").split()[:40])))
+
+
+@dataclass
+class QuestionCluster:
+    """Phrasings of one question with their combined frequency."""
+    question: str
+    variants: List[str] = field(default_factory=list)
+    frequency: int = 0
+
+
+def mine_top_questions(
+    top_n: int = PRECOMPUTE_TOP_N,
+    days: Optional[int] = PRECOMPUTE_DAYS,
+    similarity: float = PRECOMPUTE_DEDUP_SIMILARITY
+) -> List[QuestionCluster]:
+    """
+    The `top_n` most frequent questions of the last `days` days.
+
+    Query texts are grouped by normalized form, then the most frequent forms
+    are embedded (one request) and merged greedily into clusters whose
+    representative, the most frequent phrasing, is at least `similarity`
+    cosine-similar.
+    """
+    from rag.query import RATE_LIMIT_EXEMPT_CLIENTS, embed_queries, normalize_question
+
+    counts: Dict[str, int] = {}
+    history = get_metadata_db().get_question_counts(days, (PRECOMPUTE_CLIENT, *RATE_LIMIT_EXEMPT_CLIENTS), NON_QUESTION_TOOLS)
+    for row in history:
+        key = normalize_question(row["query_text"])
+        if key:
+            counts[key] = counts.get(key, 0) + row["count"]
+    # Clusters absorb phrasings, so look past the top N forms
+    forms = sorted(counts, key=lambda q: counts[q], reverse=True)[:top_n * 4]
+    if not forms:
+        return []
+
+    vectors = np.asarray(embed_queries(forms), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    clusters: List[QuestionCluster] = []
+    centers: List[np.ndarray] = []
+    for form, vector in zip(forms, vectors):
+        if centers:
+            scores = np.stack(centers) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= similarity:
+                clusters[best].variants.append(form)
+                clusters[best].frequency += counts[form]
+                continue
+        clusters.append(QuestionCluster(question=form, variants=[form], frequency=counts[form]))
+        centers.append(vector)
+    clusters.sort(key=lambda c: c.frequency, reverse=True)
+    return clusters[:top_n]
+
+
+def answer_cluster(cluster: QuestionCluster, min_confidence: float = PRECOMPUTE_MIN_CONFIDENCE) -> Optional[Dict]:
+    """
+    Answer a cluster's question with the full pipeline at FULL service level,
+    or None when the answer fails vetting: an error, a clarifying question,
+    no sources, confidence below `min_confidence`, or a non-answer such as
+    "I don't know" (neutral confidences pass `min_confidence`).
+    """
+    from rag.query import generate_answer, prepare_query
+    from rag.service_level import ServiceLevel
+
+    prepared = prepare_query(
+        cluster.question,
+        user_id="precompute",
+        client_type=PRECOMPUTE_CLIENT,
+        service_level=ServiceLevel.FULL,
+        use_precomputed=False,
+    )
+    if isinstance(prepared, dict):
+        # Refused, clarified or answered without generation
+        return None
+    result = generate_answer(prepared)
+    confidence = result.get("confidence_score") or 0.0
+    if not result.get("success") or result.get("error") or not result.get("sources") or confidence < min_confidence:
+        return None
+    if is_non_answer(result.get("response", "")):
+        return None
+    return {
+        "question_key": cluster.question,
+        "question": cluster.question,
+        "variants": cluster.variants,
+        "frequency": cluster.frequency,
+        "response": result["response"],
+        "sources": result["sources"],
+        "confidence_score": confidence,
+    }
+
+
+def refresh_precomputed_answers(top_n: int = PRECOMPUTE_TOP_N, days: Optional[int] = PRECOMPUTE_DAYS) -> Dict:
+    """
+    Mine the top questions, answer them as background OpenAI traffic and
+    replace the stored set, tagged with the current collection version.
+
+    Returns:
+        Counts of mined clusters and stored answers
+    """
+    started = time.time()
+    db = get_metadata_db()
+    version = db.get_collection_version(QDRANT_COLLECTION_NAME)
+    with governor_lane(BACKGROUND):
+        clusters = mine_top_questions(top_n, days)
+        answers = []
+        for cluster in clusters:
+            try:
+                answer = answer_cluster(cluster)
+            except Exception as exc:
+                print(f"⚠️ Could not precompute an answer for {cluster.question!r}: {exc}")
+                continue
+            if answer is not None:
+                answers.append({**answer, "collection_version": version})
+    db.replace_precomputed_answers(answers)
+    get_precomputed_answers().reload()
+    return {
+        "clusters": len(clusters),
+        "stored": len(answers),
+        "collection_version": version,
+        "seconds": round(time.time() - started, 1),
+    }
+
+
+class PrecomputedAnswers:
+    """
+    In-memory index of the stored answers by every normalized phrasing of
+    their question. Answers generated against another collection version
+    are left out until the next refresh.
+    """
+
+    def __init__(self):
+        self._answers: Dict[str, Dict] = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len({id(answer) for answer in self._answers.values()})
+
+    def reload(self) -> int:
+        """Load the stored set; returns the number of answers served."""
+        version = get_metadata_db().get_collection_version(QDRANT_COLLECTION_NAME)
+        answers: Dict[str, Dict] = {}
+        for row in get_metadata_db().get_precomputed_answers():
+            if row["collection_version"] != version:
+                continue
+            answer = {
+                "question": row["question"],
+                "response": row["response"],
+                "sources": row["sources"],
+                "confidence_score": row["confidence_score"],
+            }
+            for key in (row["question_key"], *row["variants"]):
+                answers.setdefault(key, answer)
+        with self._lock:
+            self._answers = answers
+            self._loaded_at = time.time()
+        return len(self)
+
+    def lookup(self, question_key: str) -> Optional[Dict]:
+        """The answer for a normalized question (see rag.query.normalize_question)."""
+        if time.time() - self._loaded_at > PRECOMPUTED_RELOAD_SECONDS:
+            with self._lock:
+                stale = time.time() - self._loaded_at > PRECOMPUTED_RELOAD_SECONDS
+                if stale:
+                    # Claim the reload so concurrent lookups keep using the current set
+                    self._loaded_at = time.time()
+            if stale:
+                try:
+                    self.reload()
+                except Exception as exc:
+                    print(f"⚠️ Could not reload precomputed answers: {exc}")
+        return self._answers.get(question_key)
+
+
+# Global index
+_precomputed: Optional[PrecomputedAnswers] = None
+_precomputed_lock = threading.Lock()
+
+
+def get_precomputed_answers() -> PrecomputedAnswers:
+    """Get or create the global index; it loads on the first lookup (or warm_precomputed_answers)."""
+    global _precomputed
+    if _precomputed is None:
+        with _precomputed_lock:
+            if _precomputed is None:
+                _precomputed = PrecomputedAnswers()
+    return _precomputed
+
+
+def warm_precomputed_answers() -> int:
+    """Load the stored set at startup so the first requests already hit it."""
+    return get_precomputed_answers().reload()
+
+
+def coverage_report(days: Optional[int] = None) -> Dict:
+    """Share of historical questions (no batch jobs or thread topics) the served set answers."""
+    from rag.query import RATE_LIMIT_EXEMPT_CLIENTS, normalize_question
+
+    index = get_precomputed_answers()
+    index.reload()
+    total = covered = 0
+    history = get_metadata_db().get_question_counts(days, (PRECOMPUTE_CLIENT, *RATE_LIMIT_EXEMPT_CLIENTS), NON_QUESTION_TOOLS)
+    for row in history:
+        total += row["count"]
+        if index.lookup(normalize_question(row["query_text"])) is not None:
+            covered += row["count"]
+    return {
+        "answers": len(index),
+        "queries": total,
+        "covered": covered,
+        "hit_rate": round(covered / total, 4) if total else 0.0,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Precomputed answers for the most frequent questions.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    refresh = commands.add_parser("refresh", help="Mine the top questions and regenerate their answers")
+    refresh.add_argument("--top", type=int, default=PRECOMPUTE_TOP_N)
+    refresh.add_argument("--days", type=int, default=PRECOMPUTE_DAYS, help="History window (0 = all)")
+    report = commands.add_parser("report", help="Share of historical traffic the stored answers cover")
+    report.add_argument("--days", type=int, default=7, help="History window (0 = all)")
+    args = parser.parse_args(argv)
+
+    if args.command == "refresh":
+        summary = refresh_precomputed_answers(args.top, args.days or None)
+        print(f"✅ Stored {summary['stored']} of {summary['clusters']} top questions "
+              f"(collection version {summary['collection_version']}, {summary['seconds']}s)")
+        return
+    summary = coverage_report(args.days or None)
+    print(f"📊 {summary['answers']} precomputed answers cover {summary['covered']} of {summary['queries']} "
+          f"queries ({summary['hit_rate']:.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,10 @@ import os
 import sys
 import math
 import time
-from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_core.documents import Document
-from langchain_community.vectorstores.qdrant import Qdrant
-from qdrant_client import QdrantClient
 
 # Import our new modules
 try:
@@ -22,78 +20,226 @@ except Exception:
     pass
 
 from rag.rerank import rerank_documents, is_rerank_enabled
-from rag.guardrails import get_guardrails, ToolCategory
+from rag.rescore import RetrievalSignals, glossary_hit_rates
+from rag.sparse_index import get_sparse_index, reciprocal_rank_fusion
+from rag.guardrails import get_guardrails, ToolCategory, PromptCategory
 from rag.metadata_db import get_metadata_db
-from rag.utils.glossary import augment_query_for_retrieval, find_glossary_expansions
+from rag.utils.glossary import (
+    augment_query_for_retrieval, find_glossary_expansions, find_glossary_definition, glossary_augmentation_terms,
+)
+from rag.glossary_vectors import get_glossary_vectors
+from rag.definitions import estimated_llm_cost, get_definition_store
+from rag.precompute import PRECOMPUTED_ANSWERS, get_precomputed_answers
+from rag.batching import MICRO_BATCHING, batched_embed, batched_search
+from rag.service_level import ServiceLevel, LEVEL_SETTINGS, get_service_level_controller
+from rag.cache import TTLCache
+from rag.metrics import get_metrics
+from rag.clients import get_chat_model, get_embeddings, get_qdrant_client, get_vectorstore
+from rag.deadline import (
+    Deadline, DeadlineExceeded, check_deadline, stage_timeout,
+    RETRIEVAL_TIMEOUT_SECONDS, LLM_TIMEOUT_SECONDS,
+)
 from observability import get_callback_handler
 
 load_dotenv()
 
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-QDRANT_COLLECTION_NAME = os.getenv("QDRANT_COLLECTION_NAME", "layerzero-rag")
-
 def check_qdrant_ready() -> Dict[str, any]:
     """Lightweight readiness check for Qdrant connectivity."""
     try:
-        client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
+        client = get_qdrant_client()
         # Simple call to verify connectivity
         client.get_collections()
         return {"ok": True}
     except Exception as exc:
         return {"ok": False, "error": str(exc)}
 
-# Cache the embeddings client and vectorstore once. get_relevant_documents is
-# called once per query variant, so rebuilding these per call meant re-creating
-# the OpenAI embeddings client and Qdrant connection several times per question.
-_VECTORSTORE = None
+# Answers served to degraded service levels, keyed by normalized question
+_ANSWER_CACHE = TTLCache(
+    maxsize=int(os.getenv("ANSWER_CACHE_SIZE", "2048")),
+    ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600")),
+)
 
+# Query embeddings depend only on the text, so any caller may reuse them
+_EMBEDDING_CACHE = TTLCache(
+    maxsize=int(os.getenv("EMBEDDING_CACHE_SIZE", "4096")),
+    ttl_seconds=float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "86400")),
+)
+# Search results per query variant; short-lived so a re-ingest shows up quickly
+_RETRIEVAL_CACHE = TTLCache(
+    maxsize=int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024")),
+    ttl_seconds=float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "300")),
+)
 
-def _get_vectorstore() -> "Qdrant":
-    global _VECTORSTORE
-    if _VECTORSTORE is None:
-        embeddings = OpenAIEmbeddings(
-            model="text-embedding-3-large",
-            dimensions=3072
-        )
-        qdrant_client = QdrantClient(
-            url=QDRANT_URL,
-            api_key=QDRANT_API_KEY
-        )
-        _VECTORSTORE = Qdrant(
-            client=qdrant_client,
-            collection_name=QDRANT_COLLECTION_NAME,
-            embeddings=embeddings,
-        )
-    return _VECTORSTORE
+# Confidence gate before generation: answers scoring below the guardrail threshold
+# get the clarifier without an LLM call; those within CONFIDENCE_BORDERLINE_MARGIN
+# above it are answered by BORDERLINE_LLM_MODEL (0 disables the band). Off by
+# default: turn it on with a cross-encoder or a fitted rescorer calibration
+CONFIDENCE_GATE = os.getenv("CONFIDENCE_GATE", "false").strip().lower() in {"1", "true", "yes", "on"}
+CONFIDENCE_BORDERLINE_MARGIN = float(os.getenv("CONFIDENCE_BORDERLINE_MARGIN", "0"))
+BORDERLINE_LLM_MODEL = os.getenv("BORDERLINE_LLM_MODEL", "gpt-4o-mini")
+
+# Fuse dense search with the BM25 index built by rag/ingest.py, when one exists
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "true").strip().lower() in {"1", "true", "yes", "on"}
+SPARSE_RRF_K = int(os.getenv("SPARSE_RRF_K", "60"))
+# Glossary variants composed from the question and stored term embeddings (rag/glossary_vectors.py)
+COMPOSED_VARIANT_EMBEDDINGS = os.getenv("COMPOSED_VARIANT_EMBEDDINGS", "true").strip().lower() in {"1", "true", "yes", "on"}
+
+# Operator tools (e.g. generate/batch.py, the token-protected server/webhook.py) are
+# paced by the OpenAI governor and the job queue, not per-user limits
+RATE_LIMIT_EXEMPT_CLIENTS = {
+    c.strip() for c in os.getenv("RATE_LIMIT_EXEMPT_CLIENTS", "batch,webhook").split(",") if c.strip()
+}
 
 
-def get_relevant_documents(query: str, k: int = 8, use_mmr: bool = True) -> List[Document]:
+def normalize_question(question: str) -> str:
+    """Normalize a question for cache lookups: lowercase, collapse whitespace, drop trailing punctuation."""
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+def get_relevant_documents(
+    query: str,
+    k: int = 8,
+    use_mmr: bool = True,
+    deadline: Optional[Deadline] = None,
+    embedding: Optional[List[float]] = None
+) -> List[Document]:
     """
     Get relevant documents from vector store with enhanced retrieval.
 
     Args:
         query: User query
         k: Number of documents to retrieve (increased for reranking)
+        use_mmr: Use Maximal Marginal Relevance for diversity
+        deadline: Optional request deadline; bounds the Qdrant search timeout
+        embedding: Precomputed query embedding, e.g. from a batched call
 
     Returns:
         List of relevant documents
+
+    Raises:
+        DeadlineExceeded: The deadline passed before or between calls
+    """
+    return [doc for doc, _score in get_scored_documents(query, k, use_mmr, deadline, embedding)]
+
+
+def get_scored_documents(
+    query: str,
+    k: int = 8,
+    use_mmr: bool = True,
+    deadline: Optional[Deadline] = None,
+    embedding: Optional[List[float]] = None
+) -> List[Tuple[Document, float]]:
+    """
+    Like get_relevant_documents, with the vector similarity Qdrant returns for each document.
+
+    Raises:
+        DeadlineExceeded: The deadline passed before or between calls
     """
-    qdrant_vectorstore = _get_vectorstore()
+    # Shared with every other caller in the process (see rag/clients.py)
+    qdrant_vectorstore = get_vectorstore()
+
+    if embedding is None:
+        embedding = embed_queries([query], deadline)[0]
+    search_timeout = stage_timeout(deadline, "retrieval", RETRIEVAL_TIMEOUT_SECONDS)
+    # Qdrant takes whole seconds
+    search_timeout = max(1, int(math.ceil(search_timeout)))
 
+    if MICRO_BATCHING:
+        # Sent with concurrent requests' searches in one search_batch call
+        return batched_search(embedding, k, use_mmr, fetch_k=max(32, k * 6), lambda_mult=0.55, timeout=search_timeout)
     if use_mmr:
         # Maximal Marginal Relevance for diversity
-        retriever = qdrant_vectorstore.as_retriever(
-            search_type="mmr",
-            search_kwargs={
-                "k": k,
-                "fetch_k": max(32, k * 6),
-                "lambda_mult": 0.55,
-            },
+        return qdrant_vectorstore.max_marginal_relevance_search_with_score_by_vector(
+            embedding,
+            k=k,
+            fetch_k=max(32, k * 6),
+            lambda_mult=0.55,
+            timeout=search_timeout,
         )
-    else:
-        retriever = qdrant_vectorstore.as_retriever(search_kwargs={"k": k})
-    return retriever.invoke(query)
+    return qdrant_vectorstore.similarity_search_with_score_by_vector(embedding, k=k, timeout=search_timeout)
+
+
+def retrieval_cache_stats() -> Dict[str, float]:
+    """Hit rates of the per-process embedding and retrieval caches."""
+    return {
+        "embedding_cache_hit_rate": round(_EMBEDDING_CACHE.hit_rate, 3),
+        "retrieval_cache_hit_rate": round(_RETRIEVAL_CACHE.hit_rate, 3),
+    }
+
+
+def embed_queries(queries: List[str], deadline: Optional[Deadline] = None) -> List[List[float]]:
+    """
+    Embed query texts, reusing cached embeddings and sending the rest in one request.
+
+    Raises:
+        DeadlineExceeded: The deadline passed before the request
+    """
+    embeddings = [_EMBEDDING_CACHE.get(q) for q in queries]
+    missing = [q for q, e in zip(queries, embeddings) if e is None]
+    if missing:
+        check_deadline(deadline, "embedding")
+        if MICRO_BATCHING:
+            # Joined with concurrent requests' texts in one embed_documents call. Without a
+            # deadline there is no cap, as unbatched: background callers (precompute mining)
+            # yield to interactive traffic and may wait well past RETRIEVAL_TIMEOUT_SECONDS
+            timeout = stage_timeout(deadline, "embedding", RETRIEVAL_TIMEOUT_SECONDS) if deadline is not None else None
+            vectors = batched_embed(missing, timeout)
+        else:
+            vectors = get_embeddings().embed_documents(missing)
+        fresh = dict(zip(missing, vectors))
+        for q, e in fresh.items():
+            _EMBEDDING_CACHE.set(q, e)
+        embeddings = [e if e is not None else fresh[q] for q, e in zip(queries, embeddings)]
+    return embeddings
+
+
+def build_query_variants(question: str) -> List[Tuple[str, List[str]]]:
+    """
+    Query variants of a question with the glossary terms each one appends:
+    the question itself, the synonym-augmented question, and the question
+    plus each canonical glossary term.
+    """
+    base_q = question.strip()
+    variants: List[Tuple[str, List[str]]] = [(base_q, [])] if base_q else []
+    augmented_question = augment_query_for_retrieval(question)
+    if augmented_question and augmented_question != base_q:
+        variants.append((augmented_question, glossary_augmentation_terms(question)))
+    expansions, _matched = find_glossary_expansions(question)
+    for canonical in expansions.keys():
+        variant = f"{base_q} {canonical}".strip()
+        if variant and all(variant != text for text, _ in variants):
+            variants.append((variant, [canonical]))
+    return variants
+
+
+def embed_query_variants(
+    query_variants: List[Tuple[str, List[str]]],
+    deadline: Optional[Deadline] = None
+) -> List[List[float]]:
+    """
+    Embed query variants, composing the glossary variants from the
+    question's embedding and the stored term embeddings instead of sending
+    them to the embeddings API.
+
+    Args:
+        query_variants: (text, appended glossary terms) pairs; the first is the question
+        deadline: Optional request deadline
+
+    Raises:
+        DeadlineExceeded: The deadline passed before the request
+    """
+    vectors = get_glossary_vectors() if COMPOSED_VARIANT_EMBEDDINGS and len(query_variants) > 1 else None
+    composed = {
+        i for i, (_text, terms) in enumerate(query_variants[1:], 1)
+        if vectors is not None and vectors.covers(terms)
+    }
+    texts = [text for i, (text, _terms) in enumerate(query_variants) if i not in composed]
+    embedded = iter(embed_queries(texts, deadline) if texts else [])
+    embeddings = [None if i in composed else next(embedded) for i in range(len(query_variants))]
+    for i in composed:
+        embeddings[i] = vectors.compose(embeddings[0], query_variants[i][1])
+    if composed:
+        get_metrics().inc("variant_embeddings_composed", len(composed))
+    return embeddings
 
 
 def _build_clarifying_question(
@@ -141,7 +287,12 @@ def _build_clarifying_question(
         return f"I need a bit more detail to help. Do you mean: {options}?"
     return "Could you clarify what you want to know specifically? For example: protocol overview, endpoints, or DVN."
 
-def build_metaprompt(question: str, docs: List[Document], sources: List[Dict]) -> str:
+def build_metaprompt(
+    question: str,
+    docs: List[Document],
+    sources: List[Dict],
+    max_context_chars: Optional[int] = None
+) -> str:
     """
     Build enhanced metaprompt with source information.
     
@@ -149,17 +300,26 @@ def build_metaprompt(question: str, docs: List[Document], sources: List[Dict]) -
         question: User question
         docs: Retrieved documents
         sources: Source metadata with confidence scores
+        max_context_chars: Optional budget for the combined context; sources
+            beyond it are truncated or dropped
         
     Returns:
         Formatted prompt
     """
     context_parts = []
+    remaining = max_context_chars
     
     for i, (doc, source) in enumerate(zip(docs, sources)):
         confidence = source.get("confidence", 0.0)
         source_name = source.get("source", "Unknown")
+        content = doc.page_content
+        if remaining is not None:
+            if remaining <= 0:
+                break
+            content = content[:remaining]
+            remaining -= len(content)
         
-        context_parts.append(f"[Source {i+1}: {source_name} (confidence: {confidence:.2f})]\n{doc.page_content}")
+        context_parts.append(f"[Source {i+1}: {source_name} (confidence: {confidence:.2f})]\n{content}")
     
     context = "\n\n".join(context_parts)
     
@@ -176,37 +336,412 @@ Question: {question}
 
 Answer:"""
 
-def query_rag(
+def _overloaded_result(response_id: str, level: ServiceLevel) -> Dict[str, any]:
+    return {
+        "response": "The assistant is under heavy load right now. Please try again in a minute.",
+        "success": False,
+        "error": "overloaded",
+        "response_id": response_id,
+        "service_level": level.value
+    }
+
+def _answer_from_degraded_sources(
+    question: str,
+    level: ServiceLevel,
+    response_id: str
+) -> Optional[Dict[str, any]]:
+    """
+    Serve a question without retrieval or generation: from the answer cache
+    for degraded levels and, at MINIMAL, from the glossary.
+    Returns None when the pipeline should run.
+    """
+    settings = LEVEL_SETTINGS[level]
+    if settings.use_answer_cache:
+        cached = _ANSWER_CACHE.get(normalize_question(question))
+        if cached is not None:
+            get_metrics().inc("answer_cache_hits", level=level.value)
+            return {**cached, "response_id": response_id, "service_level": level.value, "cached": True}
+    
+    if level is not ServiceLevel.MINIMAL:
+        return None
+    
+    definition = find_glossary_definition(question)
+    if definition is not None:
+        return {
+            "response": f"{definition.term}: {definition.definition}",
+            "success": True,
+            "response_id": response_id,
+            "confidence_score": 1.0,
+            "sources": [{
+                "source": definition.source,
+                "source_type": "text",
+                "doc_id": "glossary",
+                "confidence": 1.0,
+                "rank": 1
+            }],
+            "service_level": level.value
+        }
+    return _overloaded_result(response_id, level)
+
+def _answer_from_definitions(
+    question: str,
+    level: ServiceLevel,
+    response_id: str,
+    start_time: float
+) -> Optional[Dict[str, any]]:
+    """
+    Fast path for "What is X?" about a glossary term: the pre-rendered
+    definition with its citation, skipping retrieval and generation.
+    Returns None when the question has more to it than one known term.
+    """
+    entry, term = get_definition_store().answer(question)
+    if entry is None:
+        get_metrics().inc("definition_fast_path", result="not_definitional" if term is None else "unknown_term")
+        return None
+    settings = LEVEL_SETTINGS[level]
+    get_metrics().inc("definition_fast_path", result="hit")
+    get_metrics().inc("llm_calls_avoided", reason="glossary_definition")
+    get_metrics().inc("llm_spend_avoided_usd", estimated_llm_cost(settings.llm_model, settings.max_context_chars))
+    return {
+        "response": entry["response"],
+        "success": True,
+        "response_id": response_id,
+        "confidence_score": 1.0,
+        "sources": [dict(source) for source in entry["sources"]],
+        "processing_time_ms": int((time.time() - start_time) * 1000),
+        "service_level": level.value
+    }
+
+def _log_shortcut_answer(
+    question: str,
+    user_id: Optional[str],
+    client_type: str,
+    result: Dict[str, any],
+    tool_name: str
+) -> None:
+    """
+    Record a question answered without the pipeline, so it keeps counting
+    toward the history rag/precompute.py and rag/suggest.py mine.
+    """
+    try:
+        metadata_db = get_metadata_db()
+        query_id = metadata_db.log_query(
+            query_text=question,
+            user_id=user_id,
+            client_type=client_type,
+            confidence_score=result.get("confidence_score"),
+            response_length=len(result.get("response", "")),
+            sources_used=result.get("sources", []),
+            processing_time_ms=result.get("processing_time_ms", 0)
+        )
+        metadata_db.log_tool_usage(query_id=query_id, tool_name=tool_name, tool_category="rag_query")
+    except Exception as exc:
+        print(f"⚠️ Could not log {tool_name}: {exc}")
+
+def _answer_from_precomputed(
+    question: str,
+    level: ServiceLevel,
+    response_id: str,
+    start_time: float
+) -> Optional[Dict[str, any]]:
+    """A stored answer for one of the most frequent questions (rag/precompute.py), or None."""
+    answer = get_precomputed_answers().lookup(normalize_question(question))
+    if answer is None:
+        get_metrics().inc("precomputed_answers", result="miss")
+        return None
+    settings = LEVEL_SETTINGS[level]
+    get_metrics().inc("precomputed_answers", result="hit")
+    get_metrics().inc("llm_calls_avoided", reason="precomputed_answer")
+    get_metrics().inc("llm_spend_avoided_usd", estimated_llm_cost(settings.llm_model, settings.max_context_chars))
+    return {
+        "response": answer["response"],
+        "success": True,
+        "response_id": response_id,
+        "confidence_score": answer["confidence_score"],
+        "sources": [dict(source) for source in answer["sources"]],
+        "processing_time_ms": int((time.time() - start_time) * 1000),
+        "service_level": level.value,
+        "precomputed": True
+    }
+
+@dataclass
+class RetrievedCandidates:
+    """Merged retrieval results for a question, before reranking."""
+    augmented_question: str
+    expansions: Dict[str, any]
+    docs: List[Document]
+    signals: RetrievalSignals
+
+
+def retrieve_candidates(
+    question: str,
+    k: int = 4,
+    max_query_variants: int = 3,
+    total_candidates: Optional[int] = None,
+    deadline: Optional[Deadline] = None
+) -> RetrievedCandidates:
+    """
+    Retrieve and merge candidates for every query variant of a question.
+
+    Args:
+        question: User question
+        k: Number of documents the caller will keep after reranking
+        max_query_variants: Query variants to search (original, synonym-augmented, glossary terms)
+        total_candidates: Candidates to fetch across variants; default max(k * 6, 24)
+        deadline: Optional request deadline
+
+    Returns:
+        Candidates with per-document retrieval signals for reranking
+
+    Raises:
+        DeadlineExceeded: The deadline passed during embedding or search
+    """
+    # Augment query with domain synonyms/aliases for better recall
+    augmented_question = augment_query_for_retrieval(question)
+    expansions, _matched = find_glossary_expansions(question)
+
+    # Build multiple query variants: original, augmented, and canonical-term variants
+    base_q = question.strip()
+    all_variants = build_query_variants(question)
+    # The synonym-augmented query when there is one, else the question
+    augmented_variant = next((v for v in all_variants if v[0] == augmented_question), (base_q, []))
+
+    # Limit number of variants to control latency. Each variant is a separate
+    # embedding call + MMR search; PostHog traces showed the fan-out, not the
+    # gpt-4o call, drove most of the per-question latency. 3 keeps the base
+    # query, the synonym-augmented query, and the top glossary-canonical
+    # variant, which covers recall without the long tail of extra searches.
+    query_variants = all_variants[:max_query_variants]
+    if max_query_variants == 1:
+        # A single search: the synonym-augmented query covers the most recall
+        query_variants = [augmented_variant]
+
+    total_candidates = total_candidates or max(k * 6, 24)
+
+    # Hybrid retrieval: BM25 over the local sparse index matches exact terms
+    # (DVN, ULN, lzRead) that dense search handles inconsistently. When it
+    # finds the question's glossary terms, one dense search on the augmented
+    # question replaces the glossary variants and their embedding calls.
+    sparse_hits: List[Tuple[Document, float]] = []
+    sparse_index = get_sparse_index() if HYBRID_RETRIEVAL and query_variants else None
+    if sparse_index is not None:
+        glossary_terms = [str(t) for canonical, extras in expansions.items() for t in (canonical, *extras)]
+        sparse_hits = sparse_index.search(" ".join([base_q, *glossary_terms]), k=total_candidates)
+        if len(query_variants) > 1 and any(glossary_hit_rates([d for d, _ in sparse_hits[:3]], expansions)):
+            get_metrics().inc("dense_variants_skipped", len(query_variants) - 1)
+            query_variants = [augmented_variant]
+
+    # Retrieve for each variant and merge unique results, keeping each
+    # document's best similarity and how many rankings found it
+    combined_docs: List[Document] = []
+    similarities: List[float] = []
+    variant_hits: List[int] = []
+    seen_keys: Dict[tuple, int] = {}
+    rankings: List[List[tuple]] = []
+
+    def _merge(ranked: List[Tuple[Document, float]], similarity: Optional[float] = None) -> None:
+        ranking = []
+        for d, score in ranked:
+            doc_id = d.metadata.get("document_id") or d.metadata.get("doc_id") or d.metadata.get("source") or ""
+            chunk_idx = d.metadata.get("chunk_index") if d.metadata.get("chunk_index") is not None else -1
+            key = (doc_id, chunk_idx, d.page_content[:128])
+            if key in ranking:
+                continue
+            ranking.append(key)
+            score = float(score) if similarity is None else similarity
+            if key not in seen_keys:
+                seen_keys[key] = len(combined_docs)
+                combined_docs.append(d)
+                similarities.append(score)
+                variant_hits.append(1)
+            else:
+                i = seen_keys[key]
+                similarities[i] = max(similarities[i], score)
+                variant_hits[i] += 1
+        rankings.append(ranking)
+
+    per_variant_k = max(2, math.ceil(total_candidates / max(1, len(query_variants))))
+
+    # One embeddings request for the question and any uncached variants that
+    # cannot be composed from stored glossary term embeddings
+    variant_embeddings = embed_query_variants(query_variants, deadline) if query_variants else []
+
+    for (q, _terms), q_embedding in zip(query_variants, variant_embeddings):
+        variant_docs = _RETRIEVAL_CACHE.get((q, per_variant_k))
+        if variant_docs is None:
+            variant_docs = get_scored_documents(q, k=per_variant_k, deadline=deadline, embedding=q_embedding)
+            _RETRIEVAL_CACHE.set((q, per_variant_k), variant_docs)
+        _merge(variant_docs)
+
+    if sparse_hits:
+        # A lexical-only hit ranked below every dense result, so its vector
+        # similarity is at most the lowest one seen
+        _merge(sparse_hits, similarity=min(similarities, default=0.0))
+        fused = reciprocal_rank_fusion(rankings, k=SPARSE_RRF_K)[:total_candidates]
+        order = [seen_keys[key] for key, _score in fused]
+        combined_docs = [combined_docs[i] for i in order]
+        similarities = [similarities[i] for i in order]
+        variant_hits = [variant_hits[i] for i in order]
+    get_metrics().inc("retrievals", mode="hybrid" if sparse_hits else "dense")
+
+    docs = combined_docs
+
+    # Optional precision filter: if glossary expansions are present, prefer
+    # documents that explicitly mention the canonical term or its synonyms.
+    try:
+        if expansions:
+            term_filters: List[str] = []
+            for canonical, extras in expansions.items():
+                term_filters.append(str(canonical))
+                for s in list(extras):
+                    term_filters.append(str(s))
+            # Normalize and dedupe
+            norm_terms = []
+            seen_terms = set()
+            for t in term_filters:
+                t_norm = t.strip().lower()
+                if t_norm and t_norm not in seen_terms:
+                    seen_terms.add(t_norm)
+                    norm_terms.append(t_norm)
+
+            def _doc_mentions_any(d: Document) -> bool:
+                body = (d.page_content or "").lower()
+                title = str(d.metadata.get("title", "")).lower()
+                section = str(d.metadata.get("section_path", "")).lower()
+                source = str(d.metadata.get("source", "")).lower()
+                for term in norm_terms:
+                    if term in body or term in title or term in section or term in source:
+                        return True
+                return False
+
+            keep = [i for i, d in enumerate(docs) if _doc_mentions_any(d)]
+            if keep:
+                docs = [docs[i] for i in keep]
+                similarities = [similarities[i] for i in keep]
+                variant_hits = [variant_hits[i] for i in keep]
+    except Exception:
+        pass
+
+    n_rankings = max(1, len(rankings))
+    signals = RetrievalSignals(
+        similarities=similarities,
+        agreement=[hits / n_rankings for hits in variant_hits],
+        glossary_hits=glossary_hit_rates(docs, expansions),
+    )
+    return RetrievedCandidates(augmented_question, expansions, docs, signals)
+
+
+
+@dataclass
+class PreparedQuery:
+    """Retrieval output handed from prepare_query to generate_answer."""
+    question: str
+    user_id: Optional[str]
+    client_type: str
+    response_id: str
+    start_time: float
+    level: ServiceLevel
+    prompt_category: PromptCategory
+    expansions: Dict[str, any]
+    docs: List[Document]
+    context_docs: List[Document]
+    sources: List[Dict]
+    confidence: float
+    metaprompt: str
+    deadline: Optional[Deadline] = None
+    llm_model: Optional[str] = None  # overrides the service level's model
+
+def _failure_result(
+    e: Exception,
+    question: str,
+    user_id: Optional[str],
+    client_type: str,
+    response_id: str,
+    start_time: float,
+    level: ServiceLevel,
+    deadline: Optional[Deadline]
+) -> Dict[str, any]:
+    """Result for a pipeline stage that raised: a timeout, or a logged processing error."""
+    processing_time_ms = int((time.time() - start_time) * 1000)
+    timed_out = isinstance(e, DeadlineExceeded) or (deadline is not None and deadline.expired)
+    if timed_out:
+        # Abandoned or late: nobody is waiting for an answer, so skip logging it as one
+        get_metrics().inc("query_deadline_exceeded", stage=getattr(e, "stage", "generation"))
+        return {
+            "response": "The request took too long and was stopped. Please try again.",
+            "success": False,
+            "error": "timeout",
+            "response_id": response_id,
+            "processing_time_ms": processing_time_ms,
+            "service_level": level.value
+        }
+    
+    # Log error to metadata database
+    get_metadata_db().log_query(
+        query_text=question,
+        user_id=user_id,
+        client_type=client_type,
+        confidence_score=0.0,
+        response_length=0,
+        sources_used=[],
+        processing_time_ms=processing_time_ms
+    )
+    
+    return {
+        "response": f"An error occurred while processing your query: {str(e)}",
+        "success": False,
+        "error": "processing_error",
+        "response_id": response_id,
+        "processing_time_ms": processing_time_ms,
+        "service_level": level.value
+    }
+
+def prepare_query(
     question: str,
     user_id: Optional[str] = None,
     client_type: str = "web",
     k: int = 4,
-    confidence_threshold: float = 0.5
-) -> Dict[str, any]:
+    confidence_threshold: float = 0.5,
+    service_level: Optional[ServiceLevel] = None,
+    deadline: Optional[Deadline] = None,
+    gate_confidence: bool = True,
+    use_precomputed: bool = True,
+    use_shortcuts: bool = True
+) -> Union[PreparedQuery, Dict[str, any]]:
     """
-    Enhanced RAG query with guardrails, reranking, and metadata tracking.
+    First pipeline stage: guardrails, service level, retrieval, reranking and
+    prompt assembly. Everything up to, but not including, the LLM call.
     
     Args:
-        question: User question
-        user_id: Optional user identifier
-        client_type: Type of client (web, telegram, etc.)
-        k: Number of documents to return
-        confidence_threshold: Minimum confidence threshold
+        Same as query_rag, plus:
+        gate_confidence: With CONFIDENCE_GATE on, return the clarifying
+            question instead of a PreparedQuery when reranked confidence is
+            below the guardrail threshold, and pick the borderline model just
+            above it
+        use_precomputed: Serve a stored answer for a frequent question
+            (off when rag/precompute.py regenerates them)
+        use_shortcuts: Answer from the glossary definitions and, at degraded
+            levels, the answer cache instead of retrieving (off for callers
+            that need retrieved context rather than a Q&A answer, e.g. threads)
         
     Returns:
-        Dictionary with response, metadata, and guardrail info
+        A PreparedQuery to pass to generate_answer, or a finished result
+        dictionary when no generation is needed (guardrail refusal, cached or
+        degraded answer, clarifying question, error)
     """
     start_time = time.time()
     
     # Initialize components
     guardrails = get_guardrails()
-    metadata_db = get_metadata_db()
     
     # Generate response ID
     response_id = guardrails.generate_response_id(question, user_id or "anonymous")
     
     # Guardrail checks
-    rate_limit_allowed, rate_limit_msg = guardrails.check_rate_limit(user_id or "anonymous")
+    if client_type in RATE_LIMIT_EXEMPT_CLIENTS:
+        rate_limit_allowed, rate_limit_msg = True, ""
+    else:
+        rate_limit_allowed, rate_limit_msg = guardrails.check_rate_limit(user_id or "anonymous")
     if not rate_limit_allowed:
         return {
             "response": f"Rate limit exceeded: {rate_limit_msg}",
@@ -215,20 +750,19 @@ def query_rag(
             "response_id": response_id
         }
     
-    safety_allowed, safety_msg = guardrails.check_content_safety(question)
-    if not safety_allowed:
+    # Content safety, prompt classification and tool access in a single pass
+    verdict = guardrails.evaluate_prompt(question)
+    if not verdict.safe:
         return {
-            "response": f"Content safety check failed: {safety_msg}",
+            "response": f"Content safety check failed: {verdict.message}",
             "success": False,
             "error": "content_safety",
             "response_id": response_id
         }
     
-    # Classify prompt and validate tool access
-    prompt_category = guardrails.classify_prompt(question)
-    allowed_tools = guardrails.get_allowed_tools_for_prompt(question)
+    prompt_category = verdict.category
     
-    if ToolCategory.RAG_QUERY not in allowed_tools:
+    if ToolCategory.RAG_QUERY not in verdict.allowed_tools:
         return {
             "response": "This type of query is not allowed with the current tool set.",
             "success": False,
@@ -236,91 +770,52 @@ def query_rag(
             "response_id": response_id
         }
     
+    # Pick how much work this answer may cost under the current load
+    level_controller = get_service_level_controller()
+    level = service_level or level_controller.current_level()
+    settings = LEVEL_SETTINGS[level]
+    get_metrics().inc("requests_by_service_level", level=level.value)
+    
+    if use_shortcuts:
+        definition = _answer_from_definitions(question, level, response_id, start_time)
+        if definition is not None:
+            _log_shortcut_answer(question, user_id, client_type, definition, "glossary_definition")
+            return definition
+    
+    if use_precomputed and PRECOMPUTED_ANSWERS:
+        precomputed = _answer_from_precomputed(question, level, response_id, start_time)
+        if precomputed is not None:
+            _log_shortcut_answer(question, user_id, client_type, precomputed, "precomputed_answer")
+            return precomputed
+    
+    if use_shortcuts:
+        degraded = _answer_from_degraded_sources(question, level, response_id)
+        if degraded is not None:
+            return degraded
+    if settings.llm_model is None:
+        # No retrieval or generation at this level, shortcuts or not
+        return _overloaded_result(response_id, level)
+    
     try:
-        # Augment query with domain synonyms/aliases for better recall
-        augmented_question = augment_query_for_retrieval(question)
-        expansions, _matched = find_glossary_expansions(question)
-
-        # Build multiple query variants: original, augmented, and canonical-term variants
-        query_variants: List[str] = []
-        base_q = question.strip()
-        if base_q:
-            query_variants.append(base_q)
-        if augmented_question and augmented_question != base_q:
-            query_variants.append(augmented_question)
-        for canonical in expansions.keys():
-            variant = f"{base_q} {canonical}".strip()
-            if variant and variant not in query_variants:
-                query_variants.append(variant)
-
-        # Limit number of variants to control latency. Each variant is a separate
-        # embedding call + MMR search; PostHog traces showed the fan-out, not the
-        # gpt-4o call, drove most of the per-question latency. 3 keeps the base
-        # query, the synonym-augmented query, and the top glossary-canonical
-        # variant, which covers recall without the long tail of extra searches.
-        query_variants = query_variants[:3]
-
-        # Retrieve for each variant and merge unique results
-        combined_docs: List[Document] = []
-        seen_keys = set()
-
-        total_candidates = max(k * 6, 24)
-        per_variant_k = max(2, math.ceil(total_candidates / max(1, len(query_variants))))
-
-        for q in query_variants:
-            variant_docs = get_relevant_documents(q, k=per_variant_k)
-            for d in variant_docs:
-                doc_id = d.metadata.get("document_id") or d.metadata.get("doc_id") or d.metadata.get("source") or ""
-                chunk_idx = d.metadata.get("chunk_index") if d.metadata.get("chunk_index") is not None else -1
-                key = (doc_id, chunk_idx, d.page_content[:128])
-                if key not in seen_keys:
-                    seen_keys.add(key)
-                    combined_docs.append(d)
-
-        docs = combined_docs
-
-        # Optional precision filter: if glossary expansions are present, prefer
-        # documents that explicitly mention the canonical term or its synonyms.
-        try:
-            if expansions:
-                term_filters: List[str] = []
-                for canonical, extras in expansions.items():
-                    term_filters.append(str(canonical))
-                    for s in list(extras):
-                        term_filters.append(str(s))
-                # Normalize and dedupe
-                norm_terms = []
-                seen_terms = set()
-                for t in term_filters:
-                    t_norm = t.strip().lower()
-                    if t_norm and t_norm not in seen_terms:
-                        seen_terms.add(t_norm)
-                        norm_terms.append(t_norm)
-
-                def _doc_mentions_any(d: Document) -> bool:
-                    body = (d.page_content or "").lower()
-                    title = str(d.metadata.get("title", "")).lower()
-                    section = str(d.metadata.get("section_path", "")).lower()
-                    source = str(d.metadata.get("source", "")).lower()
-                    for term in norm_terms:
-                        if term in body or term in title or term in section or term in source:
-                            return True
-                    return False
-
-                filtered_docs = [d for d in docs if _doc_mentions_any(d)]
-                if filtered_docs:
-                    docs = filtered_docs
-        except Exception:
-            pass
-        
+        candidates = retrieve_candidates(
+            question,
+            k=k,
+            max_query_variants=settings.max_query_variants,
+            total_candidates=settings.total_candidates,
+            deadline=deadline,
+        )
+        augmented_question, expansions, docs = candidates.augmented_question, candidates.expansions, candidates.docs
+
         if not docs:
+            get_metrics().inc("llm_calls_avoided", reason="no_documents")
             clarifier = _build_clarifying_question(question, expansions, [])
             return {
                 "response": clarifier,
                 "success": True,
                 "response_id": response_id,
                 "confidence_score": 0.0,
-                "sources": []
+                "sources": [],
+                "service_level": level.value
             }
         
         # Rerank documents (or fallback if disabled)
@@ -329,18 +824,47 @@ def query_rag(
             documents=docs,
             top_k=k,
             confidence_threshold=confidence_threshold,
+            deadline=deadline,
+            signals=candidates.signals,
         )
         
         if not reranked_results:
+            get_metrics().inc("llm_calls_avoided", reason="no_confident_sources")
             clarifier = _build_clarifying_question(question, expansions, docs)
             return {
                 "response": clarifier,
                 "success": True,
                 "response_id": response_id,
                 "confidence_score": 0.0,
-                "sources": []
+                "sources": [],
+                "service_level": level.value
             }
         
+        overall_confidence = sum(result["confidence"] for result in reranked_results) / len(reranked_results)
+
+        # Decide before generation: an answer validate_response would reject
+        # is never generated
+        llm_model = None
+        if gate_confidence and CONFIDENCE_GATE:
+            min_confidence = guardrails.config.min_confidence_threshold
+            if overall_confidence < min_confidence:
+                get_metrics().inc("llm_calls_avoided", reason="low_confidence")
+                return {
+                    "response": _build_clarifying_question(question, expansions, docs),
+                    "success": True,
+                    "response_id": response_id,
+                    "confidence_score": overall_confidence,
+                    "sources": [],
+                    "processing_time_ms": int((time.time() - start_time) * 1000),
+                    "service_level": level.value
+                }
+            if (
+                overall_confidence < min_confidence + CONFIDENCE_BORDERLINE_MARGIN
+                and settings.llm_model not in (None, BORDERLINE_LLM_MODEL)
+            ):
+                llm_model = BORDERLINE_LLM_MODEL
+                get_metrics().inc("llm_calls_downgraded", reason="borderline_confidence", model=llm_model)
+
         # Extract documents and sources
         reranked_docs = [result["document"] for result in reranked_results]
         sources = [{
@@ -362,7 +886,7 @@ def query_rag(
                 combined_index[(did, cidx)] = d
 
             # For top N reranked docs, add neighbors if present
-            TOP_N_FOR_NEIGHBORS = min(2, len(reranked_docs))
+            TOP_N_FOR_NEIGHBORS = min(2, len(reranked_docs)) if settings.include_neighbors else 0
             added_keys = set()
             for top_doc in reranked_docs[:TOP_N_FOR_NEIGHBORS]:
                 did = top_doc.metadata.get("document_id") or top_doc.metadata.get("doc_id") or top_doc.metadata.get("source") or ""
@@ -378,12 +902,57 @@ def query_rag(
             # Best-effort; ignore neighbor augmentation failures
             context_docs = list(reranked_docs)
         
-        # Calculate overall confidence
-        overall_confidence = sum(result["confidence"] for result in reranked_results) / len(reranked_results)
-        
         # Build enhanced prompt with augmented context
-        metaprompt = build_metaprompt(question, context_docs, sources)
+        metaprompt = build_metaprompt(question, context_docs, sources, settings.max_context_chars)
+        
+        return PreparedQuery(
+            question=question,
+            user_id=user_id,
+            client_type=client_type,
+            response_id=response_id,
+            start_time=start_time,
+            level=level,
+            prompt_category=prompt_category,
+            expansions=expansions,
+            docs=docs,
+            context_docs=context_docs,
+            sources=sources,
+            confidence=overall_confidence,
+            metaprompt=metaprompt,
+            deadline=deadline,
+            llm_model=llm_model,
+        )
+        
+    except Exception as e:
+        return _failure_result(e, question, user_id, client_type, response_id, start_time, level, deadline)
+
+def generate_answer(
+    prepared: PreparedQuery,
+    on_token: Optional[Callable[[str], None]] = None
+) -> Dict[str, any]:
+    """
+    Second pipeline stage: the LLM call, validation, logging and caching.
+    
+    Args:
+        prepared: Output of prepare_query
+        on_token: Optional callback for streamed output. When given, the
+            answer is streamed and each raw (unsanitized) text chunk is passed
+            to it from the calling thread; the returned dictionary still holds
+            the final, sanitized and validated response
         
+    Returns:
+        Dictionary with response, metadata, guardrail info and service level
+    """
+    guardrails = get_guardrails()
+    metadata_db = get_metadata_db()
+    level_controller = get_service_level_controller()
+    question, user_id, client_type = prepared.question, prepared.user_id, prepared.client_type
+    response_id, start_time, deadline = prepared.response_id, prepared.start_time, prepared.deadline
+    level, settings = prepared.level, LEVEL_SETTINGS[prepared.level]
+    prompt_category, expansions, docs = prepared.prompt_category, prepared.expansions, prepared.docs
+    sources, overall_confidence, metaprompt = prepared.sources, prepared.confidence, prepared.metaprompt
+    
+    try:        
         # Generate response (captured by PostHog LLM observability when enabled)
         ph_handler = get_callback_handler(
             distinct_id=user_id or "anonymous",
@@ -391,11 +960,31 @@ def query_rag(
             client_type=client_type,
             confidence=round(overall_confidence, 3),
             num_sources=len(sources),
+            service_level=level.value,
         )
-        llm = ChatOpenAI(model="gpt-4o", temperature=0)
+        # The call is cut off when the request deadline passes; no retries,
+        # since a retried call would run past it anyway
+        llm_timeout = stage_timeout(deadline, "generation", LLM_TIMEOUT_SECONDS)
+        llm_model = prepared.llm_model or settings.llm_model
+        llm = get_chat_model(llm_model, temperature=0, max_retries=0 if deadline is not None else 2)
+        get_metrics().inc("llm_calls", model=llm_model)
         invoke_config = {"callbacks": [ph_handler]} if ph_handler else {}
-        llm_response = llm.invoke(metaprompt, config=invoke_config)
-        response_text = llm_response.content
+        llm_started = time.time()
+        if on_token is None:
+            llm_response = llm.invoke(metaprompt, config=invoke_config, timeout=llm_timeout)
+            response_text = llm_response.content
+        else:
+            chunks: List[str] = []
+            for chunk in llm.stream(metaprompt, config=invoke_config, timeout=llm_timeout):
+                # Leaving the loop closes the stream, so a cancelled request
+                # stops paying for tokens mid-answer
+                check_deadline(deadline, "generation")
+                if chunk.content:
+                    chunks.append(chunk.content)
+                    on_token(chunk.content)
+            response_text = "".join(chunks)
+        level_controller.record_llm_latency(time.time() - llm_started)
+        check_deadline(deadline, "validation")
         
         # Add source citations (disabled for user-facing output)
         citations = guardrails.format_source_citations(sources)
@@ -418,7 +1007,8 @@ def query_rag(
                     "success": True,
                     "response_id": response_id,
                     "confidence_score": overall_confidence,
-                    "sources": sources
+                    "sources": sources,
+                    "service_level": level.value
                 }
             return {
                 "response": f"Response validation failed: {validation_msg}",
@@ -448,6 +1038,15 @@ def query_rag(
             tool_category="rag_query"
         )
         
+        # Keep the answer around for degraded service levels
+        _ANSWER_CACHE.set(normalize_question(question), {
+            "response": sanitized_response,
+            "success": True,
+            "confidence_score": overall_confidence,
+            "sources": sources,
+            "prompt_category": prompt_category.value
+        })
+        
         return {
             "response": sanitized_response,
             "success": True,
@@ -455,30 +1054,56 @@ def query_rag(
             "confidence_score": overall_confidence,
             "sources": sources,
             "processing_time_ms": processing_time_ms,
-            "prompt_category": prompt_category.value
+            "prompt_category": prompt_category.value,
+            "service_level": level.value
         }
         
     except Exception as e:
-        processing_time_ms = int((time.time() - start_time) * 1000)
-        
-        # Log error to metadata database
-        metadata_db.log_query(
-            query_text=question,
-            user_id=user_id,
-            client_type=client_type,
-            confidence_score=0.0,
-            response_length=0,
-            sources_used=[],
-            processing_time_ms=processing_time_ms
-        )
+        return _failure_result(e, question, user_id, client_type, response_id, start_time, level, deadline)
+
+def query_rag(
+    question: str,
+    user_id: Optional[str] = None,
+    client_type: str = "web",
+    k: int = 4,
+    confidence_threshold: float = 0.5,
+    service_level: Optional[ServiceLevel] = None,
+    deadline: Optional[Deadline] = None,
+    on_token: Optional[Callable[[str], None]] = None
+) -> Dict[str, any]:
+    """
+    Enhanced RAG query with guardrails, reranking, and metadata tracking.
+    
+    Args:
+        question: User question
+        user_id: Optional user identifier
+        client_type: Type of client (web, telegram, etc.)
+        k: Number of documents to return
+        confidence_threshold: Minimum confidence threshold
+        service_level: Force a service level; by default it is chosen from
+            live load signals
+        deadline: Optional request deadline. Every stage checks it and sizes
+            its client timeouts from it; once it passes (or the caller
+            cancels it) the pipeline stops and returns a "timeout" error
+        on_token: Optional callback that receives the answer as it streams
+            (see generate_answer)
         
-        return {
-            "response": f"An error occurred while processing your query: {str(e)}",
-            "success": False,
-            "error": "processing_error",
-            "response_id": response_id,
-            "processing_time_ms": processing_time_ms
-        }
+    Returns:
+        Dictionary with response, metadata, guardrail info and the
+        service level the answer was produced at
+    """
+    prepared = prepare_query(
+        question,
+        user_id=user_id,
+        client_type=client_type,
+        k=k,
+        confidence_threshold=confidence_threshold,
+        service_level=service_level,
+        deadline=deadline,
+    )
+    if isinstance(prepared, dict):
+        return prepared
+    return generate_answer(prepared, on_token=on_token)
 
 # Backward compatibility function
 def ask_question(question: str) -> str:
@@ -0,0 +1,340 @@
+# rag/rate_limiter.py
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger("rate_limiter")
+
+
+@dataclass(frozen=True)
+class RateLimitRule:
+    """A single limit: at most `limit` events per `window_seconds`."""
+    name: str
+    limit: int
+    window_seconds: float
+
+
+@dataclass
+class RateLimitDecision:
+    """Outcome of a rate limit check."""
+    allowed: bool
+    rule: Optional[RateLimitRule] = None
+    retry_after: float = 0.0
+
+
+def _advance_window(
+    rule: RateLimitRule, start: float, prev: int, cur: int, now: float, cost: int
+) -> Tuple[float, int, int, Optional[float]]:
+    """
+    Roll one rule's window forward to `now` and test whether `cost` more
+    events fit.
+
+    Returns:
+        (start, prev, cur, retry_after) with the rolled-forward window;
+        `retry_after` is None when the events fit, else seconds to wait.
+    """
+    window = rule.window_seconds
+    elapsed = now - start
+    if elapsed >= window:
+        # Roll forward; after two or more windows the previous window is
+        # empty as well.
+        windows_passed = int(elapsed // window)
+        prev = cur if windows_passed == 1 else 0
+        cur = 0
+        start += windows_passed * window
+        elapsed = now - start
+    estimate = prev * (1.0 - elapsed / window) + cur
+    if estimate + cost <= rule.limit:
+        return start, prev, cur, None
+    if cur + cost > rule.limit:
+        # The current window alone is full.
+        return start, prev, cur, window - elapsed
+    # Enough of the previous window has to age out.
+    excess = estimate + cost - rule.limit
+    return start, prev, cur, window * excess / prev
+
+
+class SlidingWindowRateLimiter:
+    """
+    Sliding-window counter rate limiter.
+
+    Each rule keeps two counters per key (current and previous fixed window)
+    and estimates the number of events in the trailing window as
+    ``prev * (1 - elapsed / window) + cur``. A check is O(1) regardless of how
+    many requests a key has made, and state is a handful of numbers per key.
+
+    Keys are kept in LRU order; keys idle for two of their longest windows
+    carry no information and are evicted incrementally on each check, and the
+    table never grows beyond `max_entries`. All access is serialized by a
+    lock, and a check never blocks on I/O, so it is safe to call from
+    executor threads and from coroutines alike.
+    """
+
+    # Idle keys evicted per check; keeps eviction cost amortized O(1).
+    EVICTIONS_PER_CHECK = 8
+
+    def __init__(
+        self,
+        rules: Sequence[RateLimitRule],
+        max_entries: int = 250_000,
+        idle_ttl_seconds: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if not rules:
+            raise ValueError("At least one rate limit rule is required")
+        self.rules: List[RateLimitRule] = list(rules)
+        self.max_entries = max_entries
+        self.idle_ttl_seconds = (
+            idle_ttl_seconds
+            if idle_ttl_seconds is not None
+            else 2 * max(rule.window_seconds for rule in self.rules)
+        )
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> [last_seen, start_0, prev_0, cur_0, start_1, prev_1, cur_1, ...]
+        # i.e. per rule, the start of the current fixed window and the event
+        # counts of the current and previous windows. A flat list keeps the
+        # per-key footprint to a couple hundred bytes.
+        self._states: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def _evict(self, now: float) -> None:
+        states = self._states
+        for _ in range(self.EVICTIONS_PER_CHECK):
+            if not states:
+                return
+            key, state = next(iter(states.items()))
+            if now - state[0] < self.idle_ttl_seconds:
+                return
+            del states[key]
+        while len(states) > self.max_entries:
+            states.popitem(last=False)
+
+    def check(self, key: str, cost: int = 1) -> RateLimitDecision:
+        """
+        Record `cost` events for `key` if every rule allows it.
+
+        Args:
+            key: Rate limit key (user id, IP, ...)
+            cost: Number of events this call represents
+
+        Returns:
+            RateLimitDecision; on rejection, `rule` is the violated rule and
+            `retry_after` an estimate in seconds until it would pass.
+        """
+        now = self._clock()
+        with self._lock:
+            self._evict(now)
+            state = self._states.get(key)
+            if state is None:
+                state = [now] + [now, 0, 0] * len(self.rules)
+                self._states[key] = state
+            else:
+                self._states.move_to_end(key)
+            state[0] = now
+
+            for i, rule in enumerate(self.rules):
+                base = 1 + 3 * i
+                start, prev, cur, retry_after = _advance_window(
+                    rule, state[base], state[base + 1], state[base + 2], now, cost
+                )
+                state[base], state[base + 1], state[base + 2] = start, prev, cur
+                if retry_after is not None:
+                    return RateLimitDecision(False, rule, retry_after)
+
+            for i in range(len(self.rules)):
+                state[3 + 3 * i] += cost
+            return RateLimitDecision(True)
+
+    def reset(self, key: Optional[str] = None) -> None:
+        """Forget state for one key, or for all keys."""
+        with self._lock:
+            if key is None:
+                self._states.clear()
+            else:
+                self._states.pop(key, None)
+
+
+class SQLiteRateLimiter:
+    """
+    Sliding-window counter rate limiter whose state lives in a SQLite file,
+    so every local process (uvicorn workers, the Telegram bot) enforces one
+    shared budget per key.
+
+    Uses the same window arithmetic as SlidingWindowRateLimiter. Each check
+    is a single short `BEGIN IMMEDIATE` transaction against a WAL-mode
+    database with synchronous writes disabled; counters are advisory, so
+    losing the last few increments on a power cut is acceptable. Idle rows
+    are purged periodically.
+
+    A check waits at most `busy_timeout` seconds for the write lock; when
+    the database is busy or unusable it fails open to a per-process
+    SlidingWindowRateLimiter with the same rules instead of raising.
+    """
+
+    # Purge idle rows once every N checks per process.
+    PURGE_EVERY = 1000
+
+    def __init__(
+        self,
+        rules: Sequence[RateLimitRule],
+        db_path: str = "data/ratelimit.db",
+        namespace: str = "default",
+        idle_ttl_seconds: Optional[float] = None,
+        clock: Callable[[], float] = time.time,
+        busy_timeout: float = 0.25,
+    ):
+        if not rules:
+            raise ValueError("At least one rate limit rule is required")
+        self.rules: List[RateLimitRule] = list(rules)
+        self.db_path = db_path
+        self.namespace = namespace
+        self.busy_timeout = busy_timeout
+        self.idle_ttl_seconds = (
+            idle_ttl_seconds
+            if idle_ttl_seconds is not None
+            else 2 * max(rule.window_seconds for rule in self.rules)
+        )
+        # Wall clock: monotonic clocks are not comparable across processes.
+        self._clock = clock
+        self._local = threading.local()
+        self._checks = 0
+        self._fallback = SlidingWindowRateLimiter(self.rules, idle_ttl_seconds=self.idle_ttl_seconds)
+        self._degraded = False
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rate_limit_state (
+                    key TEXT NOT NULL,
+                    rule TEXT NOT NULL,
+                    window_start REAL NOT NULL,
+                    prev_count INTEGER NOT NULL,
+                    cur_count INTEGER NOT NULL,
+                    last_seen REAL NOT NULL,
+                    PRIMARY KEY (key, rule)
+                ) WITHOUT ROWID
+            """)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def check(self, key: str, cost: int = 1) -> RateLimitDecision:
+        """
+        Record `cost` events for `key` if every rule allows it.
+
+        Args:
+            key: Rate limit key (user id, IP, ...)
+            cost: Number of events this call represents
+
+        Returns:
+            RateLimitDecision; on rejection, `rule` is the violated rule and
+            `retry_after` an estimate in seconds until it would pass.
+        """
+        try:
+            decision = self._check_shared(key, cost)
+        except sqlite3.Error as exc:
+            if not self._degraded:
+                logger.warning("Shared rate limiter failed (%s); using in-memory limits.", exc)
+                self._degraded = True
+            return self._fallback.check(key, cost)
+        if self._degraded:
+            logger.info("Shared rate limiter recovered.")
+            self._degraded = False
+        return decision
+
+    def _check_shared(self, key: str, cost: int) -> RateLimitDecision:
+        conn = self._connection()
+        db_key = f"{self.namespace}:{key}"
+        self._checks += 1
+        if self._checks % self.PURGE_EVERY == 0:
+            self.purge_idle()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = self._clock()
+            stored = {
+                rule: (start, prev, cur)
+                for rule, start, prev, cur in conn.execute(
+                    "SELECT rule, window_start, prev_count, cur_count "
+                    "FROM rate_limit_state WHERE key = ?",
+                    (db_key,),
+                )
+            }
+            rows = []
+            decision = RateLimitDecision(True)
+            for rule in self.rules:
+                start, prev, cur = stored.get(rule.name, (now, 0, 0))
+                start, prev, cur, retry_after = _advance_window(rule, start, prev, cur, now, cost)
+                if retry_after is not None and decision.allowed:
+                    decision = RateLimitDecision(False, rule, retry_after)
+                rows.append((db_key, rule.name, start, prev, cur, now))
+            if decision.allowed:
+                rows = [(k, r, st, p, c + cost, ts) for k, r, st, p, c, ts in rows]
+            conn.executemany(
+                "INSERT OR REPLACE INTO rate_limit_state "
+                "(key, rule, window_start, prev_count, cur_count, last_seen) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return decision
+
+    def purge_idle(self) -> int:
+        """Delete rows idle for longer than `idle_ttl_seconds`. Returns rows deleted."""
+        cutoff = self._clock() - self.idle_ttl_seconds
+        cursor = self._connection().execute(
+            "DELETE FROM rate_limit_state WHERE last_seen < ?", (cutoff,)
+        )
+        return cursor.rowcount
+
+    def reset(self, key: Optional[str] = None) -> None:
+        """Forget state for one key, or for every key in this namespace."""
+        conn = self._connection()
+        if key is None:
+            conn.execute(
+                "DELETE FROM rate_limit_state WHERE key LIKE ?",
+                (f"{self.namespace}:%",),
+            )
+        else:
+            conn.execute(
+                "DELETE FROM rate_limit_state WHERE key = ?",
+                (f"{self.namespace}:{key}",),
+            )
+
+
+def create_rate_limiter(rules: Sequence[RateLimitRule], namespace: str = "default"):
+    """
+    Build the configured rate limiter backend.
+
+    `RATE_LIMIT_BACKEND` selects `sqlite` (default; shared by all processes
+    on the host through `RATE_LIMIT_DB_PATH`) or `memory` (per process).
+    Falls back to the in-memory limiter if the SQLite file is unusable.
+    """
+    backend = os.getenv("RATE_LIMIT_BACKEND", "sqlite").strip().lower()
+    if backend == "sqlite":
+        db_path = os.getenv("RATE_LIMIT_DB_PATH", "data/ratelimit.db")
+        busy_timeout = float(os.getenv("RATE_LIMIT_BUSY_TIMEOUT_MS", "250")) / 1000.0
+        try:
+            return SQLiteRateLimiter(rules, db_path=db_path, namespace=namespace, busy_timeout=busy_timeout)
+        except Exception as exc:
+            logger.warning("Shared rate limiter unavailable (%s); using in-memory limiter.", exc)
+    return SlidingWindowRateLimiter(rules)
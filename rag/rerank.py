@@ -1,32 +1,146 @@
 # rag/rerank.py
 
 import os
+import re
 import math
-from typing import List, Dict, Any
+import time
+import hashlib
+from typing import List, Dict, Any, Optional
 from langchain_core.documents import Document
 from dotenv import load_dotenv
+from rag.cache import TTLCache
+from rag.deadline import Deadline, DeadlineExceeded, check_deadline
+from rag.metrics import get_metrics
+from rag.rescore import RetrievalSignals, get_rescorer
 
 load_dotenv()
 
+# Cascade: only the RERANK_CASCADE_TOP_M best candidates by the cheap first-stage
+# score reach the cross-encoder (0 sends all of them), and scoring stops once the
+# top_k confidences all reach RERANK_EARLY_EXIT_CONFIDENCE (above 1 never stops early)
+RERANK_CASCADE_TOP_M = int(os.getenv("RERANK_CASCADE_TOP_M", "12"))
+RERANK_EARLY_EXIT_CONFIDENCE = float(os.getenv("RERANK_EARLY_EXIT_CONFIDENCE", "0.9"))
+
+# Raw cross-encoder scores keyed by (normalized query hash, chunk id)
+_SCORE_CACHE = TTLCache(
+    maxsize=int(os.getenv("RERANK_CACHE_SIZE", "8192")),
+    ttl_seconds=float(os.getenv("RERANK_CACHE_TTL_SECONDS", "86400")),
+)
+
+_TERM_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it of on or the this to what when where which who why with".split()
+)
+
+
+def _query_key(query: str) -> str:
+    return hashlib.sha1(" ".join(query.lower().split()).encode("utf-8")).hexdigest()
+
+
+def _chunk_id(doc: Document) -> str:
+    """Stable id of a chunk; includes a content hash so a re-ingested chunk is scored afresh."""
+    did = doc.metadata.get("document_id") or doc.metadata.get("doc_id") or doc.metadata.get("source") or ""
+    content_hash = hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()[:16]
+    return f"{did}:{doc.metadata.get('chunk_index', -1)}:{content_hash}"
+
+
+def _terms(text: str) -> set:
+    return {t for t in _TERM_RE.findall(text.lower()) if t not in _STOPWORDS}
+
+
+def first_stage_scores(
+    query: str,
+    documents: List[Document],
+    similarities: Optional[List[float]] = None,
+) -> List[float]:
+    """
+    Cheap relevance estimate used to shortlist candidates for the cross-encoder.
+
+    Combines vector similarity (or, without scores, the retrieval rank) with
+    the share of query terms found in the chunk, its title or section, scaled
+    by the chunk's `source_weight`.
+    """
+    query_terms = _terms(query)
+    n = len(documents)
+    scores = []
+    for i, doc in enumerate(documents):
+        similarity = similarities[i] if similarities is not None else 1.0 - i / n
+        lexical = 0.0
+        if query_terms:
+            text = " ".join((
+                doc.page_content,
+                str(doc.metadata.get("title", "")),
+                str(doc.metadata.get("section_path", "")),
+            ))
+            lexical = len(query_terms & _terms(text)) / len(query_terms)
+        weight = float(doc.metadata.get("source_weight", 1.0) or 1.0)
+        scores.append((0.6 * similarity + 0.4 * lexical) * weight)
+    return scores
+
+
+def _sigmoid(score: float) -> float:
+    # Map cross-encoder score to [0,1] for guardrail compatibility
+    try:
+        return 1.0 / (1.0 + math.exp(-float(score)))
+    except Exception:
+        return float(score)
+
 
 def _env_truthy(value: str) -> bool:
     return value.strip().lower() in {"1", "true", "yes", "on"}
 
 
+def rerank_mode() -> str:
+    """
+    RERANK_MODE: "off" (default), "local" (CrossEncoder in this process) or
+    "remote" (the shared rag/rerank_service.py process). The older
+    RERANK_ENABLED=true means "local".
+    """
+    mode = os.getenv("RERANK_MODE", "").strip().lower()
+    if mode in {"off", "local", "remote"}:
+        return mode
+    return "local" if _env_truthy(os.getenv("RERANK_ENABLED", "")) else "off"
+
+
 def is_rerank_enabled() -> bool:
-    # Temporarily disabled to reduce RAM usage in production.
-    return False
+    # Off by default: a local CrossEncoder costs a torch model per process;
+    # RERANK_MODE=remote shares one quantized model between processes.
+    return rerank_mode() != "off"
 
 
 class BGEReranker:
-    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"):
+    BATCH_SIZE = 16
+    # Pairs per cross-encoder call while an early exit is still possible
+    EARLY_EXIT_BATCH_SIZE = 4
+
+    def __init__(
+        self,
+        model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+        cascade_top_m: int = RERANK_CASCADE_TOP_M,
+        early_exit_confidence: float = RERANK_EARLY_EXIT_CONFIDENCE,
+        score_cache: Optional[TTLCache] = _SCORE_CACHE,
+    ):
         """
         Initialize BGE reranker for improving search result relevance.
         Lazily loads the CrossEncoder only when enabled.
+
+        Args:
+            model_name: Cross-encoder for local mode
+            cascade_top_m: Candidates sent to the cross-encoder; 0 sends all
+            early_exit_confidence: Stop scoring once the top_k reach this confidence
+            score_cache: Cache of cross-encoder scores, or None to always score
         """
         self.model_name = model_name
+        self.cascade_top_m = cascade_top_m
+        self.early_exit_confidence = early_exit_confidence
+        self.score_cache = score_cache
         self.cross_encoder = None
-        if is_rerank_enabled():
+        mode = rerank_mode()
+        if mode == "remote":
+            from rag.rerank_service import RemoteCrossEncoder
+            # Connects on first use, so the service may start after this process
+            self.cross_encoder = RemoteCrossEncoder()
+        elif mode == "local":
             try:
                 # Lazy import to avoid heavy deps on startup
                 from sentence_transformers import CrossEncoder  # type: ignore
@@ -41,53 +155,97 @@ class BGEReranker:
         documents: List[Document],
         top_k: int = 4,
         confidence_threshold: float = 0.5,
+        deadline: Optional[Deadline] = None,
+        signals: Optional[RetrievalSignals] = None,
     ) -> List[Dict[str, Any]]:
         """
         Rerank documents based on relevance to query.
-        
+
+        Candidates are ordered by `first_stage_scores()`; the best
+        `cascade_top_m` are scored by the cross-encoder in that order (cached
+        scores are reused), stopping early once the top_k are decisive.
+        Without a cross-encoder, confidences come from the vector rescorer
+        (rag/rescore.py) when retrieval signals are given.
+
         Args:
             query: User query
             documents: List of documents to rerank
             top_k: Number of top documents to return
             confidence_threshold: Minimum confidence score threshold
+            deadline: Optional request deadline, checked between scoring batches
+            signals: Retrieval evidence per document (similarity, variant
+                agreement, glossary hits)
             
         Returns:
             List of reranked documents with confidence scores and metadata
+
+        Raises:
+            DeadlineExceeded: The deadline passed while scoring
         """
         if not documents:
             return []
             
-        # No-op reranker if model is unavailable: assign neutral confidence
+        # No cross-encoder: calibrated confidences from retrieval evidence
         if self.cross_encoder is None:
-            fallback_results: List[Dict[str, Any]] = []
-            for i, doc in enumerate(documents[: max(top_k, 1)]):
-                fallback_results.append({
-                    "document": doc,
-                    "confidence": 0.5,
-                    "rank": i + 1,
-                    "source": doc.metadata.get("source", "Unknown"),
-                    "source_type": doc.metadata.get("source_type", "Unknown"),
-                    "doc_id": doc.metadata.get("doc_id", "Unknown"),
-                })
-            return fallback_results
-
-        # Prepare pairs for cross-encoder
-        pairs = [(query, doc.page_content) for doc in documents]
-
-        # Get relevance scores
-        scores = self.cross_encoder.predict(pairs)
-
-        # Create results with metadata
-        results: List[Dict[str, Any]] = []
-        for i, (doc, score) in enumerate(zip(documents, scores)):
-            # Map cross-encoder score to [0,1] via sigmoid for guardrail compatibility
-            try:
-                confidence = 1.0 / (1.0 + math.exp(-float(score)))
-            except Exception:
-                confidence = float(score)
+            return self._rescored_results(documents, signals, top_k, confidence_threshold)
+
+        first_stage = first_stage_scores(query, documents, signals.similarities if signals else None)
+        order = sorted(range(len(documents)), key=lambda i: first_stage[i], reverse=True)
+        if self.cascade_top_m > 0:
+            order = order[:max(self.cascade_top_m, top_k)]
+
+        query_key = _query_key(query)
+        confidences: Dict[int, float] = {}
+        pending = []
+        for i in order:
+            cached = self.score_cache.get((query_key, _chunk_id(documents[i]))) if self.score_cache is not None else None
+            if cached is None:
+                pending.append(i)
+            else:
+                confidences[i] = _sigmoid(cached)
+        cache_hits = len(confidences)
+
+        # Scored in batches so an abandoned request stops using the CPU at the
+        # next batch boundary, and so scoring can stop once the top_k are decisive
+        early_exit = self.early_exit_confidence <= 1.0
+        batch_size = max(top_k, self.EARLY_EXIT_BATCH_SIZE) if early_exit else self.BATCH_SIZE
+        scored = 0
+        exited = False
+        try:
+            for start in range(0, len(pending), batch_size):
+                if early_exit and self._decisive(confidences, top_k, max(self.early_exit_confidence, confidence_threshold)):
+                    exited = True
+                    break
+                check_deadline(deadline, "rerank")
+                batch = pending[start:start + batch_size]
+                scores = self.cross_encoder.predict([(query, documents[i].page_content) for i in batch])
+                scored += len(batch)
+                for i, score in zip(batch, scores):
+                    confidences[i] = _sigmoid(score)
+                    if self.score_cache is not None:
+                        self.score_cache.set((query_key, _chunk_id(documents[i])), float(score))
+        except DeadlineExceeded:
+            raise
+        except Exception as exc:
+            # Reranker service down or slow: answer unreranked rather than fail
+            get_metrics().inc("rerank_failures", error=type(exc).__name__)
+            return self._rescored_results(documents, signals, top_k, confidence_threshold)
+
+        metrics = get_metrics()
+        metrics.inc("rerank_candidates", len(documents), stage="first_stage")
+        metrics.inc("rerank_candidates", len(order), stage="shortlist")
+        metrics.inc("rerank_candidates", cache_hits, stage="cache_hit")
+        metrics.inc("rerank_candidates", scored, stage="cross_encoder")
+        # Share of candidates that never reached the cross-encoder
+        metrics.observe("rerank_pruning_ratio", 1.0 - scored / len(documents))
+        if exited:
+            metrics.inc("rerank_early_exits")
 
-            # Only include documents above confidence threshold
+        # Create results with metadata; only documents above the confidence threshold
+        results: List[Dict[str, Any]] = []
+        for i, confidence in confidences.items():
             if confidence >= confidence_threshold:
+                doc = documents[i]
                 results.append(
                     {
                         "document": doc,
@@ -104,7 +262,60 @@ class BGEReranker:
         
         # Return top_k results
         return results[:top_k]
+
+    @staticmethod
+    def _decisive(confidences: Dict[int, float], top_k: int, level: float) -> bool:
+        """True when at least top_k scored candidates reach `level`."""
+        return sum(1 for c in confidences.values() if c >= level) >= max(top_k, 1)
     
+    def _rescored_results(
+        self,
+        documents: List[Document],
+        signals: Optional[RetrievalSignals],
+        top_k: int,
+        confidence_threshold: float,
+    ) -> List[Dict[str, Any]]:
+        """
+        Documents ranked by the vector rescorer; neutral confidence without
+        signals. Until a fitted calibration exists the rescorer only orders
+        the candidates: confidences stay neutral and nothing is filtered, so
+        hand-set weights never decide what reaches the LLM.
+        """
+        if signals is None:
+            return self._neutral_results(documents, top_k)
+        rescorer = get_rescorer()
+        started = time.perf_counter()
+        confidences = rescorer.score(documents, signals)
+        get_metrics().observe("rescore_latency_us", int((time.perf_counter() - started) * 1e6))
+        if not rescorer.calibrated:
+            order = confidences.argsort(kind="stable")[::-1][:max(top_k, 1)]
+            return self._neutral_results([documents[i] for i in order], top_k, ranks=[int(i) + 1 for i in order])
+        results = [
+            {
+                "document": documents[i],
+                "confidence": float(confidences[i]),
+                "rank": int(i) + 1,
+                "source": documents[i].metadata.get("source", "Unknown"),
+                "source_type": documents[i].metadata.get("source_type", "Unknown"),
+                "doc_id": documents[i].metadata.get("doc_id", "Unknown"),
+            }
+            for i in confidences.argsort()[::-1]
+            if confidences[i] >= confidence_threshold
+        ]
+        return results[:top_k]
+
+    @staticmethod
+    def _neutral_results(documents: List[Document], top_k: int, ranks: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+        """Documents in the given order with neutral confidence; `ranks` are their retrieval ranks."""
+        return [{
+            "document": doc,
+            "confidence": 0.5,
+            "rank": ranks[i] if ranks else i + 1,
+            "source": doc.metadata.get("source", "Unknown"),
+            "source_type": doc.metadata.get("source_type", "Unknown"),
+            "doc_id": doc.metadata.get("doc_id", "Unknown"),
+        } for i, doc in enumerate(documents[: max(top_k, 1)])]
+
     def get_confidence_score(self, query: str, document_content: str) -> float:
         """
         Get confidence score for a single query-document pair.
@@ -119,11 +330,7 @@ class BGEReranker:
         if self.cross_encoder is None:
             # Neutral confidence when reranker is disabled
             return 0.5
-        score = self.cross_encoder.predict([(query, document_content)])
-        try:
-            return 1.0 / (1.0 + math.exp(-float(score[0])))
-        except Exception:
-            return float(score[0])
+        return _sigmoid(self.cross_encoder.predict([(query, document_content)])[0])
 
 # Global reranker instance
 _reranker = None
@@ -139,7 +346,9 @@ def rerank_documents(
     query: str, 
     documents: List[Document], 
     top_k: int = 4,
-    confidence_threshold: float = 0.5
+    confidence_threshold: float = 0.5,
+    deadline: Optional[Deadline] = None,
+    signals: Optional[RetrievalSignals] = None
 ) -> List[Dict[str, Any]]:
     """
     Convenience function to rerank documents.
@@ -149,9 +358,11 @@ def rerank_documents(
         documents: List of documents to rerank
         top_k: Number of top documents to return
         confidence_threshold: Minimum confidence score threshold
+        deadline: Optional request deadline
+        signals: Retrieval evidence per document, if known
         
     Returns:
         List of reranked documents with confidence scores and metadata
     """
     reranker = get_reranker()
-    return reranker.rerank_documents(query, documents, top_k, confidence_threshold) 
\ No newline at end of file
+    return reranker.rerank_documents(query, documents, top_k, confidence_threshold, deadline, signals)
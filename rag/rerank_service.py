@@ -0,0 +1,469 @@
+# rag/rerank_service.py
+"""
+Cross-encoder reranker served from its own process.
+
+The web app and the bot score (query, passage) pairs through
+RemoteCrossEncoder instead of each loading a torch model; the service holds
+one int8-quantized ONNX copy of the model and batches pairs from concurrent
+requests into single inference calls.
+
+    python rag/rerank_service.py export --model cross-encoder/ms-marco-MiniLM-L-6-v2
+    python rag/rerank_service.py serve
+    python rag/rerank_service.py check
+
+Any local sequence-classification model directory works with `export
+--model <dir>`. `check` builds a tiny random cross-encoder offline, exports
+and serves it on a temporary socket, and compares RemoteCrossEncoder scores
+with in-process ones, so the service can be tested without the real model.
+
+Connections authenticate with RERANK_SERVICE_AUTHKEY before any message is
+unpickled. Unset, the service generates a per-deployment key into
+RERANK_SERVICE_KEY_FILE (owner-only) that local clients read; a TCP address
+requires an explicit key.
+"""
+import os
+import sys
+import time
+import queue
+import secrets
+import argparse
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from multiprocessing.connection import Client, Connection, Listener
+from typing import List, Optional, Sequence, Tuple, Union
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Unix socket path, or host:port for TCP
+RERANK_SERVICE_ADDRESS = os.getenv("RERANK_SERVICE_ADDRESS", "data/rerank.sock")
+# Handshake secret; unset, a generated key in RERANK_SERVICE_KEY_FILE (Unix sockets only)
+RERANK_SERVICE_AUTHKEY = os.getenv("RERANK_SERVICE_AUTHKEY", "")
+RERANK_SERVICE_KEY_FILE = os.getenv("RERANK_SERVICE_KEY_FILE", "data/rerank.key")
+RERANK_MODEL_NAME = os.getenv("RERANK_MODEL_NAME", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_MODEL_DIR = os.getenv("RERANK_MODEL_DIR", "data/models/ms-marco-MiniLM-L-6-v2-onnx")
+# Tokens per (query, passage) pair; longer pairs lose tokens from the passage first
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "256"))
+# Dynamic batching: pairs per inference call, and how long the first request waits for company
+RERANK_MAX_BATCH_PAIRS = int(os.getenv("RERANK_MAX_BATCH_PAIRS", "64"))
+RERANK_BATCH_WAIT_MS = float(os.getenv("RERANK_BATCH_WAIT_MS", "5"))
+RERANK_THREADS = int(os.getenv("RERANK_THREADS", "2"))
+# Client-side cap on one scoring round trip
+RERANK_TIMEOUT_SECONDS = float(os.getenv("RERANK_TIMEOUT_SECONDS", "2"))
+
+Pair = Tuple[str, str]
+
+
+def parse_address(value: str) -> Union[str, Tuple[str, int]]:
+    """"host:port" -> ("host", port); anything else is a Unix socket path."""
+    host, sep, port = value.rpartition(":")
+    if sep and "/" not in value and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return value
+
+
+def resolve_authkey(address: Union[str, Tuple[str, int]], create: bool = False) -> bytes:
+    """
+    The handshake secret: RERANK_SERVICE_AUTHKEY, or for a Unix socket the
+    key in RERANK_SERVICE_KEY_FILE, generated with owner-only permissions
+    when `create` (the service) finds none.
+
+    Raises:
+        ValueError: A TCP address without RERANK_SERVICE_AUTHKEY
+        FileNotFoundError: No key file yet (the service has never started)
+    """
+    if RERANK_SERVICE_AUTHKEY:
+        return RERANK_SERVICE_AUTHKEY.encode("utf-8")
+    if not isinstance(address, str):
+        raise ValueError("RERANK_SERVICE_AUTHKEY must be set to use the reranker service over TCP")
+    if create and not os.path.exists(RERANK_SERVICE_KEY_FILE):
+        os.makedirs(os.path.dirname(RERANK_SERVICE_KEY_FILE) or ".", exist_ok=True)
+        try:
+            fd = os.open(RERANK_SERVICE_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "w") as f:
+                f.write(secrets.token_hex(32))
+    with open(RERANK_SERVICE_KEY_FILE, encoding="utf-8") as f:
+        return f.read().strip().encode("utf-8")
+
+
+def export_model(model_name: str, out_dir: str, quantize: bool = True, opset: int = 14) -> str:
+    """
+    Export a Hugging Face sequence-classification model to ONNX, optionally
+    with int8 dynamic quantization, next to its tokenizer.
+
+    Returns:
+        Path of the model file the service will load
+    """
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+    tokenizer.save_pretrained(out_dir)
+
+    sample = tokenizer(["what is a dvn"], ["A DVN verifies messages."], return_tensors="pt")
+    input_names = list(sample.keys())
+    fp32_path = os.path.join(out_dir, "model.onnx")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["logits"] = {0: "batch"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (dict(sample),),
+            fp32_path,
+            input_names=input_names,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+        )
+    if not quantize:
+        return fp32_path
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    int8_path = os.path.join(out_dir, "model_int8.onnx")
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+class OnnxCrossEncoder:
+    """
+    ONNX Runtime cross-encoder with the `predict(pairs)` interface of
+    sentence-transformers' CrossEncoder. Loads `model_int8.onnx` when
+    present, else `model.onnx`.
+
+    Pairs are truncated longest-first to `max_length` tokens, which in
+    practice trims the passage and keeps the (short) query whole.
+    """
+
+    def __init__(self, model_dir: str = RERANK_MODEL_DIR, max_length: int = RERANK_MAX_LENGTH, threads: int = RERANK_THREADS):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_path = os.path.join(model_dir, "model_int8.onnx")
+        if not os.path.exists(model_path):
+            model_path = os.path.join(model_dir, "model.onnx")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.model_path = model_path
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def predict(self, pairs: Sequence[Pair]) -> List[float]:
+        if not pairs:
+            return []
+        encoded = self.tokenizer(
+            [query for query, _ in pairs],
+            [passage for _, passage in pairs],
+            padding=True,
+            truncation="longest_first",
+            max_length=self.max_length,
+            return_tensors="np",
+        )
+        feeds = {name: value.astype("int64") for name, value in encoded.items() if name in self.input_names}
+        logits = self.session.run(None, feeds)[0]
+        # Single-logit models (ms-marco) score in column 0; otherwise use the positive class
+        return logits.reshape(len(pairs), -1)[:, -1].tolist()
+
+
+@dataclass
+class _ScoreRequest:
+    pairs: List[Pair]
+    done: threading.Event = field(default_factory=threading.Event)
+    scores: Optional[List[float]] = None
+    error: Optional[str] = None
+
+
+class RerankServer:
+    """
+    Serves one model to many clients. A thread per connection queues each
+    request; a single batcher thread drains the queue, packing pairs from
+    concurrent requests into inference calls of up to `max_batch_pairs`
+    and waiting at most `batch_wait_ms` for more requests once the first
+    one arrives.
+    """
+
+    def __init__(
+        self,
+        model,
+        address: Union[str, Tuple[str, int]] = parse_address(RERANK_SERVICE_ADDRESS),
+        authkey: Optional[bytes] = None,
+        max_batch_pairs: int = RERANK_MAX_BATCH_PAIRS,
+        batch_wait_ms: float = RERANK_BATCH_WAIT_MS,
+    ):
+        self.model = model
+        self.address = address
+        self.authkey = authkey or resolve_authkey(address, create=True)
+        self.max_batch_pairs = max_batch_pairs
+        self.batch_wait = batch_wait_ms / 1000.0
+        self._requests: "queue.Queue[_ScoreRequest]" = queue.Queue()
+        self.batches = 0
+        self.pairs_scored = 0
+
+    def warm_up(self) -> None:
+        """Run a small and a full-size batch so the first real request pays no graph or arena setup."""
+        self.model.predict([("warm up", "warm up")])
+        self.model.predict([("warm up", "warm up " * 64)] * self.max_batch_pairs)
+
+    def _batch_loop(self) -> None:
+        while True:
+            batch = [self._requests.get()]
+            size = len(batch[0].pairs)
+            flush_at = time.monotonic() + self.batch_wait
+            while size < self.max_batch_pairs:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.pairs)
+            self._score(batch)
+
+    def _score(self, batch: List[_ScoreRequest]) -> None:
+        pairs = [pair for request in batch for pair in request.pairs]
+        try:
+            scores: List[float] = []
+            for start in range(0, len(pairs), self.max_batch_pairs):
+                scores.extend(self.model.predict(pairs[start:start + self.max_batch_pairs]))
+                self.batches += 1
+            self.pairs_scored += len(pairs)
+        except Exception as exc:
+            for request in batch:
+                request.error = f"{type(exc).__name__}: {exc}"
+                request.done.set()
+            return
+        offset = 0
+        for request in batch:
+            request.scores = scores[offset:offset + len(request.pairs)]
+            offset += len(request.pairs)
+            request.done.set()
+
+    def _handle(self, conn: Connection) -> None:
+        with conn:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                command = message[0]
+                if command == "score":
+                    request = _ScoreRequest(list(message[1]))
+                    self._requests.put(request)
+                    request.done.wait()
+                    reply = ("error", request.error) if request.error else ("ok", request.scores)
+                elif command == "ping":
+                    reply = ("ok", {
+                        "model": getattr(self.model, "model_path", type(self.model).__name__),
+                        "batches": self.batches,
+                        "pairs_scored": self.pairs_scored,
+                    })
+                else:
+                    reply = ("error", f"unknown command {command!r}")
+                try:
+                    conn.send(reply)
+                except (EOFError, OSError):
+                    # The client timed out and hung up
+                    return
+
+    def serve_forever(self) -> None:
+        self.warm_up()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            # Stale socket from a previous run
+            os.unlink(self.address)
+        threading.Thread(target=self._batch_loop, name="rerank-batcher", daemon=True).start()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"✅ Reranker listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as exc:
+                    # Failed handshake (wrong authkey, dropped client); keep serving
+                    print(f"⚠️ Rejected reranker connection: {exc}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+
+class RemoteCrossEncoder:
+    """
+    Client for RerankServer with the `predict(pairs)` interface of
+    CrossEncoder. Connections are pooled and reused across threads; one that
+    errors or times out is discarded, and a pooled one that went stale
+    because the service restarted is retried once on a fresh connection.
+    """
+
+    def __init__(
+        self,
+        address: str = RERANK_SERVICE_ADDRESS,
+        authkey: Optional[bytes] = None,
+        timeout: float = RERANK_TIMEOUT_SECONDS,
+    ):
+        self.address = parse_address(address)
+        if authkey is None and not RERANK_SERVICE_AUTHKEY and not isinstance(self.address, str):
+            raise ValueError("RERANK_SERVICE_AUTHKEY must be set to use the reranker service over TCP")
+        # The generated key file is read on first connect, once the service has written it
+        self.authkey = authkey
+        self.timeout = timeout
+        self._idle: List[Connection] = []
+        self._lock = threading.Lock()
+
+    def _call(self, message: tuple):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        pooled = conn is not None
+        if conn is None:
+            if self.authkey is None:
+                self.authkey = resolve_authkey(self.address)
+            conn = Client(self.address, authkey=self.authkey)
+        try:
+            conn.send(message)
+            if not conn.poll(self.timeout):
+                raise TimeoutError(f"Reranker did not answer within {self.timeout:.1f}s")
+            status, payload = conn.recv()
+        except (EOFError, OSError) as exc:
+            conn.close()
+            if not pooled or isinstance(exc, TimeoutError):
+                raise
+            # The service restarted since this connection was pooled; retry on a fresh one
+            return self._call_fresh(message)
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            self._idle.append(conn)
+        if status != "ok":
+            raise RuntimeError(f"Reranker error: {payload}")
+        return payload
+
+    def _call_fresh(self, message: tuple):
+        with self._lock:
+            stale, self._idle = self._idle, []
+        for conn in stale:
+            conn.close()
+        return self._call(message)
+
+    def predict(self, pairs: Sequence[Pair]) -> List[float]:
+        if not pairs:
+            return []
+        return self._call(("score", [(str(query), str(passage)) for query, passage in pairs]))
+
+    def ping(self) -> dict:
+        return self._call(("ping",))
+
+
+def _make_tiny_model(model_dir: str) -> None:
+    """A randomly initialized two-layer BERT cross-encoder with a toy vocabulary; no download."""
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizer
+
+    os.makedirs(model_dir, exist_ok=True)
+    words = "what is a the dvn oapp oft message verifies verify chain chains layerzero endpoint warm up".split()
+    vocab_path = os.path.join(model_dir, "vocab.txt")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", ".", "?", *words]))
+    BertTokenizer(vocab_path).save_pretrained(model_dir)
+    config = BertConfig(
+        vocab_size=len(words) + 7,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        max_position_embeddings=RERANK_MAX_LENGTH,
+        num_labels=1,
+    )
+    BertForSequenceClassification(config).save_pretrained(model_dir)
+
+
+def self_check(max_batch_pairs: int = 8) -> bool:
+    """
+    Export a tiny cross-encoder, serve it on a temporary Unix socket and
+    check that RemoteCrossEncoder returns the in-process scores, that a
+    client with the wrong key is rejected, and that a client which times out
+    and hangs up does not take the service down.
+    """
+    pairs = [("what is a dvn", "a dvn verifies the message."), ("what is an oft", "the endpoint.")] * 5
+    with tempfile.TemporaryDirectory() as tmp:
+        source_dir, model_dir = os.path.join(tmp, "tiny"), os.path.join(tmp, "onnx")
+        _make_tiny_model(source_dir)
+        export_model(source_dir, model_dir)
+        local = OnnxCrossEncoder(model_dir, threads=1)
+        # Outside `tmp`: the listener removes its socket at interpreter exit
+        address = os.path.join(tempfile.gettempdir(), f"rerank-check-{os.getpid()}.sock")
+        authkey = secrets.token_bytes(16)
+        server = RerankServer(local, address=address, authkey=authkey, max_batch_pairs=max_batch_pairs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        deadline = time.monotonic() + 30
+        while not os.path.exists(address):
+            if time.monotonic() > deadline:
+                print("❌ Reranker service did not start")
+                return False
+            time.sleep(0.05)
+
+        ok = True
+        expected = local.predict(pairs)
+        remote = RemoteCrossEncoder(address, authkey=authkey, timeout=10)
+        scores = remote.predict(pairs)
+        if len(scores) != len(pairs) or max(abs(a - b) for a, b in zip(scores, expected)) > 1e-5:
+            print(f"❌ Remote scores differ from in-process scores: {scores} vs {expected}")
+            ok = False
+
+        try:
+            RemoteCrossEncoder(address, authkey=b"wrong", timeout=10).ping()
+            print("❌ A client with the wrong key was accepted")
+            ok = False
+        except Exception:
+            pass
+
+        try:
+            RemoteCrossEncoder(address, authkey=authkey, timeout=0.0).predict(pairs * 20)
+        except (TimeoutError, OSError):
+            pass
+        time.sleep(0.5)
+        if remote.predict(pairs[:2]) != scores[:2]:
+            print("❌ The service misbehaved after a client hung up")
+            ok = False
+
+        stats = remote.ping()
+        print(f"{'✅' if ok else '❌'} Tiny cross-encoder: {stats['pairs_scored']} pairs in {stats['batches']} batches")
+        return ok
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Out-of-process cross-encoder reranker.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Export a model to (int8) ONNX")
+    export.add_argument("--model", default=RERANK_MODEL_NAME, help="Hugging Face model name or local directory")
+    export.add_argument("--out", default=RERANK_MODEL_DIR)
+    export.add_argument("--no-quantize", action="store_true")
+    serve = commands.add_parser("serve", help="Serve an exported model")
+    serve.add_argument("--model-dir", default=RERANK_MODEL_DIR)
+    serve.add_argument("--address", default=RERANK_SERVICE_ADDRESS)
+    commands.add_parser("check", help="Export, serve and query a tiny random cross-encoder")
+    args = parser.parse_args(argv)
+
+    if args.command == "check":
+        sys.exit(0 if self_check() else 1)
+
+    if args.command == "export":
+        path = export_model(args.model, args.out, quantize=not args.no_quantize)
+        print(f"✅ Exported {args.model} to {path}")
+        return
+    if not os.path.isdir(args.model_dir):
+        print(f"📥 No model at {args.model_dir}; exporting {RERANK_MODEL_NAME}...")
+        export_model(RERANK_MODEL_NAME, args.model_dir)
+    RerankServer(OnnxCrossEncoder(args.model_dir), address=parse_address(args.address)).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# rag/rescore.py
+
+import os
+import json
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Written by `python rag/calibrate.py --fit`; until then the rescorer only orders candidates
+RESCORE_CALIBRATION_PATH = os.getenv("RESCORE_CALIBRATION_PATH", "data/rescore_calibration.json")
+
+FEATURES = ("similarity", "agreement", "glossary", "source_weight")
+
+
+@dataclass
+class RetrievalSignals:
+    """
+    Per-candidate evidence from retrieval, aligned with the candidate list.
+
+    similarities: Best vector similarity over the query variants that found the chunk
+    agreement: Share of query variants that retrieved the chunk
+    glossary_hits: Share of the question's glossary terms the chunk mentions
+    """
+    similarities: List[float] = field(default_factory=list)
+    agreement: List[float] = field(default_factory=list)
+    glossary_hits: List[float] = field(default_factory=list)
+
+
+@dataclass
+class Calibration:
+    """
+    Platt scaling over the features: confidence = sigmoid(weights · x + bias).
+
+    The defaults are hand-set for text-embedding-3-large cosine scores, where
+    relevant chunks mostly score above ~0.4. They are good enough to order
+    candidates but are not calibrated probabilities; fit real values on a
+    labeled replay set with rag/calibrate.py.
+    """
+    weights: Tuple[float, ...] = (14.0, 1.0, 0.8, 1.5)
+    bias: float = -6.9
+    source: str = "default"
+
+    @property
+    def fitted(self) -> bool:
+        """Whether the weights came from a calibration file rather than the defaults."""
+        return self.source != "default"
+
+    def to_dict(self) -> Dict:
+        return {"features": list(FEATURES), "weights": list(self.weights), "bias": self.bias, "source": self.source}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Calibration":
+        if tuple(data.get("features", FEATURES)) != FEATURES:
+            raise ValueError(f"Calibration features {data.get('features')} do not match {list(FEATURES)}")
+        return cls(weights=tuple(float(w) for w in data["weights"]), bias=float(data["bias"]), source=data.get("source", "file"))
+
+    def save(self, path: str = RESCORE_CALIBRATION_PATH) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def load_calibration(path: str = RESCORE_CALIBRATION_PATH) -> Calibration:
+    """Calibration from `path`, or the built-in defaults when the file is missing or invalid."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return Calibration.from_dict(json.load(f))
+    except FileNotFoundError:
+        return Calibration()
+    except (ValueError, KeyError, TypeError) as exc:
+        print(f"⚠️ Ignoring invalid rescore calibration {path}: {exc}")
+        return Calibration()
+
+
+def glossary_hit_rates(docs: Sequence[Document], expansions: Dict[str, Iterable[str]]) -> List[float]:
+    """Share of the question's glossary terms (a canonical term or any synonym) each chunk mentions."""
+    if not expansions:
+        return [0.0] * len(docs)
+    groups = [
+        {str(t).strip().lower() for t in (canonical, *synonyms) if str(t).strip()}
+        for canonical, synonyms in expansions.items()
+    ]
+    rates = []
+    for doc in docs:
+        text = " ".join((
+            doc.page_content or "",
+            str(doc.metadata.get("title", "")),
+            str(doc.metadata.get("section_path", "")),
+            str(doc.metadata.get("source", "")),
+        )).lower()
+        rates.append(sum(1 for group in groups if any(term in text for term in group)) / len(groups))
+    return rates
+
+
+def feature_matrix(docs: Sequence[Document], signals: RetrievalSignals) -> np.ndarray:
+    """Candidates × FEATURES matrix."""
+    return np.column_stack((
+        np.asarray(signals.similarities, dtype=np.float64),
+        np.asarray(signals.agreement, dtype=np.float64),
+        np.asarray(signals.glossary_hits, dtype=np.float64),
+        np.fromiter((float(d.metadata.get("source_weight", 1.0) or 1.0) for d in docs), dtype=np.float64, count=len(docs)),
+    ))
+
+
+def _sigmoid(logits: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-np.clip(logits, -30.0, 30.0)))
+
+
+def apply_calibration(features: np.ndarray, calibration: Calibration) -> np.ndarray:
+    return _sigmoid(features @ np.asarray(calibration.weights) + calibration.bias)
+
+
+def fit_calibration(features: np.ndarray, labels: np.ndarray, l2: float = 1e-2, iterations: int = 100) -> Calibration:
+    """
+    Fit Platt weights by L2-regularized logistic regression (Newton's method).
+
+    Args:
+        features: Candidates × FEATURES matrix
+        labels: 1 for relevant candidates, 0 otherwise
+        l2: Penalty on the weights (not the bias); keeps small replay sets stable
+        iterations: Upper bound on Newton steps
+    """
+    X = np.column_stack((features, np.ones(len(features))))
+    y = np.asarray(labels, dtype=np.float64)
+    penalty = np.full(X.shape[1], l2)
+    penalty[-1] = 0.0
+    theta = np.zeros(X.shape[1])
+    for _ in range(iterations):
+        p = _sigmoid(X @ theta)
+        gradient = X.T @ (p - y) + penalty * theta
+        hessian = (X * (p * (1 - p))[:, None]).T @ X + np.diag(penalty) + 1e-9 * np.eye(X.shape[1])
+        step = np.linalg.solve(hessian, gradient)
+        theta -= step
+        if np.max(np.abs(step)) < 1e-8:
+            break
+    return Calibration(weights=tuple(float(w) for w in theta[:-1]), bias=float(theta[-1]), source="fitted")
+
+
+def calibration_report(probabilities: np.ndarray, labels: np.ndarray, bins: int = 10) -> Dict:
+    """Brier score, log loss, expected calibration error, ROC AUC and a reliability table."""
+    p = np.clip(np.asarray(probabilities, dtype=np.float64), 1e-9, 1 - 1e-9)
+    y = np.asarray(labels, dtype=np.float64)
+    edges = np.linspace(0.0, 1.0, bins + 1)
+    index = np.clip(np.digitize(p, edges[1:-1]), 0, bins - 1)
+    table, ece = [], 0.0
+    for b in range(bins):
+        mask = index == b
+        if not mask.any():
+            continue
+        predicted, observed = float(p[mask].mean()), float(y[mask].mean())
+        ece += mask.mean() * abs(predicted - observed)
+        table.append({"bin": f"{edges[b]:.1f}-{edges[b + 1]:.1f}", "count": int(mask.sum()),
+                      "predicted": round(predicted, 3), "observed": round(observed, 3)})
+    positives, negatives = int(y.sum()), int(len(y) - y.sum())
+    auc = None
+    if positives and negatives:
+        # Mann-Whitney U with average ranks for ties
+        order = np.argsort(p)
+        ranks = np.empty(len(p))
+        ranks[order] = np.arange(1, len(p) + 1)
+        for value in np.unique(p):
+            tied = p == value
+            ranks[tied] = ranks[tied].mean()
+        auc = (ranks[y == 1].sum() - positives * (positives + 1) / 2) / (positives * negatives)
+    return {
+        "candidates": len(y),
+        "positives": positives,
+        "brier": round(float(np.mean((p - y) ** 2)), 4),
+        "log_loss": round(float(-np.mean(y * np.log(p) + (1 - y) * np.log(1 - p))), 4),
+        "ece": round(float(ece), 4),
+        "auc": round(float(auc), 4) if auc is not None else None,
+        "reliability": table,
+    }
+
+
+class VectorRescorer:
+    """
+    Model-free relevance scorer: confidences from retrieval evidence in a
+    few vectorized numpy operations, used whenever no cross-encoder is
+    loaded. Only `calibrated` scores are meant for thresholds.
+    """
+
+    def __init__(self, calibration: Optional[Calibration] = None):
+        self.calibration = calibration or load_calibration()
+
+    @property
+    def calibrated(self) -> bool:
+        return self.calibration.fitted
+
+    def score(self, docs: Sequence[Document], signals: RetrievalSignals) -> np.ndarray:
+        """Confidence in [0,1] per candidate."""
+        if not docs:
+            return np.zeros(0)
+        return apply_calibration(feature_matrix(docs, signals), self.calibration)
+
+
+# Global rescorer instance
+_rescorer: Optional[VectorRescorer] = None
+_rescorer_lock = threading.Lock()
+
+
+def get_rescorer() -> VectorRescorer:
+    """Get or create the global rescorer, loading the calibration file once."""
+    global _rescorer
+    if _rescorer is None:
+        with _rescorer_lock:
+            if _rescorer is None:
+                _rescorer = VectorRescorer()
+    return _rescorer
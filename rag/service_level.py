@@ -0,0 +1,176 @@
+# rag/service_level.py
+
+import os
+import time
+import threading
+from enum import Enum
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from rag.admission import all_controllers
+from rag.metrics import get_metrics
+
+
+class ServiceLevel(Enum):
+    """How much work query_rag may spend on an answer."""
+    FULL = "full"
+    REDUCED = "reduced"
+    MINIMAL = "minimal"  # answer cache / glossary only, no retrieval or LLM
+
+
+# Ordered from best to cheapest
+_LEVEL_ORDER = [ServiceLevel.FULL, ServiceLevel.REDUCED, ServiceLevel.MINIMAL]
+
+
+@dataclass(frozen=True)
+class LevelSettings:
+    """Pipeline knobs for one service level."""
+    max_query_variants: int
+    total_candidates: Optional[int]  # None: max(k * 6, 24)
+    include_neighbors: bool
+    max_context_chars: Optional[int]  # None: unbounded
+    llm_model: Optional[str]  # None: no generation
+    use_answer_cache: bool
+
+
+LEVEL_SETTINGS: Dict[ServiceLevel, LevelSettings] = {
+    ServiceLevel.FULL: LevelSettings(
+        max_query_variants=3,
+        total_candidates=None,
+        include_neighbors=True,
+        max_context_chars=None,
+        llm_model=os.getenv("LLM_MODEL", "gpt-4o"),
+        use_answer_cache=False,
+    ),
+    ServiceLevel.REDUCED: LevelSettings(
+        max_query_variants=1,
+        total_candidates=12,
+        include_neighbors=False,
+        max_context_chars=6000,
+        llm_model=os.getenv("REDUCED_LLM_MODEL", "gpt-4o-mini"),
+        use_answer_cache=True,
+    ),
+    ServiceLevel.MINIMAL: LevelSettings(
+        max_query_variants=0,
+        total_candidates=0,
+        include_neighbors=False,
+        max_context_chars=0,
+        llm_model=None,
+        use_answer_cache=True,
+    ),
+}
+
+
+class ServiceLevelController:
+    """
+    Picks the service level from live load signals, with hysteresis.
+
+    Signals are the fullest admission pool (admitted jobs / capacity) and an
+    EWMA of LLM call latency. The level degrades as soon as either signal
+    crosses its entry threshold, but only recovers one step at a time once
+    both signals are below `exit_ratio` times the thresholds and the current
+    level has been held for `min_dwell_seconds`, so it does not flap around
+    a threshold. Latency samples older than `latency_stale_seconds` are
+    ignored, which lets the cheapest level (which makes no LLM calls) probe
+    its way back up.
+    """
+
+    def __init__(
+        self,
+        reduced_load: float = 0.5,
+        minimal_load: float = 0.9,
+        reduced_latency: float = 8.0,
+        minimal_latency: float = 20.0,
+        exit_ratio: float = 0.7,
+        min_dwell_seconds: float = 15.0,
+        latency_stale_seconds: float = 60.0,
+        forced_level: Optional[ServiceLevel] = None,
+        load_signal: Optional[Callable[[], float]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.thresholds = {
+            ServiceLevel.REDUCED: (reduced_load, reduced_latency),
+            ServiceLevel.MINIMAL: (minimal_load, minimal_latency),
+        }
+        self.exit_ratio = exit_ratio
+        self.min_dwell_seconds = min_dwell_seconds
+        self.latency_stale_seconds = latency_stale_seconds
+        self.forced_level = forced_level
+        self._load_signal = load_signal or (lambda: max((c.load for c in all_controllers()), default=0.0))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._level = ServiceLevel.FULL
+        self._changed_at = clock()
+        self._latency_ewma = 0.0
+        self._latency_at: Optional[float] = None
+
+    @classmethod
+    def from_env(cls) -> "ServiceLevelController":
+        forced = os.getenv("SERVICE_LEVEL")
+        return cls(
+            reduced_load=float(os.getenv("SERVICE_LEVEL_REDUCED_LOAD", "0.5")),
+            minimal_load=float(os.getenv("SERVICE_LEVEL_MINIMAL_LOAD", "0.9")),
+            reduced_latency=float(os.getenv("SERVICE_LEVEL_REDUCED_LATENCY", "8")),
+            minimal_latency=float(os.getenv("SERVICE_LEVEL_MINIMAL_LATENCY", "20")),
+            min_dwell_seconds=float(os.getenv("SERVICE_LEVEL_MIN_DWELL", "15")),
+            forced_level=ServiceLevel(forced) if forced else None,
+        )
+
+    def record_llm_latency(self, seconds: float) -> None:
+        """Feed one LLM call duration into the latency signal."""
+        with self._lock:
+            now = self._clock()
+            if self._latency_at is None or now - self._latency_at > self.latency_stale_seconds:
+                self._latency_ewma = seconds
+            else:
+                self._latency_ewma = 0.8 * self._latency_ewma + 0.2 * seconds
+            self._latency_at = now
+
+    def _pressure_level(self, load: float, latency: float, scale: float) -> ServiceLevel:
+        level = ServiceLevel.FULL
+        for candidate, (load_threshold, latency_threshold) in self.thresholds.items():
+            if load >= load_threshold * scale or latency >= latency_threshold * scale:
+                level = candidate
+        return level
+
+    def current_level(self) -> ServiceLevel:
+        """The level new requests should be served at."""
+        if self.forced_level is not None:
+            return self.forced_level
+        load = self._load_signal()
+        with self._lock:
+            now = self._clock()
+            latency = self._latency_ewma
+            if self._latency_at is None or now - self._latency_at > self.latency_stale_seconds:
+                latency = 0.0
+
+            current = _LEVEL_ORDER.index(self._level)
+            enter = _LEVEL_ORDER.index(self._pressure_level(load, latency, 1.0))
+            stay = _LEVEL_ORDER.index(self._pressure_level(load, latency, self.exit_ratio))
+            if enter > current:
+                new = enter
+            elif stay < current and now - self._changed_at >= self.min_dwell_seconds:
+                new = current - 1
+            else:
+                new = current
+
+            if new != current:
+                self._level = _LEVEL_ORDER[new]
+                self._changed_at = now
+                get_metrics().inc("service_level_transitions", to=self._level.value)
+            get_metrics().set_gauge("service_level", new)
+            return self._level
+
+
+# Global service level controller
+_controller = None
+_controller_lock = threading.Lock()
+
+def get_service_level_controller() -> ServiceLevelController:
+    """Get or create global service level controller."""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = ServiceLevelController.from_env()
+    return _controller
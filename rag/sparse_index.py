@@ -0,0 +1,193 @@
+# rag/sparse_index.py
+
+import os
+import re
+import json
+import threading
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from rag.clients import QDRANT_COLLECTION_NAME
+
+# One index per collection, written by rag/ingest.py next to the collection upload
+SPARSE_INDEX_DIR = os.getenv("SPARSE_INDEX_DIR", "data/sparse_index")
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it its of on or that the this to was what when where which who why will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased alphanumeric tokens without stopwords; "lzRead" -> "lzread", "ULN v2" -> "uln", "v2"."""
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+class SparseIndex:
+    """
+    BM25 over chunk text with compact CSR postings.
+
+    Postings for term t are `doc_ids[offsets[t]:offsets[t + 1]]` with term
+    frequencies `tfs[...]`; a query is scored with a few numpy operations
+    per query term. Chunk text and metadata are kept so lexical-only hits
+    can be returned as Documents without a Qdrant round trip.
+    """
+
+    def __init__(
+        self,
+        vocabulary: Dict[str, int],
+        offsets: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        doc_lengths: np.ndarray,
+        documents: List[Dict],
+        version: Optional[str] = None,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.documents = documents
+        self.version = version
+        self.k1 = k1
+        self.b = b
+        n = len(doc_lengths)
+        df = np.diff(offsets).astype(np.float64)
+        self.idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5))
+        avgdl = float(doc_lengths.mean()) if n else 1.0
+        # Per-document BM25 length normalization, precomputed
+        self._norm = k1 * (1.0 - b + b * doc_lengths / max(avgdl, 1e-9))
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, chunks: Sequence[Document], version: Optional[str] = None) -> "SparseIndex":
+        """Index chunk text plus title and section path."""
+        vocabulary: Dict[str, int] = {}
+        postings: List[Dict[int, int]] = []
+        lengths = []
+        for doc_id, chunk in enumerate(chunks):
+            tokens = tokenize(" ".join((
+                chunk.page_content,
+                str(chunk.metadata.get("title", "") or ""),
+                str(chunk.metadata.get("section_path", "") or ""),
+            )))
+            lengths.append(len(tokens))
+            for token in tokens:
+                term = vocabulary.setdefault(token, len(vocabulary))
+                if term == len(postings):
+                    postings.append({})
+                postings[term][doc_id] = postings[term].get(doc_id, 0) + 1
+        counts = np.fromiter((len(p) for p in postings), dtype=np.int64, count=len(postings))
+        offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        doc_ids = np.fromiter((d for p in postings for d in sorted(p)), dtype=np.int32, count=int(offsets[-1]))
+        tfs = np.fromiter((p[d] for p in postings for d in sorted(p)), dtype=np.uint16, count=int(offsets[-1]))
+        documents = [{"page_content": c.page_content, "metadata": c.metadata} for c in chunks]
+        return cls(vocabulary, offsets, doc_ids, tfs, np.asarray(lengths, dtype=np.int32), documents, version)
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[Document, float]]:
+        """Top-k chunks by BM25 score; chunks sharing no term with the query are not returned."""
+        scores = np.zeros(len(self), dtype=np.float64)
+        for token in set(tokenize(query)):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, end = self.offsets[term], self.offsets[term + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end].astype(np.float64)
+            scores[docs] += self.idf[term] * tf * (self.k1 + 1.0) / (tf + self._norm[docs])
+        hits = np.flatnonzero(scores)
+        if not len(hits):
+            return []
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [
+            (Document(page_content=self.documents[i]["page_content"], metadata=dict(self.documents[i]["metadata"])), float(scores[i]))
+            for i in hits
+        ]
+
+    def save(self, path: str) -> None:
+        """
+        Write postings to `<path>.npz` and vocabulary and chunks to
+        `<path>.json`, each replaced atomically; the .json goes last since
+        readers reload when it changes.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez_compressed(f"{path}.tmp.npz", offsets=self.offsets, doc_ids=self.doc_ids, tfs=self.tfs, doc_lengths=self.doc_lengths)
+        os.replace(f"{path}.tmp.npz", f"{path}.npz")
+        with open(f"{path}.json.tmp", "w", encoding="utf-8") as f:
+            json.dump({"version": self.version, "vocabulary": self.vocabulary, "documents": self.documents}, f, ensure_ascii=False, default=str)
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+
+    @classmethod
+    def load(cls, path: str) -> "SparseIndex":
+        with open(f"{path}.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        with np.load(f"{path}.npz") as arrays:
+            if len(arrays["doc_lengths"]) != len(meta["documents"]):
+                # Caught between the two replaces of a save
+                raise ValueError("postings and chunk list are from different builds")
+            return cls(
+                meta["vocabulary"], arrays["offsets"], arrays["doc_ids"], arrays["tfs"], arrays["doc_lengths"],
+                meta["documents"], meta.get("version"),
+            )
+
+
+def sparse_index_path(collection_name: Optional[str] = None) -> str:
+    collection_name = collection_name or QDRANT_COLLECTION_NAME
+    return os.path.join(SPARSE_INDEX_DIR, collection_name)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Hashable]], k: int = 60) -> List[Tuple[Hashable, float]]:
+    """
+    Fuse ranked lists: each key scores sum(1 / (k + rank)) over the lists
+    it appears in, so agreement between lists outweighs a single top rank.
+    """
+    fused: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+# Loaded indexes per collection, reloaded when ingest rewrites the files
+_indexes: Dict[str, Tuple[float, Optional[SparseIndex]]] = {}
+_index_lock = threading.Lock()
+
+
+def get_sparse_index(collection_name: Optional[str] = None) -> Optional[SparseIndex]:
+    """The collection's sparse index, or None if ingest has not built one."""
+    path = sparse_index_path(collection_name)
+    try:
+        mtime = os.path.getmtime(f"{path}.json")
+    except OSError:
+        return None
+    cached = _indexes.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with _index_lock:
+        cached = _indexes.get(path)
+        if cached is None or cached[0] != mtime:
+            try:
+                index = SparseIndex.load(path)
+            except (OSError, ValueError, KeyError) as exc:
+                print(f"⚠️ Could not load sparse index {path}: {exc}")
+                index = None
+            cached = _indexes[path] = (mtime, index)
+    return cached[1]
+
+
+def build_sparse_index(chunks: Sequence[Document], collection_name: Optional[str] = None, version: Optional[str] = None) -> SparseIndex:
+    """Build and save the collection's sparse index; called by rag/ingest.py."""
+    index = SparseIndex.build(chunks, version)
+    index.save(sparse_index_path(collection_name))
+    return index
+
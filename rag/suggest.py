@@ -0,0 +1,143 @@
+# rag/suggest.py
+
+import os
+import time
+import bisect
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from rag.definitions import get_definition_store
+from rag.metadata_db import get_metadata_db
+from rag.metrics import get_metrics
+from rag.precompute import PRECOMPUTE_CLIENT, get_precomputed_answers
+from rag.query import RATE_LIMIT_EXEMPT_CLIENTS, _ANSWER_CACHE, normalize_question
+
+SUGGEST_INDEX_SIZE = int(os.getenv("SUGGEST_INDEX_SIZE", "5000"))
+SUGGEST_DAYS = int(os.getenv("SUGGEST_DAYS", "30"))
+SUGGEST_REBUILD_SECONDS = float(os.getenv("SUGGEST_REBUILD_SECONDS", "300"))
+# Weight multiplier for questions answered without an LLM call
+SUGGEST_CACHED_BOOST = float(os.getenv("SUGGEST_CACHED_BOOST", "4"))
+# /suggest is public: only offer questions answered this often, for this many distinct users
+SUGGEST_MIN_COUNT = int(os.getenv("SUGGEST_MIN_COUNT", "3"))
+SUGGEST_MIN_USERS = int(os.getenv("SUGGEST_MIN_USERS", "3"))
+# Tools a successfully answered question is logged with (rag/query.py)
+ANSWERED_TOOLS = ("rag_query", "precomputed_answer", "glossary_definition")
+
+
+def is_answer_cached(question_key: str) -> bool:
+    """Whether the question is answered from a precomputed answer, the answer cache or the glossary."""
+    if get_precomputed_answers().lookup(question_key) is not None or question_key in _ANSWER_CACHE:
+        return True
+    return get_definition_store().answer(question_key)[0] is not None
+
+
+class SuggestionIndex:
+    """
+    Popular questions in a sorted array of normalized keys with aligned
+    display texts, weights and cached flags. A prefix is a contiguous range
+    found by two bisections; its best entries come from one argpartition.
+    """
+
+    def __init__(self, entries: List[Tuple[str, str, float, bool]]):
+        entries = sorted(entries)
+        self.keys = [e[0] for e in entries]
+        self.questions = [e[1] for e in entries]
+        self.weights = np.asarray([e[2] for e in entries], dtype=np.float64)
+        self.cached = [e[3] for e in entries]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def suggest(self, prefix: str, limit: int = 8) -> List[Dict]:
+        """The `limit` heaviest questions starting with `prefix` (normalized), heaviest first."""
+        prefix = normalize_question(prefix)
+        if not prefix or limit <= 0:
+            return []
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + "\uffff", lo)
+        if lo == hi:
+            return []
+        weights = self.weights[lo:hi]
+        if hi - lo > limit:
+            top = np.argpartition(-weights, limit - 1)[:limit]
+        else:
+            top = np.arange(hi - lo)
+        top = top[np.argsort(-weights[top], kind="stable")]
+        return [{"question": self.questions[lo + i], "cached": self.cached[lo + i]} for i in top.tolist()]
+
+
+def build_suggestion_index(days: Optional[int] = SUGGEST_DAYS, size: int = SUGGEST_INDEX_SIZE) -> SuggestionIndex:
+    """
+    Index the `size` most frequent normalized questions of the last `days`
+    days, weighted by frequency and boosted when their answer is cached.
+
+    Only answered questions asked at least `SUGGEST_MIN_COUNT` times by at
+    least `SUGGEST_MIN_USERS` distinct users are indexed, and each is shown
+    as its precomputed phrasing or its normalized form, never a user's
+    verbatim text.
+    """
+    counts: Dict[str, int] = {}
+    users: Dict[str, Set[str]] = {}
+    history = get_metadata_db().get_answered_question_users(
+        days, (PRECOMPUTE_CLIENT, *RATE_LIMIT_EXEMPT_CLIENTS), ANSWERED_TOOLS
+    )
+    for row in history:
+        key = normalize_question(row["query_text"])
+        if not key:
+            continue
+        counts[key] = counts.get(key, 0) + row["count"]
+        users.setdefault(key, set()).add(row["user_id"])
+    popular = [key for key in counts if counts[key] >= SUGGEST_MIN_COUNT and len(users[key]) >= SUGGEST_MIN_USERS]
+    entries = []
+    for key in sorted(popular, key=lambda k: counts[k], reverse=True)[:size]:
+        precomputed = get_precomputed_answers().lookup(key)
+        cached = precomputed is not None or is_answer_cached(key)
+        question = " ".join(precomputed["question"].split()) if precomputed else key
+        entries.append((key, question, counts[key] * (SUGGEST_CACHED_BOOST if cached else 1.0), cached))
+    return SuggestionIndex(entries)
+
+
+# Current index, swapped whole by background rebuilds
+_index: Optional[SuggestionIndex] = None
+_rebuilding = threading.Lock()
+_rebuild_started = 0.0
+
+
+def _rebuild() -> None:
+    global _index
+    try:
+        started = time.perf_counter()
+        _index = build_suggestion_index()
+        get_metrics().observe("suggest_rebuild_ms", (time.perf_counter() - started) * 1000)
+    except Exception as exc:
+        print(f"⚠️ Could not rebuild the suggestion index: {exc}")
+    finally:
+        _rebuilding.release()
+
+
+def rebuild_suggestion_index(wait: bool = False) -> None:
+    """Rebuild the index in a background thread unless a rebuild is already running."""
+    global _rebuild_started
+    if not _rebuilding.acquire(blocking=False):
+        return
+    _rebuild_started = time.time()
+    thread = threading.Thread(target=_rebuild, name="suggest-rebuild", daemon=True)
+    thread.start()
+    if wait:
+        thread.join()
+
+
+def suggest_questions(prefix: str, limit: int = 8) -> List[Dict]:
+    """
+    Popular questions starting with `prefix`, weighted toward cached
+    answers. Never waits for a build: a missing or stale index triggers a
+    background rebuild and the current one (or nothing) is served.
+    """
+    index = _index
+    if time.time() - _rebuild_started > SUGGEST_REBUILD_SECONDS:
+        rebuild_suggestion_index()
+    if index is None:
+        return []
+    return index.suggest(prefix, limit)
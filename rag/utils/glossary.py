@@ -1,5 +1,12 @@
+import os
 import re
-from typing import Dict, List, Set, Tuple
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Tuple
+
+GLOSSARY_DOC_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "data", "docs", "Glossary.md"
+)
 
 
 def _normalize(text: str) -> str:
@@ -84,13 +91,12 @@ def find_glossary_expansions(query: str) -> Tuple[Dict[str, Set[str]], Set[str]]
     return expansions, matched_terms
 
 
-def augment_query_for_retrieval(query: str, max_terms: int = 12) -> str:
+def glossary_augmentation_terms(query: str, max_terms: int = 12) -> List[str]:
     """
-    Append glossary-based expansions to the query to improve dense retrieval recall.
+    Glossary terms augment_query_for_retrieval appends to the query:
+    canonical terms and their expansions, deduplicated, at most `max_terms`.
     """
     expansions, _ = find_glossary_expansions(query)
-    if not expansions:
-        return query
 
     terms_to_add: List[str] = []
     for canonical, extras in expansions.items():
@@ -106,14 +112,120 @@ def augment_query_for_retrieval(query: str, max_terms: int = 12) -> str:
             seen.add(t_norm)
             deduped.append(t)
 
-    if not deduped:
-        return query
-
     # Limit to avoid over-inflating the prompt
-    deduped = deduped[:max_terms]
+    return deduped[:max_terms]
+
+
+def augment_query_for_retrieval(query: str, max_terms: int = 12) -> str:
+    """
+    Append glossary-based expansions to the query to improve dense retrieval recall.
+    """
+    terms = glossary_augmentation_terms(query, max_terms)
+    if not terms:
+        return query
 
     # Add an explicit synonyms hint; this primarily affects retrieval embeddings
-    appended = query.strip() + "\nSynonyms/aliases: " + ", ".join(deduped)
+    appended = query.strip() + "\nSynonyms/aliases: " + ", ".join(terms)
     return appended
 
 
+@dataclass
+class GlossaryDefinition:
+    """A term defined in the glossary document."""
+    term: str
+    definition: str
+    names: List[str] = field(default_factory=list)
+    source: str = "Glossary.md"
+
+
+def _term_names(header: str) -> List[str]:
+    """
+    Names a glossary header can be referred to by, e.g.
+    "OFT (Omnichain Fungible Token)" -> ["oft (omnichain fungible token)", "oft", "omnichain fungible token"]
+    and "Channel / Lossless Channel" -> [..., "channel", "lossless channel"].
+    """
+    names = [_normalize(header)]
+    m = re.match(r"^(.*?)\s*\((.*?)\)\s*$", header)
+    parts = [m.group(1), m.group(2)] if m else [header]
+    for part in parts:
+        for alias in part.split("/"):
+            alias = _normalize(alias)
+            if alias and alias not in names:
+                names.append(alias)
+    return names
+
+
+def _is_term_header(line: str, next_text: str) -> bool:
+    stripped = line.strip()
+    if not stripped or len(stripped) > 60 or not stripped[0].isalpha():
+        return False
+    # Terms are proper nouns/identifiers; this skips admonitions like "tip"
+    if not any(ch.isupper() for ch in stripped):
+        return False
+    if stripped[-1] in ".:;," or any(ch in stripped for ch in ":=;{}`"):
+        return False
+    # A header is followed by a definition paragraph, not another short line
+    return len(next_text) >= 80
+
+
+@lru_cache(maxsize=4)
+def load_glossary_definitions(path: str = GLOSSARY_DOC_PATH) -> Tuple[GlossaryDefinition, ...]:
+    """
+    Parse the glossary document (a term line followed by definition
+    paragraphs) into GlossaryDefinition entries. Parsed once per path.
+    """
+    if not os.path.exists(path):
+        return ()
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.rstrip() for line in f]
+
+    entries: List[GlossaryDefinition] = []
+    current: Optional[GlossaryDefinition] = None
+    body: List[str] = []
+    for i, line in enumerate(lines):
+        next_text = next((l.strip() for l in lines[i + 1:] if l.strip()), "")
+        if i > 0 and _is_term_header(line, next_text):
+            if current is not None:
+                current.definition = "\n".join(body).strip()
+                entries.append(current)
+            current = GlossaryDefinition(term=line.strip(), definition="", names=_term_names(line.strip()))
+            body = []
+        elif current is not None:
+            body.append(line)
+    if current is not None:
+        current.definition = "\n".join(body).strip()
+        entries.append(current)
+    return tuple(e for e in entries if e.definition)
+
+
+def find_glossary_definition(query: str, path: str = GLOSSARY_DOC_PATH) -> Optional[GlossaryDefinition]:
+    """
+    Find the glossary definition the query refers to, matching term names
+    directly or through the synonym glossary. Prefers the longest match.
+    """
+    entries = load_glossary_definitions(path)
+    if not entries:
+        return None
+
+    # Direct mentions in the query win over matches through synonyms
+    query_norm = _normalize(query)
+    expanded: Set[str] = set()
+    expansions, _ = find_glossary_expansions(query)
+    for canonical, extras in expansions.items():
+        expanded.add(_normalize(canonical))
+        expanded.update(_normalize(e) for e in extras)
+
+    best: Optional[GlossaryDefinition] = None
+    best_rank = (False, 0)
+    for entry in entries:
+        for name in entry.names:
+            if _phrase_present(name, query_norm):
+                rank = (True, len(name))
+            elif name in expanded:
+                rank = (False, len(name))
+            else:
+                continue
+            if rank > best_rank:
+                best, best_rank = entry, rank
+    return best
+
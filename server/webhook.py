@@ -1,20 +1,83 @@
 """
-FastAPI server exposing a webhook to trigger the RAG assistant chain.
+FastAPI server exposing a webhook that queues thread generation on the
+shared background job queue.
+
+Run with: `uvicorn server.webhook:app --port 8001`
 """
-from fastapi import FastAPI, Request
-from generate.thread import generate_tweet_thread
-from rag.query import get_context_for_question
+import os
+import sys
+import hmac
+import math
+from contextlib import asynccontextmanager
+from typing import Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+
+from rag.admission import AdmissionRejected
+from rag.jobs import get_job_queue
+
+# Shared secret callers send as `Authorization: Bearer <token>`; the server refuses to start without it
+WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN", "")
+# Longest a caller may block waiting for a result before getting the job id back
+WEBHOOK_MAX_WAIT_SECONDS = float(os.getenv("WEBHOOK_MAX_WAIT_SECONDS", "30"))
+
+
+class WebhookRequest(BaseModel):
+    topic: str = Field(..., min_length=1, max_length=500)
+    template: Optional[str] = None
+    # Seconds to wait for the result before returning the pending job
+    wait: float = 0.0
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not WEBHOOK_TOKEN:
+        raise RuntimeError("WEBHOOK_TOKEN must be set to run the webhook server")
+    get_job_queue().recover()
+    yield
+    get_job_queue().shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def _authorize(authorization: Optional[str]) -> None:
+    token = (authorization or "").removeprefix("Bearer ").strip()
+    if not WEBHOOK_TOKEN or not hmac.compare_digest(token, WEBHOOK_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid webhook token")
 
-app = FastAPI()
 
 @app.post("/webhook")
-async def webhook(request: Request):
+async def webhook(body: WebhookRequest, authorization: Optional[str] = Header(None)):
     """
-    Accepts a JSON payload with a 'topic', runs the RAG chain, and returns the generated thread.
+    Queue a thread for `topic` and return the job. With `wait`, block up to
+    that many seconds (capped by WEBHOOK_MAX_WAIT_SECONDS) for the result.
     """
-    data = await request.json()
-    topic = data.get("topic", "")
-    # TODO: Add error handling and authentication
-    context = get_context_for_question(topic)
-    thread = generate_tweet_thread(context)
-    return {"thread": thread} 
\ No newline at end of file
+    _authorize(authorization)
+    queue = get_job_queue()
+    try:
+        # Exempt from per-user rate limits (RATE_LIMIT_EXEMPT_CLIENTS); admission bounds the queue
+        job = queue.submit_thread(body.topic, user_id="webhook", client_type="webhook", template_name=body.template)
+    except AdmissionRejected as exc:
+        return JSONResponse(
+            status_code=503,
+            content={"message": "The job queue is full. Please try again later."},
+            headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+        )
+    if not job.finished and body.wait > 0:
+        job = await queue.wait(job.id, timeout=min(body.wait, WEBHOOK_MAX_WAIT_SECONDS))
+    return JSONResponse(status_code=200 if job.finished else 202, content=job.to_dict())
+
+
+@app.get("/webhook/jobs/{job_id}")
+async def webhook_job(job_id: str, authorization: Optional[str] = Header(None)):
+    """Poll a job queued through the webhook."""
+    _authorize(authorization)
+    job = get_job_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
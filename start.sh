@@ -1,4 +1,27 @@
 #!/bin/bash
 
+# RUNTIME_MODE=unified runs the web app and the Telegram bot in one process
+# (the bot long-polls, or uses the webhook when TELEGRAM_WEBHOOK_URL is set).
+# RERANK_MODE=remote also runs the reranker service (rag/rerank_service.py).
+# With TELEGRAM_WEBHOOK_URL set the web app receives updates by webhook, so the
+# polling bot (whose startup deletes the webhook) is not started.
+if [ "${RERANK_MODE:-off}" = "remote" ]; then
+    export RERANK_AUTOSTART=true
+else
+    export RERANK_AUTOSTART=false
+fi
+if [ -n "${TELEGRAM_WEBHOOK_URL:-}" ]; then
+    export BOT_AUTOSTART=false
+else
+    export BOT_AUTOSTART=true
+fi
+
+if [ "${RUNTIME_MODE:-split}" = "unified" ]; then
+    if [ "$RERANK_AUTOSTART" = "true" ]; then
+        python rag/rerank_service.py serve &
+    fi
+    exec uvicorn app.main:app --host 0.0.0.0 --port "${PORT:-8000}"
+fi
+
 # Start the process manager with your config
 supervisord -c supervisord.conf